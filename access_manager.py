@@ -1,10 +1,17 @@
 import base64
-from random import randint
+from collections import Counter
 from PyQt5.QtCore import QUrl, QTimer, Qt
-from collections import namedtuple
 import re
+from time import monotonic
 from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkProxyFactory, QNetworkProxy, QNetworkRequest, QSslConfiguration, QNetworkReply, QNetworkCookieJar
+from block_profiles import BlockStats, get_profile, is_tracker_host, TRACKER, type_of_mime
+from http_cache import SharedCache
+from metrics import SUBREQUESTS, JOB_SUBREQUESTS, HOST_BYTES, PROXY_BYTES
+from proxy_pool import ProxyPool, parse_proxy
+from rate_limiter import RateLimiter, proxy_key
+from retry_policy import classify_reply, is_proxy_failure, CAUSE_HTTP, THROTTLE_STATUSES
 from settings import HTTP_HEADER_CHARSET
+from url_filter import compile_filter
 
 import logging
 logger = logging.getLogger(__name__)
@@ -31,16 +38,20 @@ class CookieManager(QNetworkCookieJar):
 
 
 class AccessManager(QNetworkAccessManager):
-    Rule = namedtuple('Rule', ['rule_type', 'rule'])
-    _allow = 'allow'
-    _reject = 'reject'
-
     def __init__(self, parent):
         super().__init__(parent)
 
         self.control = parent.control
-        self.rule_list = []
+        self.url_filter = None
+        self.block_profile = None
+        self.block_stats = BlockStats()
+        # 'allowed', 'filtered' or 'blocked' -> requests of the current job
+        self.subrequests = Counter()
+        self.cache_host_rules = []
         self.proxy = None
+        self.pool_proxy = None
+        self.cache = SharedCache(self)
+        self.setCache(self.cache)
         self.proxy_factory = ProxyManager(self)
         self.setProxyFactory(self.proxy_factory)
         self.proxyAuthenticationRequired.connect(self.proxy_authenticate)
@@ -60,7 +71,7 @@ class AccessManager(QNetworkAccessManager):
 
     def authenticate(self, network_proxy, authenticator):
         logger.error(self.control.prepend_id('Proxy Authenticate {}'.format(network_proxy.url())))
-        self.control.abort()
+        self.control.abort(cause=CAUSE_HTTP)
 
     def proxy_authenticate(self, network_proxy, authenticator):
         if self.proxy:
@@ -70,35 +81,62 @@ class AccessManager(QNetworkAccessManager):
             logger.error(self.control.prepend_id('Asked for proxy when no proxy is present: {}'.format(network_proxy.url())))
 
     def set_page_proxy(self, proxy_string, auth_string):
-        if not proxy_string:
+        archive = self.control.parent.net_archive
+        if not proxy_string or (archive and archive.replaying):
             return
 
-        pr = proxy_string.split(':', 1)
-        if len(pr) != 2:
-            logger.error(self.control.prepend_id('Invalid proxy string {}, auth {}'.format(proxy_string, auth_string)))
+        if proxy_string == ProxyPool.name:
+            # The job keeps the proxy it is given until it ends
+            self.pool_proxy = ProxyPool.get().acquire()
+            if self.pool_proxy:
+                logger.debug(self.control.prepend_id('Using proxy {}'.format(self.pool_proxy.name)))
+                self.proxy = self.pool_proxy.network_proxy
             return
-        host = pr[0]
-        port = int(pr[1])
 
-        if not (host and port):
+        try:
+            self.proxy = parse_proxy(proxy_string, auth_string or None)
+        except ValueError:
             logger.error(self.control.prepend_id('Invalid proxy string {}, auth {}'.format(proxy_string, auth_string)))
-            return
 
-        if auth_string:
-            aus = auth_string.split(':', 1)
-            if len(aus) != 2:
-                logger.error(self.control.prepend_id('Invalid proxy string {}, auth {}'.format(proxy_string, auth_string)))
-                return
-            user = aus[0]
-            password = aus[1]
-
-            self.proxy = QNetworkProxy(QNetworkProxy.HttpProxy, host, port, user, password)
-        else:
-            self.proxy = QNetworkProxy(QNetworkProxy.HttpProxy, host, port)
+    def is_crawlera(self):
+        if self.pool_proxy:
+            return self.pool_proxy.is_crawlera
+        return self.control.job().is_crawlera
 
     def reset(self):
-        self.rule_list = []
+        if self.block_stats:
+            logger.info(self.control.prepend_id(str(self.block_stats)))
+        for decision in ('allowed', 'filtered', 'blocked'):
+            JOB_SUBREQUESTS.labels(decision).observe(self.subrequests[decision])
+        self.subrequests = Counter()
+        self.url_filter = None
+        self.block_profile = None
+        self.block_stats = BlockStats()
+        self.cache_host_rules = []
         self.proxy = None
+        if self.pool_proxy:
+            ProxyPool.get().release(self.pool_proxy)
+            self.pool_proxy = None
+
+    def set_block_profile(self, name):
+        self.block_profile = get_profile(name)
+        if self.block_profile is None:
+            logger.error(self.control.prepend_id('Unknown block profile {}'.format(name)))
+
+    def set_cache_hosts(self, cache_hosts):
+        # From the job header this is a comma separated string, from SjCtrl.load a list
+        if isinstance(cache_hosts, str):
+            cache_hosts = cache_hosts.split(',')
+        for host_rule in cache_hosts:
+            host_rule = host_rule.strip()
+            if host_rule:
+                self.cache_host_rules.append(re.compile(host_rule))
+
+    def is_force_cached(self, url):
+        if not self.cache_host_rules:
+            return False
+        host = url.host()
+        return any(rule.search(host) for rule in self.cache_host_rules)
 
     def request_finished(self, network_reply):
         if not self.control.job():
@@ -107,7 +145,12 @@ class AccessManager(QNetworkAccessManager):
         error = network_reply.error()
         url = network_reply.url()
         url_str = url.toString()
-        retry_after_sec = 60
+        retry_after = None
+        size = network_reply.header(QNetworkRequest.ContentLengthHeader)
+        if size and not network_reply.attribute(QNetworkRequest.SourceIsFromCacheAttribute):
+            HOST_BYTES.labels(url.host()).inc(size)
+            if self.proxy:
+                PROXY_BYTES.labels('{}:{}'.format(self.proxy.hostName(), self.proxy.port())).inc(size)
         if error != 0:
             if error == QNetworkReply.OperationCanceledError:
                 logger.debug(self.control.prepend_id('Operation cancelled for url {}'.format(url_str)))
@@ -123,8 +166,8 @@ class AccessManager(QNetworkAccessManager):
             for header in network_reply.rawHeaderList():
                 header_key = header.data().decode(encoding=HTTP_HEADER_CHARSET)
                 header_value = network_reply.rawHeader(header).data().decode(encoding=HTTP_HEADER_CHARSET)
-                if 'Retry-After' == header and header_value.isdigit():
-                    retry_after_sec = int(header_value)
+                if header_key.lower() == 'retry-after' and header_value.strip().isdigit():
+                    retry_after = int(header_value.strip())
                 response_headers_string += '{}: {}\n'.format(header_key, header_value)
 
             logger.error(self.control.prepend_id('e_id="{eid};{estr}" url="{url}"\n{req_h}\n{res_h}'.format(eid=error,
@@ -132,22 +175,12 @@ class AccessManager(QNetworkAccessManager):
                                                                                                             url=url_str,
                                                                                                             req_h=request_headers_string,
                                                                                                             res_h=response_headers_string)))
-            ###############################################
-            # Throttle the retries as lazily as possible
-            ###############################################
+            status = network_reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+            if status in THROTTLE_STATUSES or retry_after is not None:
+                # Every page slows down on this host, not just this job
+                RateLimiter.get().throttle(url.host(), retry_after or 0)
 
-            # We go slightly above the recommended value, randomize it a bit and double check the values just in case
-            if retry_after_sec < 1:
-                retry_after_sec = 2
-
-            if retry_after_sec < 100:
-                retry_after_sec = (retry_after_sec * 10) + randint(0, 30)
-
-            # Restrict the retry sec to 1 hour
-            if retry_after_sec > 3600:
-                retry_after_sec = 3600
-
-            self.control.abort(retry_after_sec)
+            self.control.abort(retry_after or 0, classify_reply(error, status, retry_after))
 
     def createRequest(self, operation, request, device=None):
         if not self.control.job():
@@ -156,16 +189,42 @@ class AccessManager(QNetworkAccessManager):
         url = request.url()
         url_str = url.toString()
 
-        if self.rule_list:
-            for r in self.rule_list:
-                if r.rule.search(url_str):
-                    if r.rule_type == self._reject:
-                        logger.debug(self.control.prepend_id('Blocking {}'.format(url_str)))
-                        return super().createRequest(operation, QNetworkRequest(QUrl()), device)
-                    else:
-                        break
+        if self.url_filter and self.url_filter.is_rejected(url_str):
+            logger.debug(self.control.prepend_id('Blocking {}'.format(url_str)))
+            self.count_request('filtered', url_str)
+            return super().createRequest(operation, QNetworkRequest(QUrl()), device)
+
+        # The page itself is never blocked
+        is_subresource = url_str != self.control.job().url
+        if self.block_profile and is_subresource:
+            accept = request.rawHeader(b'Accept').data().decode(encoding=HTTP_HEADER_CHARSET)
+            resource_type = self.block_profile.blocked_type(url.host(), url.path(), accept)
+            if resource_type:
+                logger.debug(self.control.prepend_id('Blocking {} {}'.format(resource_type, url_str)))
+                self.block_stats.blocked(resource_type)
+                self.count_request('blocked', url_str, resource_type)
+                return super().createRequest(operation, QNetworkRequest(QUrl()), device)
+
+        self.count_request('allowed', url_str)
+        archive = self.control.parent.net_archive
+        if archive and archive.replaying:
+            # Nothing is sent, so the rate limits, the proxy and the cache are left alone
+            return self.watch_reply(archive.replay(operation, request, self), is_subresource)
 
-        if self.proxy and self.control.job() and self.control.job().is_crawlera:
+        rate_limiter = RateLimiter.get()
+        if is_subresource:
+            # The page itself was charged when the job was dispatched
+            rate_limiter.take(url.host())
+        if self.proxy:
+            rate_limiter.take(proxy_key('{}:{}'.format(self.proxy.hostName(), self.proxy.port())))
+
+        if self.is_force_cached(url):
+            request.setAttribute(QNetworkRequest.CacheLoadControlAttribute, QNetworkRequest.PreferCache)
+        elif url_str == self.control.job().url:
+            # The page itself is what the job is after, so it always comes from the network
+            request.setAttribute(QNetworkRequest.CacheLoadControlAttribute, QNetworkRequest.AlwaysNetwork)
+
+        if self.proxy and self.is_crawlera():
             scheme = url.scheme()
             if scheme == 'https':
                 url.setScheme('http')
@@ -188,25 +247,76 @@ class AccessManager(QNetworkAccessManager):
             request.setRawHeader(b'X-Crawlera-UA', b'desktop')
 
         network_reply = super().createRequest(operation, request, device)
+        if archive:
+            network_reply = archive.record(operation, request, device, network_reply, url_str)
+        return self.watch_reply(network_reply, is_subresource)
+
+    def watch_reply(self, network_reply, is_subresource):
         network_reply.finished.connect(lambda: self.request_finished(network_reply))
+        # Requests starting, receiving and finishing are what tells a loading page from a stalled one
+        activity = self.control.parent.activity
+        activity.request_started()
+        network_reply.downloadProgress.connect(lambda received, total: activity.progress())
+        network_reply.finished.connect(activity.request_finished)
+        if self.pool_proxy:
+            proxy = self.pool_proxy
+            proxy.in_flight += 1
+            started = monotonic()
+            network_reply.finished.connect(lambda: self.proxy_request_finished(proxy, network_reply, started))
+        if self.control.parent.trace:
+            network_reply.finished.connect(lambda reply=network_reply, started=monotonic():
+                                           self.trace_request(reply, started))
+        if is_subresource:
+            network_reply.metaDataChanged.connect(lambda: self.response_headers(network_reply))
         return network_reply
 
-    def set_filter(self, filter_str_list):
-        for filter_str in filter_str_list:
-            filter_conf = filter_str.split(':', 1)
+    def count_request(self, decision, url_str, resource_type=None):
+        self.subrequests[decision] += 1
+        SUBREQUESTS.labels(decision).inc()
+        trace = self.control.parent.trace
+        if trace and decision != 'allowed':
+            trace.instant(decision, cat='network', url=url_str, type=resource_type)
 
-            if len(filter_conf) != 2:
-                logger.error(self.control.prepend_id('Invalid filter string {}'.format(filter_str)))
-                return
+    def trace_request(self, network_reply, started):
+        trace = self.control.parent.trace
+        if not trace:
+            return
+        url_str = network_reply.url().toString()
+        trace.async_span(url_str[:100], started, url=url_str, error=int(network_reply.error()),
+                         status=network_reply.attribute(QNetworkRequest.HttpStatusCodeAttribute),
+                         size=network_reply.header(QNetworkRequest.ContentLengthHeader),
+                         cached=bool(network_reply.attribute(QNetworkRequest.SourceIsFromCacheAttribute)))
+
+    def proxy_request_finished(self, proxy, network_reply, started):
+        proxy.in_flight -= 1
+        error = network_reply.error()
+        if error == QNetworkReply.OperationCanceledError:
+            return
+        status = network_reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        proxy.request_finished(monotonic() - started, not is_proxy_failure(error, status))
+
+    def response_headers(self, network_reply):
+        """Blocks by content type the responses whose url didn't tell what they are. Also keeps the average
+        response size of every type, which is what blocking one is estimated to save."""
+        content_type = network_reply.header(QNetworkRequest.ContentTypeHeader)
+        size = network_reply.header(QNetworkRequest.ContentLengthHeader)
+        if not content_type:
+            return
 
-            rule_type = filter_conf[0]
-            if not (rule_type == self._allow or rule_type == self._reject):
-                logger.error(self.control.prepend_id('Invalid filter string {}'.format(filter_str)))
+        if self.block_profile and self.block_profile.sniff and self.control.job():
+            resource_type = self.block_profile.blocked_mime(content_type)
+            if resource_type:
+                logger.debug(self.control.prepend_id('Blocking {} {}'.format(resource_type, network_reply.url().toString())))
+                self.block_stats.blocked(resource_type, size or 0)
+                network_reply.abort()
                 return
 
-            rule_str = filter_conf[1]
-            if not rule_str:
-                logger.error(self.control.prepend_id('Invalid filter string {}'.format(filter_str)))
-                return
+        if size:
+            resource_type = TRACKER if is_tracker_host(network_reply.url().host()) else type_of_mime(content_type)
+            if resource_type:
+                BlockStats.record_response(resource_type, size)
 
-            self.rule_list.append(self.Rule(rule_type, re.compile(rule_str)))
\ No newline at end of file
+    def set_filter(self, filter_str_list):
+        self.url_filter, errors = compile_filter(tuple(filter_str_list))
+        for error in errors:
+            logger.error(self.control.prepend_id(error))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Compares SjCtrl.extract with the jQuery extraction jobs/linkedin.js used before, on a large feed page of the
+synthetic site of site_server.py.
+
+Both run --repeat times in the same page, one after the other, from the point the page is loaded to the JSON body
+that is posted. The jQuery version pays for what it did around its extraction too: a log message for every item and
+the pass of SjCtrl.post_obj over the results. The bodies they post are compared item by item and the first difference
+is printed.
+
+Run from the project directory: python benchmarks/extract_bench.py --items 2000
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from page_bench import JOBS_DIR, percentiles
+from site_server import serve
+
+
+def run(args):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    context = multiprocessing.get_context('spawn')
+    parent_connection, child_connection = context.Pipe()
+    site = context.Process(target=serve, args=(child_connection,), name='site-server', daemon=True)
+    site.start()
+    port = parent_connection.recv()
+
+    # Settings are read when the modules are imported
+    import settings
+    settings.JOB_STORE_PATH = None
+    from http_cache import SharedCache
+    from result_spool import ResultSpool
+    work_dir = tempfile.mkdtemp(prefix='sj-bench-')
+    SharedCache.configure(os.path.join(work_dir, 'http'))
+    ResultSpool.configure(os.path.join(work_dir, 'spool'))
+    from PyQt5.QtWidgets import QApplication
+    from job import Job
+    from webpage_custom import WebPageCustom
+
+    app = QApplication(sys.argv[:1])
+    page = WebPageCustom(None)
+    payloads = []
+
+    def on_render_finished(request_id, ok, payload):
+        payloads.append(json.loads(payload))
+        app.quit()
+
+    page.render_finished.connect(on_render_finished)
+    page.load_job(Job(file=os.path.join(JOBS_DIR, 'extract.js'),
+                      url='http://127.0.0.1:{}/feed?pages=1&items={}'.format(port, args.items),
+                      meta_data={'repeat': args.repeat}, request_id=1, timeout=args.timeout, stall_timeout=0))
+    app.exec_()
+    site.terminate()
+
+    if not payloads or 'error' in payloads[0]:
+        raise SystemExit('The benchmark job failed: {}'.format(payloads[0]['error'] if payloads else 'no result'))
+    return payloads[0]['result']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--items', type=int, default=2000, help='feed items on the page')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--timeout', type=int, default=600, help='seconds before giving up on the run')
+    parser.add_argument('--log-level', default='warning')
+    args = parser.parse_args()
+
+    result = run(args)
+    print('{} feed items, {} runs each'.format(result['items'], args.repeat))
+    if result['different_items']:
+        difference = result['first_difference']
+        print('The two versions posted {} different items. The first, item {}:'.format(
+            result['different_items'], difference['index']))
+        print('  jquery   {}'.format(difference['jquery']))
+        print('  extract  {}'.format(difference['extract']))
+    for name in ('jquery', 'extract'):
+        stats = percentiles(result[name + '_ms'])
+        print('{:<8} p50 {:.0f}ms  max {:.0f}ms  {:.1f}us/item  {} bytes posted'.format(
+            name, stats['p50'], stats['max'], stats['p50'] * 1000 / max(1, result['items']), result[name + '_bytes']))
+    jquery, extract = percentiles(result['jquery_ms'])['p50'], percentiles(result['extract_ms'])['p50']
+    print('extract is {:.1f}x the speed of jquery'.format(jquery / extract if extract else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+(function() {
+  'use strict';
+
+  // The getJson round trip that jobs/linkedin.js starts with. Runs on a page or, with mode script, on the lane.
+  SjCtrl.onState('main', function(job) {
+    SjCtrl.getJson(job.meta_data.api, function(data) {
+      var companies = 0, id;
+      for (id in data.result) {
+        companies = companies + 1;
+      }
+      SjCtrl.setResult({companies: companies});
+      SjCtrl.done();
+    }, function(error_id) {
+      SjCtrl.log_error('getJson failed ' + error_id);
+      SjCtrl.done();
+    });
+  }).run();
+}).call(this);
@@ -0,0 +1,128 @@
+(function() {
+  'use strict';
+
+  var FEED_SCHEMA = {
+    selector: '.feed-item',
+    list: true,
+    fields: {
+      id: {attr: 'data-li-update-id'},
+      title: {selector: '.share-title .title', text: 'content', default: ''},
+      urls: {selector: '.share-title .title, .share-body a', attr: 'href', url: true, list: true},
+      share_url: {selector: '.feed-item-meta > a', attr: 'href', url: true},
+      share_text: {selector: '.share-body .commentary', text: 'content', default: ''},
+      share_title: {value: 'published a new update on LinkedIn'},
+      pub_date: {attr: 'data-li-update-date'},
+      engagement: {
+        fields: {
+          'ln_likes': {selector: '[data-li-num-liked]', attr: 'data-li-num-liked', type: 'int', default: null},
+          'ln_comments': {selector: '[data-li-num-commented]', attr: 'data-li-num-commented', type: 'int',
+            default: null}
+        }
+      }
+    }
+  };
+
+  // parseAndSubmit of jobs/linkedin.js before SjCtrl.extract, up to the body it posted
+  function jqueryExtract() {
+    var result_list = [];
+    $('.feed-item').each(function(index, element) {
+      var title_element = $(element).find('.share-title .title'),
+        urls = [];
+
+      if (title_element) {
+        var main_url = SjCtrl.relativeToAbsolute(title_element.attr('href'));
+        if (main_url) {
+          urls.push(main_url);
+        }
+      }
+
+      $(element).find('.share-body a').each(function(index, element) {
+        var url = SjCtrl.relativeToAbsolute($(element).attr('href'));
+        if (url) {
+          urls.push(url);
+        }
+      });
+
+      var result = {
+        id: $(element).attr('data-li-update-id'),
+        title: title_element.text(),
+        urls: urls,
+        share_url: SjCtrl.relativeToAbsolute($(element).find('.feed-item-meta > a').attr('href')),
+        share_text: $(element).find('.share-body .commentary').text(),
+        share_title: 'published a new update on LinkedIn',
+        pub_date: $(element).attr('data-li-update-date'),
+        engagement: {
+          'ln_likes': parseInt($(element).find('[data-li-num-liked]').attr('data-li-num-liked')),
+          'ln_comments': parseInt($(element).find('[data-li-num-commented]').attr('data-li-num-commented'))
+        }
+      };
+      SjCtrl.log_message(result);
+      result_list.push(result);
+    });
+    return {list: result_list, body: JSON.stringify(SjCtrl.remove_undefined({data: result_list}))};
+  }
+
+  // parseAndSubmit of jobs/linkedin.js, up to the body it posts
+  function nativeExtract() {
+    var result_list = SjCtrl.extract(FEED_SCHEMA);
+    return {list: result_list, body: JSON.stringify({data: result_list})};
+  }
+
+  // JSON of value with the keys of its objects sorted, which doesn't depend on the order they were set in
+  function canonical(value) {
+    if (value === undefined) {
+      // An item one of the lists doesn't have
+      return 'no item';
+    }
+    if (value === null || typeof value !== 'object') {
+      return JSON.stringify(value);
+    }
+    if (value instanceof Array) {
+      return '[' + value.map(canonical).join(',') + ']';
+    }
+    return '{' + Object.keys(value).sort().map(function(key) {
+      return JSON.stringify(key) + ':' + canonical(value[key]);
+    }).join(',') + '}';
+  }
+
+  // How many items of the posted bodies differ and the first of them, from the bodies as they were posted
+  function compareBodies(jquery_body, native_body) {
+    var jquery_list = JSON.parse(jquery_body).data, native_list = JSON.parse(native_body).data,
+      count = Math.max(jquery_list.length, native_list.length), different = 0, first = null, i, a, b;
+    for (i = 0; i < count; i++) {
+      a = canonical(jquery_list[i]);
+      b = canonical(native_list[i]);
+      if (a !== b) {
+        different = different + 1;
+        first = first || {index: i, jquery: a, extract: b};
+      }
+    }
+    return {different_items: different, first_difference: first};
+  }
+
+  // Runs both on the feed page the job was loaded with, one after the other, and sets how long every run took
+  SjCtrl.onState('main', function(job) {
+    var jquery_ms = [], extract_ms = [], jquery, native, started, i;
+    for (i = 0; i < job.meta_data.repeat; i++) {
+      started = Date.now();
+      jquery = jqueryExtract();
+      jquery_ms.push(Date.now() - started);
+
+      started = Date.now();
+      native = nativeExtract();
+      extract_ms.push(Date.now() - started);
+    }
+
+    var comparison = compareBodies(jquery.body, native.body);
+    SjCtrl.setResult({
+      items: native.list.length,
+      different_items: comparison.different_items,
+      first_difference: comparison.first_difference,
+      jquery_ms: jquery_ms,
+      extract_ms: extract_ms,
+      jquery_bytes: jquery.body.length,
+      extract_bytes: native.body.length
+    });
+    SjCtrl.done();
+  }).run();
+}).call(this);
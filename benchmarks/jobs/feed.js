@@ -0,0 +1,60 @@
+(function() {
+  'use strict';
+
+  // What the company_page state of jobs/linkedin.js extracts from every feed item
+  var FEED_SCHEMA = {
+    selector: '.feed-item',
+    list: true,
+    fields: {
+      id: {attr: 'data-li-update-id'},
+      title: {selector: '.share-title .title', text: 'content', default: ''},
+      urls: {selector: '.share-title .title, .share-body a', attr: 'href', url: true, list: true},
+      share_url: {selector: '.feed-item-meta > a', attr: 'href', url: true},
+      share_text: {selector: '.share-body .commentary', text: 'content', default: ''},
+      pub_date: {attr: 'data-li-update-date'},
+      engagement: {
+        fields: {
+          'ln_likes': {selector: '[data-li-num-liked]', attr: 'data-li-num-liked', type: 'int', default: null},
+          'ln_comments': {selector: '[data-li-num-commented]', attr: 'data-li-num-commented', type: 'int',
+            default: null}
+        }
+      }
+    }
+  };
+
+  // Pages through the feed with its .view-more button like the company_page state of jobs/linkedin.js does, then
+  // extracts every item and posts them to the sink of the site server.
+  SjCtrl.onState('main', function(job) {
+    var page_count = 1,
+      max_page_count = job.meta_data.max_pages || 10,
+      done = false,
+      show_more_updates_button = $('#feed-show-more'),
+      show_more_updates_span = $('.view-more');
+
+    function parseAndSubmit() {
+      var result_list = SjCtrl.extract(FEED_SCHEMA);
+      SjCtrl.post_request(job.meta_data.sink, JSON.stringify({data: result_list}));
+      SjCtrl.setResult({items: result_list.length});
+      done = true;
+    }
+
+    var observer = new MutationObserver(function(mutations) {
+      mutations.forEach(function(mutation) {
+        if (done || $(mutation.target).hasClass('disabled')) {
+          return;
+        }
+        page_count = page_count + 1;
+        if (page_count >= max_page_count || show_more_updates_button.hasClass('done')) {
+          observer.disconnect();
+          parseAndSubmit();
+          SjCtrl.done();
+        } else {
+          $('.view-more').trigger('click');
+        }
+      });
+    });
+
+    observer.observe(show_more_updates_button[0], {attributes: true, childList: false, characterData: false});
+    show_more_updates_span.trigger('click');
+  }).run();
+}).call(this);
@@ -0,0 +1,2 @@
+//!> mode: fetch
+// The work is done by main() in fetch.py
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+import re
+
+ROW = re.compile(r'<tr class="row"')
+
+
+def main(sj, response):
+    sj.set_result({'status': response.status, 'rows': len(ROW.findall(response.text()))})
@@ -0,0 +1,12 @@
+(function() {
+  'use strict';
+
+  // Loads the page and reports its size. Used for the heavy, subresources, slow and error pages.
+  SjCtrl.onState('main', function(job) {
+    SjCtrl.setResult({
+      title: document.title,
+      elements: document.getElementsByTagName('*').length
+    });
+    SjCtrl.done();
+  }).run();
+}).call(this);
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""Runs a mix of jobs against the synthetic site of site_server.py on a headless PageCoordinator and reports
+jobs/sec, job latency, RSS per page and CPU per job. Results are saved as JSON to compare runs with each other.
+
+Run from the project directory:
+    python benchmarks/page_bench.py --instances 4 --jobs 200 --mix heavy:2,subresources:2,feed:1,api:1,slow:1,error:1
+    python benchmarks/page_bench.py --jobs 200 --compare benchmarks/results/<an earlier run>.json
+
+Kinds of jobs: heavy, subresources, slow, error, feed and api run on pages. api_lane and fetch run on the lane.
+Rate limits and retries are off and failed jobs count as finished, so the numbers are about the crawler and not
+its politeness. Every run starts with an empty http cache and result spool. Latency is from submitting the job to
+its end, service time from giving it to a page or the lane to its end.
+"""
+import argparse
+from collections import Counter
+import json
+import logging
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import urlopen
+
+import psutil
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from site_server import serve
+
+JOBS_DIR = os.path.join(BENCH_DIR, 'jobs')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+DEFAULT_MIX = 'heavy:2,subresources:2,feed:1,api:1,slow:1,error:1'
+# Result -> True when a bigger value is better. Compared by --compare.
+COMPARED = (('jobs_per_sec', True), ('latency.p50', False), ('latency.p95', False), ('latency.p99', False),
+            ('service.p50', False), ('service.p95', False), ('service.p99', False), ('cpu_per_job_ms', False),
+            ('rss.peak_per_page_mb', False))
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+
+    def at(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+    return {'count': len(ordered), 'mean': sum(ordered) / len(ordered), 'p50': at(50), 'p95': at(95), 'p99': at(99),
+            'max': ordered[-1]}
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition(':')
+        weights[kind.strip()] = float(weight or 1)
+    return weights
+
+
+def pick(rand, weights):
+    point = rand.random() * sum(weights.values())
+    for kind, weight in sorted(weights.items()):
+        point -= weight
+        if point < 0:
+            return kind
+    return kind
+
+
+def job_makers(port, args):
+    """kind -> function of the job number returning the arguments of the Job"""
+    proxy = '127.0.0.1:{}'.format(port)
+    local = 'http://127.0.0.1:{}'.format(port)
+
+    def page(path, script='page.js', **extra):
+        def make(n):
+            # Every job has its own url so that none are coalesced
+            url = 'http://site{}.bench.test{}{}n={}'.format(n % args.hosts, path, '&' if '?' in path else '?', n)
+            return dict(extra, file=os.path.join(JOBS_DIR, script), url=url, proxy=proxy)
+        return make
+
+    def api(mode):
+        return lambda n: dict(file=os.path.join(JOBS_DIR, 'api.js'), mode=mode,
+                              meta_data={'api': '{}/api/companies?count=20'.format(local), 'n': n})
+
+    return {
+        'heavy': page('/heavy?nodes={}'.format(args.nodes)),
+        'subresources': page('/subresources?count={}&hosts=8'.format(args.subresources)),
+        'slow': page('/slow?delay={}'.format(args.slow_delay)),
+        'error': page('/error?status=500'),
+        'feed': page('/feed?pages={}'.format(args.feed_pages), 'feed.js',
+                     meta_data={'sink': '{}/sink'.format(local), 'max_pages': args.feed_pages}),
+        'api': api(None),
+        'api_lane': api('script'),
+        'fetch': page('/heavy?nodes={}'.format(args.nodes), 'fetch.js', mode='fetch'),
+    }
+
+
+def configure(args, work_dir):
+    """Settings are read when the modules are imported, so this runs before importing any of them"""
+    import settings
+    settings.DEFAULT_HOST_RATE_LIMIT = None
+    settings.HOST_RATE_LIMITS = {}
+    settings.MAX_PAGES_PER_HOST = max(settings.MAX_PAGES_PER_HOST, args.instances)
+    settings.JOB_STORE_PATH = None
+    settings.TRACE_SAMPLE_RATE = args.trace
+    settings.TRACE_DIRECTORY = os.path.join(RESULTS_DIR, 'traces')
+    from http_cache import SharedCache
+    from result_spool import ResultSpool
+    SharedCache.configure(os.path.join(work_dir, 'http'))
+    ResultSpool.configure(os.path.join(work_dir, 'spool'))
+
+
+def make_coordinator_class():
+    from page_coordinator import PageCoordinator
+
+    class BenchCoordinator(PageCoordinator):
+        """Times every job it runs and never retries"""
+
+        def __init__(self, instances, on_done):
+            super().__init__(instances, local_jobs=False)
+            self.on_done = on_done
+            # Job.key() -> [kind, submitted at, dispatched at]
+            self.pending = {}
+            self.failures = {}
+            self.finished = []
+
+        def submit(self, jobs):
+            now = time.monotonic()
+            for kind, job in jobs:
+                self.pending[job.key()] = [kind, now, None]
+            self.add_jobs_to_queue([job for _, job in jobs])
+
+        def dispatched(self, entry):
+            super().dispatched(entry)
+            timing = self.pending.get(entry.job.key())
+            if timing:
+                timing[2] = time.monotonic()
+
+        def on_job_failed(self, job, cause, retry_after_sec):
+            self.failures[job.key()] = cause
+
+        def release_page(self, web_page):
+            entry = self.running_jobs.get(web_page)
+            super().release_page(web_page)
+            self.job_ended(entry)
+
+        def on_lane_job_finished(self, entry):
+            self.job_ended(entry)
+            super().on_lane_job_finished(entry)
+
+        def job_ended(self, entry):
+            if entry is None:
+                return
+            key = entry.job.key()
+            timing = self.pending.pop(key, None)
+            if timing is None:
+                return
+            kind, submitted_at, dispatched_at = timing
+            now = time.monotonic()
+            self.finished.append((kind, self.failures.pop(key, None), now - submitted_at,
+                                  now - (dispatched_at or submitted_at), now))
+            if not self.pending:
+                self.on_done()
+
+    return BenchCoordinator
+
+
+def run(args):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    # Spawned, a fork would share the state of this process with the server
+    context = multiprocessing.get_context('spawn')
+    parent_connection, child_connection = context.Pipe()
+    site = context.Process(target=serve, args=(child_connection,), name='site-server', daemon=True)
+    site.start()
+    port = parent_connection.recv()
+
+    work_dir = tempfile.mkdtemp(prefix='sj-bench-')
+    configure(args, work_dir)
+    from PyQt5.QtCore import QTimer
+    from PyQt5.QtWidgets import QApplication
+    from job import Job
+
+    app = QApplication(sys.argv[:1])
+    coordinator = make_coordinator_class()(args.instances, on_done=lambda: QTimer.singleShot(0, app.quit))
+
+    weights = parse_mix(args.mix)
+    makers = job_makers(port, args)
+    unknown = set(weights) - set(makers)
+    if unknown:
+        raise SystemExit('Unknown kinds {}. Known: {}'.format(', '.join(sorted(unknown)), ', '.join(sorted(makers))))
+    rand = random.Random(args.seed)
+    jobs = [(kind, Job(**makers[kind](n))) for n, kind in enumerate(pick(rand, weights) for _ in range(args.jobs))]
+
+    process = psutil.Process(os.getpid())
+    samples = []
+
+    def sample():
+        rss = process.memory_info().rss
+        cpu = process.cpu_times()
+        samples.append([round(time.monotonic() - started, 3), rss, rss // max(1, args.instances),
+                        round(cpu.user + cpu.system, 3), len(coordinator.finished)])
+
+    sampler = QTimer()
+    sampler.timeout.connect(sample)
+    sampler.start(int(args.sample_seconds * 1000))
+    timed_out = []
+    QTimer.singleShot(int(args.timeout * 1000), lambda: (timed_out.append(True), app.quit()))
+
+    cpu_before = process.cpu_times()
+    started = time.monotonic()
+    sample()
+    coordinator.submit(jobs)
+    app.exec_()
+    sample()
+    duration = time.monotonic() - started
+    cpu_after = process.cpu_times()
+
+    finished = coordinator.finished
+    cpu_seconds = (cpu_after.user + cpu_after.system) - (cpu_before.user + cpu_before.system)
+    kinds_result = {}
+    for kind in sorted(weights):
+        runs = [run for run in finished if run[0] == kind]
+        kinds_result[kind] = {'jobs': len(runs), 'failed': sum(1 for run in runs if run[1]),
+                              'latency': percentiles([run[2] for run in runs]),
+                              'service': percentiles([run[3] for run in runs])}
+    end = max(run[4] for run in finished) - started if finished else duration
+    peak_rss = max(sample[1] for sample in samples)
+    try:
+        site_stats = json.loads(urlopen('http://127.0.0.1:{}/stats'.format(port), timeout=5).read().decode('utf-8'))
+    except OSError:
+        site_stats = {}
+    site.terminate()
+
+    return {
+        'name': args.name,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'config': vars(args),
+        'jobs': len(finished),
+        'unfinished': len(coordinator.pending),
+        'timed_out': bool(timed_out),
+        'failed': sum(1 for run in finished if run[1]),
+        'failures': dict(Counter(run[1] for run in finished if run[1])),
+        'duration_sec': duration,
+        'jobs_per_sec': len(finished) / end if end else 0,
+        'latency': percentiles([run[2] for run in finished]),
+        'service': percentiles([run[3] for run in finished]),
+        'kinds': kinds_result,
+        'cpu_seconds': cpu_seconds,
+        'cpu_per_job_ms': cpu_seconds / len(finished) * 1000 if finished else 0,
+        'rss': {'start_mb': samples[0][1] / 1024 / 1024, 'peak_mb': peak_rss / 1024 / 1024,
+                'end_mb': samples[-1][1] / 1024 / 1024,
+                'peak_per_page_mb': peak_rss / max(1, args.instances) / 1024 / 1024},
+        # [sec since start, rss, rss per page, cpu sec, jobs finished]
+        'samples': samples,
+        # Process RSS growth while each page had a job, not memory of the page itself
+        'process_rss_growth_mb_by_page': [getattr(page, 'process_rss_growth', 0) / 1024 / 1024
+                                          for page in coordinator.web_pages],
+        'site': site_stats,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def lookup(result, path):
+    for name in path.split('.'):
+        result = result.get(name) if isinstance(result, dict) else None
+    return result
+
+
+def compare(previous, current, threshold):
+    """Prints the change of every compared result. Returns the names of those that got worse by over threshold %."""
+    regressions = []
+    print('{:<22} {:>12} {:>12} {:>8}'.format('', previous.get('commit') or 'previous', current.get('commit') or
+                                             'current', 'change'))
+    for path, higher_is_better in COMPARED:
+        before, after = lookup(previous, path), lookup(current, path)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        worse = change < -threshold if higher_is_better else change > threshold
+        if worse:
+            regressions.append(path)
+        print('{:<22} {:>12.3f} {:>12.3f} {:>+7.1f}%{}'.format(path, before, after, change, ' !' if worse else ''))
+    return regressions
+
+
+def print_summary(result):
+    print('{} jobs in {:.1f}s, {:.2f} jobs/sec, {} failed {}'.format(
+        result['jobs'], result['duration_sec'], result['jobs_per_sec'], result['failed'], result['failures']))
+    if result['unfinished']:
+        print('{} jobs did not finish before the timeout'.format(result['unfinished']))
+    for name in ('latency', 'service'):
+        stats = result[name]
+        if stats['count']:
+            print('{:<8} p50 {:.3f}s  p95 {:.3f}s  p99 {:.3f}s'.format(name, stats['p50'], stats['p95'], stats['p99']))
+    for kind, stats in sorted(result['kinds'].items()):
+        if stats['jobs']:
+            print('  {:<13} {:>5} jobs {:>4} failed  p50 {:.3f}s  p95 {:.3f}s'.format(
+                kind, stats['jobs'], stats['failed'], stats['latency']['p50'], stats['latency']['p95']))
+    print('cpu {:.1f}ms/job, peak rss {:.0f}MB, {:.0f}MB per page'.format(
+        result['cpu_per_job_ms'], result['rss']['peak_mb'], result['rss']['peak_per_page_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--instances', type=int, default=4, help='pages')
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='kind:weight,... default %(default)s')
+    parser.add_argument('--hosts', type=int, default=20, help='fake hosts the pages are spread over')
+    parser.add_argument('--nodes', type=int, default=3000, help='rows of the heavy page')
+    parser.add_argument('--subresources', type=int, default=120, help='subresources of the subresources page')
+    parser.add_argument('--feed-pages', type=int, default=5)
+    parser.add_argument('--slow-delay', type=float, default=2)
+    parser.add_argument('--timeout', type=float, default=600, help='seconds before giving up on the run')
+    parser.add_argument('--sample-seconds', type=float, default=1, help='how often RSS and CPU are sampled')
+    parser.add_argument('--trace', type=float, default=0, help='fraction of the jobs to trace')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--name', default='page_bench')
+    parser.add_argument('--output', help='JSON file for the results, by default in benchmarks/results')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=10, help='%% change that counts as a regression')
+    parser.add_argument('--log-level', default='warning')
+    args = parser.parse_args()
+
+    result = run(args)
+    print_summary(result)
+
+    output = args.output or os.path.join(RESULTS_DIR, '{}-{}.json'.format(args.name, time.strftime('%Y%m%d-%H%M%S')))
+    with open(output, 'w', encoding='utf-8') as output_file:
+        json.dump(result, output_file, indent=2, sort_keys=True)
+    print('Results saved to {}'.format(output))
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as previous_file:
+            regressions = compare(json.load(previous_file), result, args.threshold)
+        if regressions:
+            print('Regressions over {}%: {}'.format(args.threshold, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
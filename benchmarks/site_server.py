@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for the sites jobs scrape, for benchmarks.
+
+It is also an http proxy. Jobs that use it as their proxy can ask for any host, e.g. http://cdn3.bench.test/, and
+all of them are served from here without any DNS. Every response is no-store so that runs don't depend on the
+http cache left by the last one.
+
+    /heavy?nodes=3000               a page with a large DOM
+    /subresources?count=120&hosts=8 a page with count images, stylesheets and scripts spread over fake cdn hosts
+    /static/<n>.<png|css|js>        the subresources, SUBRESOURCE_BYTES each
+    /slow?delay=2                   a small page served after delay seconds
+    /error?status=500               an error page
+    /feed?pages=5&items=10          a linkedin style feed whose .view-more button loads the next page from /api/feed
+    /api/feed?page=1&pages=5        a page of feed items as html in JSON
+    /api/companies?count=20         a JSON list like the social_peek api that jobs/linkedin.js starts from
+    POST /sink                      takes posted results and counts them
+    /stats                          how many requests and posts were served
+
+Run on its own with: python benchmarks/site_server.py [port]
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+from socketserver import ThreadingMixIn
+import sys
+import time
+from urllib.parse import urlsplit, parse_qs
+
+SUBRESOURCE_BYTES = 4096
+FEED_ITEMS_PER_PAGE = 10
+# A 1x1 transparent png
+PNG = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                    '1f15c4890000000d49444154789c6360000002000100e221bc330000000049454e44ae426082')
+
+
+def feed_item(page, index):
+    item_id = page * FEED_ITEMS_PER_PAGE + index
+    return ('<li class="feed-item" data-li-update-id="{id}" data-li-update-date="{date}">'
+            '<div class="share-title"><a class="title" href="/posts/{id}">Update {id}</a></div>'
+            '<div class="share-body"><p class="commentary">Text of update {id} {filler}</p>'
+            '<a href="/links/{id}/1">one</a><a href="/links/{id}/2">two</a></div>'
+            '<div class="feed-item-meta"><a href="/share/{id}">share</a>'
+            '<span data-li-num-liked="{likes}"></span><span data-li-num-commented="{comments}"></span></div>'
+            '</li>').format(id=item_id, date=1500000000 + item_id, filler='lorem ipsum ' * 20, likes=item_id % 97,
+                            comments=item_id % 13)
+
+
+FEED_PAGE = """<html><head><title>Feed</title></head><body>
+<ul id="feed">{items}</ul>
+<button id="feed-show-more" data-pages="{pages}"><span class="view-more">Show more</span></button>
+<script>
+(function() {{
+  var page = 1, pages = {pages}, button = document.getElementById('feed-show-more');
+  document.querySelector('.view-more').addEventListener('click', function() {{
+    if (page >= pages || button.className.indexOf('disabled') !== -1) {{
+      return;
+    }}
+    button.className = 'disabled';
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', '/api/feed?page=' + (page + 1) + '&pages=' + pages);
+    xhr.onload = function() {{
+      page = page + 1;
+      document.getElementById('feed').insertAdjacentHTML('beforeend', JSON.parse(xhr.responseText).html);
+      button.className = page >= pages ? 'done' : '';
+    }};
+    xhr.send();
+  }});
+}})();
+</script>
+</body></html>"""
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type='text/html; charset=utf-8', status=200):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data):
+        self.send_body(json.dumps(data), 'application/json')
+
+    def do_GET(self):
+        # As a proxy the request line has the whole url
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.requests += 1
+        path = url.path
+        if path == '/heavy':
+            nodes = int(query.get('nodes', 3000))
+            rows = ''.join('<tr class="row" id="r{0}"><td><span class="a">{0}</span></td><td><div><b>cell</b> {0}'
+                           '</div></td></tr>'.format(i) for i in range(nodes))
+            self.send_body('<html><head><title>Heavy</title></head><body><table>{}</table></body></html>'.format(rows))
+        elif path == '/subresources':
+            count, hosts = int(query.get('count', 120)), int(query.get('hosts', 8))
+            tags = []
+            for i in range(count):
+                src = 'http://cdn{}.bench.test/static/{}'.format(i % hosts, i)
+                kind = i % 3
+                if kind == 0:
+                    tags.append('<img src="{}.png">'.format(src))
+                elif kind == 1:
+                    tags.append('<link rel="stylesheet" href="{}.css">'.format(src))
+                else:
+                    tags.append('<script src="{}.js"></script>'.format(src))
+            self.send_body('<html><head><title>Subresources</title></head><body>{}</body></html>'.format(''.join(tags)))
+        elif path.startswith('/static/'):
+            name = path.rsplit('/', 1)[-1]
+            if name.endswith('.png'):
+                self.send_body(PNG + b'\0' * (SUBRESOURCE_BYTES - len(PNG)), 'image/png')
+            elif name.endswith('.css'):
+                rule = '.c{} {{ color: #123456; margin: 1px; }}\n'.format(name.split('.')[0])
+                self.send_body(rule * (SUBRESOURCE_BYTES // len(rule)), 'text/css')
+            else:
+                statement = 'window.sj_bench = (window.sj_bench || 0) + 1;\n'
+                self.send_body(statement * (SUBRESOURCE_BYTES // len(statement)), 'application/javascript')
+        elif path == '/slow':
+            time.sleep(float(query.get('delay', 2)))
+            self.send_body('<html><head><title>Slow</title></head><body>slow</body></html>')
+        elif path == '/error':
+            self.send_body('<html><body>error</body></html>', status=int(query.get('status', 500)))
+        elif path == '/feed':
+            pages, count = int(query.get('pages', 5)), int(query.get('items', FEED_ITEMS_PER_PAGE))
+            items = ''.join(feed_item(0, i) for i in range(count))
+            self.send_body(FEED_PAGE.format(items=items, pages=pages))
+        elif path == '/api/feed':
+            page = int(query.get('page', 1))
+            self.send_json({'html': ''.join(feed_item(page - 1, i) for i in range(FEED_ITEMS_PER_PAGE))})
+        elif path == '/stats':
+            self.send_json({'requests': self.server.requests, 'posts': self.server.posts})
+        elif path == '/api/companies':
+            count = int(query.get('count', 20))
+            self.send_json({'result': {str(i): {'linkedin_company': 'company{}'.format(i), 'last_access_id': '',
+                                                'search_keyword_id': str(i)} for i in range(count)}})
+        else:
+            self.send_body('<html><body>not found</body></html>', status=404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.requests += 1
+        if urlsplit(self.path).path == '/sink':
+            self.server.posts += 1
+            self.send_json({'ok': True})
+        else:
+            self.send_body('<html><body>not found</body></html>', status=404)
+
+
+class SiteServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        super().__init__(('127.0.0.1', port), SiteHandler)
+        self.requests = 0
+        self.posts = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def serve(connection):
+    """Target of the process the benchmarks run the site in, so that its CPU isn't counted as theirs"""
+    server = SiteServer()
+    connection.send(server.port)
+    server.serve_forever()
+
+
+def main():
+    server = SiteServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
+    print('Serving the synthetic site on 127.0.0.1:{}. Use it as the http proxy for *.bench.test'.format(server.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
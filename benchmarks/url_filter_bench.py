@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Compares the compiled url filter with the rule by rule loop AccessManager used before.
+
+Run from the project directory: python benchmarks/url_filter_bench.py
+"""
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_filter import compile_filter
+
+FILTER_LIST = ['allow:www\\.linkedin\\.com',
+               'allow:static\\.licdn\\.com',
+               'allow:media\\.licdn\\.com',
+               'reject:\\.(png|jpe?g|gif|svg|woff2?)(\\?|$)',
+               'reject:doubleclick\\.net',
+               'reject:google-analytics\\.com',
+               'reject:/ads?/',
+               'reject:facebook\\.(com|net)',
+               'allow:\\.js(\\?|$)',
+               'allow:\\.css(\\?|$)',
+               'reject:.*']
+
+# A long block list of tracker domains in front of a catch all allow
+TRACKER_FILTER_LIST = (['reject:tracker{}\\.example\\.net'.format(i) for i in range(60)] +
+                       ['reject:/pixel\\.(gif|png)', 'reject:[?&]utm_', 'allow:.*'])
+
+HOSTS = ['www.linkedin.com', 'static.licdn.com', 'media.licdn.com', 'stats.g.doubleclick.net',
+         'www.google-analytics.com', 'connect.facebook.net', 'cdn.example.com', 'fonts.example.org']
+PATHS = ['/', '/in/someone', '/sc/h/abc123.js', '/sc/h/def456.css', '/media/p/1.jpg', '/ads/slot.js',
+         '/collect?v=1&tid=UA-1', '/fonts/x.woff2', '/api/data?id=42']
+
+
+def loop_decision(rules, url):
+    for rule_type, rule in rules:
+        if rule.search(url):
+            return rule_type
+    return None
+
+
+def bench(name, filter_list, urls):
+    rules = [(filter_str.split(':', 1)[0], re.compile(filter_str.split(':', 1)[1])) for filter_str in filter_list]
+    url_filter, _ = compile_filter(tuple(filter_list))
+
+    for url in urls:
+        assert loop_decision(rules, url) == url_filter.decision(url), url
+
+    pages = 200
+    loop_time = timeit.timeit(lambda: [loop_decision(rules, url) for url in urls], number=pages)
+    compiled_time = timeit.timeit(lambda: [url_filter.decision(url) for url in urls], number=pages)
+    url_filter.memo.clear()
+    unmemoized_time = timeit.timeit(lambda: [url_filter.memo.clear(), [url_filter.decision(url) for url in urls]],
+                                    number=pages)
+
+    requests = pages * len(urls)
+    print('{}: {} rules, {} requests'.format(name, len(filter_list), requests))
+    print('rule loop         {:.3f}s  {:.2f}us/request'.format(loop_time, loop_time / requests * 1e6))
+    print('compiled          {:.3f}s  {:.2f}us/request'.format(compiled_time, compiled_time / requests * 1e6))
+    print('compiled, no memo {:.3f}s  {:.2f}us/request'.format(unmemoized_time, unmemoized_time / requests * 1e6))
+
+
+def main():
+    random.seed(1)
+    # A page makes a couple of hundred requests, mostly to urls the previous pages asked for already
+    hosts = HOSTS + ['tracker{}.example.net'.format(i) for i in range(0, 60, 7)]
+    urls = ['https://{}{}?v={}'.format(random.choice(hosts), random.choice(PATHS), random.randint(0, 50))
+            for _ in range(200)]
+    bench('linkedin style', FILTER_LIST, urls)
+    bench('tracker list', TRACKER_FILTER_LIST, urls)
+
+
+if __name__ == '__main__':
+    main()
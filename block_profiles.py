@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+from functools import lru_cache
+import posixpath
+
+from settings import BLOCK_PROFILES
+
+import logging
+logger = logging.getLogger(__name__)
+
+IMAGE = 'image'
+FONT = 'font'
+MEDIA = 'media'
+STYLESHEET = 'stylesheet'
+SCRIPT = 'script'
+TRACKER = 'tracker'
+RESOURCE_TYPES = (IMAGE, FONT, MEDIA, STYLESHEET, SCRIPT, TRACKER)
+
+EXTENSION_TYPES = {
+    '.png': IMAGE, '.jpg': IMAGE, '.jpeg': IMAGE, '.gif': IMAGE, '.webp': IMAGE, '.svg': IMAGE, '.ico': IMAGE,
+    '.bmp': IMAGE,
+    '.woff': FONT, '.woff2': FONT, '.ttf': FONT, '.otf': FONT, '.eot': FONT,
+    '.mp4': MEDIA, '.webm': MEDIA, '.ogv': MEDIA, '.m3u8': MEDIA, '.ts': MEDIA, '.mp3': MEDIA, '.ogg': MEDIA,
+    '.wav': MEDIA, '.m4a': MEDIA, '.flv': MEDIA, '.swf': MEDIA,
+    '.css': STYLESHEET,
+    '.js': SCRIPT,
+}
+
+# Content type prefixes, for responses whose url didn't give their type away
+MIME_TYPES = (('image/', IMAGE), ('font/', FONT), ('application/font-', FONT), ('application/x-font-', FONT),
+              ('application/vnd.ms-fontobject', FONT), ('video/', MEDIA), ('audio/', MEDIA),
+              ('application/vnd.apple.mpegurl', MEDIA), ('application/x-mpegurl', MEDIA), ('text/css', STYLESHEET),
+              ('application/javascript', SCRIPT), ('application/x-javascript', SCRIPT), ('text/javascript', SCRIPT))
+
+# Analytics, ad and tracking pixel hosts. Subdomains are blocked too.
+TRACKER_HOSTS = frozenset([
+    'google-analytics.com', 'googletagmanager.com', 'googletagservices.com', 'googlesyndication.com',
+    'googleadservices.com', 'doubleclick.net', 'adservice.google.com', 'analytics.google.com',
+    'connect.facebook.net', 'pixel.facebook.com', 'ads.linkedin.com', 'px.ads.linkedin.com', 'snap.licdn.com',
+    'analytics.twitter.com', 'ads-twitter.com', 'static.ads-twitter.com', 'bat.bing.com', 'clarity.ms',
+    'scorecardresearch.com', 'quantserve.com', 'quantcount.com', 'chartbeat.com', 'chartbeat.net',
+    'hotjar.com', 'mouseflow.com', 'crazyegg.com', 'fullstory.com', 'mixpanel.com', 'segment.com', 'segment.io',
+    'amplitude.com', 'heap.io', 'heapanalytics.com', 'optimizely.com', 'newrelic.com', 'nr-data.net',
+    'adnxs.com', 'adsrvr.org', 'criteo.com', 'criteo.net', 'taboola.com', 'outbrain.com', 'rubiconproject.com',
+    'pubmatic.com', 'openx.net', 'casalemedia.com', 'moatads.com', 'amazon-adsystem.com', 'yieldmo.com',
+    'demdex.net', 'omtrdc.net', '2o7.net', 'everesttech.net', 'krxd.net', 'bluekai.com', 'exelator.com',
+    'mathtag.com', 'rlcdn.com', 'tapad.com', 'addthis.com', 'sharethis.com', 'disqusads.com', 'zedo.com',
+    'mc.yandex.ru', 'hs-analytics.net', 'hubspot.com', 'intercom.io', 'intercomcdn.com',
+])
+
+
+def is_tracker_host(host):
+    host = host.lower()
+    while host:
+        if host in TRACKER_HOSTS:
+            return True
+        dot = host.find('.')
+        if dot < 0:
+            return False
+        host = host[dot + 1:]
+    return False
+
+
+def type_of_path(path):
+    return EXTENSION_TYPES.get(posixpath.splitext(path)[1].lower())
+
+
+def type_of_accept(accept):
+    """WebKit asks for images and stylesheets with their own Accept headers"""
+    if accept.startswith('image/'):
+        return IMAGE
+    if accept.startswith('text/css'):
+        return STYLESHEET
+    return None
+
+
+def type_of_mime(content_type):
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    for prefix, resource_type in MIME_TYPES:
+        if content_type.startswith(prefix):
+            return resource_type
+    return None
+
+
+class BlockProfile(object):
+    """A named set of resource types that the pages of a job don't load"""
+
+    def __init__(self, name, resource_types):
+        self.name = name
+        self.resource_types = frozenset(resource_types)
+        self.sniff = bool(self.resource_types - {TRACKER})
+
+    def blocked_type(self, host, path, accept):
+        """The type the request is blocked as, or None. Uses only what is known before the request is sent."""
+        if TRACKER in self.resource_types and is_tracker_host(host):
+            return TRACKER
+        resource_type = type_of_path(path) or type_of_accept(accept)
+        if resource_type in self.resource_types:
+            return resource_type
+        return None
+
+    def blocked_mime(self, content_type):
+        resource_type = type_of_mime(content_type)
+        if resource_type in self.resource_types:
+            return resource_type
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_profile(name):
+    resource_types = BLOCK_PROFILES.get(name)
+    if resource_types is None:
+        return None
+    unknown = set(resource_types) - set(RESOURCE_TYPES)
+    if unknown:
+        logger.error('Unknown resource types {} in block profile {}'.format(', '.join(sorted(unknown)), name))
+    return BlockProfile(name, set(resource_types) & set(RESOURCE_TYPES))
+
+
+class BlockStats(object):
+    """What a block profile saved during one job.
+
+    Requests blocked before they are sent have no size, so their bytes are estimated from the average size of the
+    responses of the same type this process did load. Responses aborted after their headers count their
+    Content-Length.
+    """
+    # Shared by all the pages of the process: resource type -> [responses, bytes]
+    response_sizes = {}
+    # Process totals
+    total_requests = Counter()
+    total_bytes = 0
+
+    def __init__(self):
+        self.requests = Counter()
+        self.bytes = 0
+
+    @staticmethod
+    def record_response(resource_type, size):
+        sizes = BlockStats.response_sizes.setdefault(resource_type, [0, 0])
+        sizes[0] += 1
+        sizes[1] += size
+
+    @staticmethod
+    def average_size(resource_type):
+        responses, size = BlockStats.response_sizes.get(resource_type, (0, 0))
+        return size // responses if responses else 0
+
+    @staticmethod
+    def stats():
+        return {'requests': dict(BlockStats.total_requests), 'bytes': BlockStats.total_bytes}
+
+    def blocked(self, resource_type, size=None):
+        if size is None:
+            size = self.average_size(resource_type)
+        self.requests[resource_type] += 1
+        self.bytes += size
+        BlockStats.total_requests[resource_type] += 1
+        BlockStats.total_bytes += size
+
+    def __bool__(self):
+        return bool(self.requests)
+
+    def __str__(self):
+        return 'Blocked {} requests, about {} bytes ({})'.format(
+            sum(self.requests.values()), self.bytes,
+            ', '.join('{}={}'.format(k, v) for k, v in sorted(self.requests.items())))
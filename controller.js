@@ -4,6 +4,16 @@
   SjCtrl.callbackMap = {};
   SjCtrl.httpRequestCallbackMap = {};
   SjCtrl.httpRequestGenerate = 1;
+  SjCtrl.networkIdleCallbackMap = {};
+  SjCtrl.networkIdleGenerate = 1;
+  SjCtrl.selectorWaitGenerate = 1;
+  // Read by the page to tell a page that is still changing from a stalled one
+  SjCtrl.domMutations = 0;
+  if (typeof MutationObserver !== 'undefined' && typeof document !== 'undefined') {
+    new MutationObserver(function(mutations) {
+      SjCtrl.domMutations = SjCtrl.domMutations + mutations.length;
+    }).observe(document, {childList: true, attributes: true, characterData: true, subtree: true});
+  }
   SjCtrl.onState = function(state, callback) {
     if (!state) {
       SjCtrl.log_error('No state specified for onState');
@@ -19,8 +29,7 @@
       try {
         cb(SjCtrl.job_dict);
       } catch (e) {
-        SjCtrl.log_error('Exception in job: ' + e.message);
-        SjCtrl.done();
+        SjCtrl.script_error(String(e && e.message || e));
       }
     } else {
       SjCtrl.log_error('No callback with state ' + state);
@@ -30,20 +39,85 @@
 
   SjCtrl.getJson = function(url, success_callback, failure_callback, always_callback) {
     SjCtrl.httpRequestGenerate = SjCtrl.httpRequestGenerate + 1;
-    SjCtrl.http_request(SjCtrl.httpRequestGenerate, url);
     SjCtrl.httpRequestCallbackMap[SjCtrl.httpRequestGenerate] = [success_callback, failure_callback, always_callback];
+    SjCtrl.http_request(SjCtrl.httpRequestGenerate, url);
   };
 
+  // data is already parsed. error_id is a QNetworkReply error or -1 when the response was not JSON.
   SjCtrl.httpRequestCallback = function(callback_id, error_id, data) {
     var callback = SjCtrl.httpRequestCallbackMap[callback_id];
+    if (!callback) {
+      return;
+    }
+    delete SjCtrl.httpRequestCallbackMap[callback_id];
+
     if (error_id === 0) {
-      callback[0](JSON.parse(data));
-    } else {
+      callback[0](data);
+    } else if (callback[1]) {
       callback[1](error_id);
     }
-    callback[2]();
+    if (callback[2]) {
+      callback[2]();
+    }
+  };
 
-    SjCtrl.httpRequestCallbackMap.removeAttribute(callback_id);
+  // callback(true) once no request of the job has been in flight for idle_ms, callback(false) if that didn't happen
+  // within timeout_ms
+  SjCtrl.waitForNetworkIdle = function(callback, idle_ms, timeout_ms) {
+    SjCtrl.networkIdleGenerate = SjCtrl.networkIdleGenerate + 1;
+    SjCtrl.networkIdleCallbackMap[SjCtrl.networkIdleGenerate] = callback;
+    SjCtrl.wait_for_network_idle(SjCtrl.networkIdleGenerate, idle_ms || 500, timeout_ms || 30000);
+  };
+
+  SjCtrl.networkIdleCallback = function(callback_id, idle) {
+    var callback = SjCtrl.networkIdleCallbackMap[callback_id];
+    if (!callback) {
+      return;
+    }
+    delete SjCtrl.networkIdleCallbackMap[callback_id];
+    callback(idle);
+  };
+
+  // callback(element) once an element matches selector, callback(null) if none did within timeout_ms.
+  // Pages only, the lane has no DOM.
+  SjCtrl.waitForSelector = function(selector, callback, timeout_ms) {
+    if (typeof document === 'undefined') {
+      SjCtrl.log_error('waitForSelector needs a page');
+      callback(null);
+      return;
+    }
+
+    var element = document.querySelector(selector), observer, timer, wait_id;
+    if (element) {
+      callback(element);
+      return;
+    }
+
+    // The page doesn't count the job as stalled while it waits here
+    timeout_ms = timeout_ms || 30000;
+    SjCtrl.selectorWaitGenerate = SjCtrl.selectorWaitGenerate + 1;
+    wait_id = SjCtrl.selectorWaitGenerate;
+    SjCtrl.selector_wait_started(wait_id, timeout_ms);
+    observer = new MutationObserver(function() {
+      var found = document.querySelector(selector);
+      if (found) {
+        observer.disconnect();
+        clearTimeout(timer);
+        SjCtrl.selector_wait_finished(wait_id);
+        callback(found);
+      }
+    });
+    observer.observe(document, {childList: true, attributes: true, subtree: true});
+    timer = setTimeout(function() {
+      observer.disconnect();
+      SjCtrl.selector_wait_finished(wait_id);
+      callback(null);
+    }, timeout_ms);
+  };
+
+  // What the schema extracts from the page, see dom_extract.py. null if the schema is not valid, which fails the job.
+  SjCtrl.extract = function(schema) {
+    return JSON.parse(SjCtrl.extract_json(JSON.stringify(schema)));
   };
 
   SjCtrl.remove_undefined = function(obj) {
@@ -86,6 +160,21 @@
     SjCtrl.post_request(url, JSON.stringify(SjCtrl.remove_undefined(obj)));
   };
 
+  // Loads a list of jobs at once, which is much cheaper than calling SjCtrl.load for each of them
+  SjCtrl.loadMany = function(jobs) {
+    SjCtrl.load_many(jobs);
+  };
+
+  // Loads a job that fans out one page of a long list, e.g. with job.meta_data.page of a paged api, and then loads
+  // the cursor for the next page. The coordinator only runs it once the queue has room for the jobs it loads.
+  SjCtrl.loadCursor = function(job) {
+    SjCtrl.load_cursor(job);
+  };
+
+  SjCtrl.setResult = function(obj) {
+    SjCtrl.set_result(SjCtrl.remove_undefined(obj));
+  };
+
   SjCtrl.relativeToAbsolute = function(href) {
     if (typeof href === 'string' && href.length !== 0) {
       var link = document.createElement("a");
@@ -96,5 +185,6 @@
     }
   };
 
-  SjCtrl.http_request_finished.connect(SjCtrl, 'httpRequestCallback');
+  SjCtrl.http_request_finished.connect(SjCtrl.httpRequestCallback);
+  SjCtrl.network_idle.connect(SjCtrl.networkIdleCallback);
 }).call(this);
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+from datetime import datetime
+
+from PyQt5.QtCore import QObject, pyqtSignal
+from croniter import croniter
+
+from job import Job
+from settings import CRON_MISFIRE_POLICY, CRON_MISFIRE_GRACE_SECONDS, CRON_MAX_CATCHUP_FIRES
+
+import logging
+logger = logging.getLogger(__name__)
+
+# What to do with fires that were missed, because the process was down or the timer fired late.
+# A fire is missed when it is more than CRON_MISFIRE_GRACE_SECONDS old by the time it is handled.
+MISFIRE_SKIP = 'skip'  # Drop missed fires. Only on time fires run.
+MISFIRE_FIRE_ONCE = 'fire_once'  # Run once for any number of missed fires.
+MISFIRE_FIRE_ALL = 'fire_all'  # Run every missed fire, up to CRON_MAX_CATCHUP_FIRES.
+
+
+class CronScheduler(QObject):
+    """Keeps the next fire of every scheduled job on a TimerHeap and advances each job's croniter one fire at a time"""
+    fired = pyqtSignal(Job)
+    # The fires after the first of a 'fire_all' catch up. They are identical jobs that must not be coalesced.
+    caught_up = pyqtSignal(Job)
+    once = 'once'
+    Entry = namedtuple('Entry', ['job', 'cron_iter', 'next_fire', 'handle'])
+
+    def __init__(self, timer_heap, job_store=None, parent=None, misfire_policy=CRON_MISFIRE_POLICY):
+        super().__init__(parent)
+        self.timer_heap = timer_heap
+        self.job_store = job_store
+        self.misfire_policy = misfire_policy
+        # job file -> Entry
+        self.entries = {}
+
+    def add_job(self, job):
+        self.remove_job(job.file)
+
+        if job.schedule == self.once:
+            self.timer_heap.call_later(0, lambda: self.fired.emit(job))
+            return
+
+        now = datetime.now()
+        try:
+            cron_iter = croniter(job.schedule, now)
+        except (ValueError, KeyError) as e:
+            logger.error('Invalid schedule {} for {}: {}'.format(job.schedule, job.file, e))
+            return
+
+        last_fire = self.job_store.get_cron_last_fire(job.file) if self.job_store else None
+        if last_fire:
+            catch_up_iter = croniter(job.schedule, datetime.fromtimestamp(last_fire))
+            missed = []
+            fire = catch_up_iter.get_next(datetime)
+            while fire <= now:
+                missed.append(fire)
+                fire = catch_up_iter.get_next(datetime)
+            if missed:
+                self.run_fires(job, missed, now)
+
+        self.schedule_next(job, cron_iter)
+
+    def remove_job(self, file):
+        entry = self.entries.pop(file, None)
+        if entry:
+            entry.handle.cancel()
+
+    def schedule_next(self, job, cron_iter):
+        next_fire = cron_iter.get_next(datetime)
+        handle = self.timer_heap.call_at(next_fire.timestamp(), lambda: self.on_timer(job.file))
+        self.entries[job.file] = self.Entry(job, cron_iter, next_fire, handle)
+
+    def on_timer(self, file):
+        entry = self.entries.get(file)
+        if not entry:
+            return
+
+        now = datetime.now()
+        fires = [entry.next_fire]
+        # The timer can be late, e.g. after a suspend. Collect every fire up to now.
+        next_fire = entry.cron_iter.get_next(datetime)
+        while next_fire <= now:
+            fires.append(next_fire)
+            next_fire = entry.cron_iter.get_next(datetime)
+
+        self.run_fires(entry.job, fires, now)
+        handle = self.timer_heap.call_at(next_fire.timestamp(), lambda: self.on_timer(file))
+        self.entries[file] = self.Entry(entry.job, entry.cron_iter, next_fire, handle)
+
+    def run_fires(self, job, fires, now):
+        on_time = [f for f in fires if (now - f).total_seconds() <= CRON_MISFIRE_GRACE_SECONDS]
+        missed = len(fires) - len(on_time)
+
+        if self.misfire_policy == MISFIRE_FIRE_ALL:
+            count = min(len(fires), CRON_MAX_CATCHUP_FIRES)
+        elif self.misfire_policy == MISFIRE_FIRE_ONCE:
+            count = 1
+        else:
+            count = 1 if on_time else 0
+
+        if missed:
+            logger.warning('{} missed {} fires of {}. Policy {} runs it {} times'.format(job.file, missed, job.schedule,
+                                                                                      self.misfire_policy, count))
+        for fire in range(count):
+            if fire:
+                self.caught_up.emit(job)
+            else:
+                self.fired.emit(job)
+
+        if self.job_store:
+            self.job_store.set_cron_last_fire(job.file, fires[-1].timestamp())
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""SjCtrl.extract. Takes what a job wants out of a page as a schema and reads it with QWebElement in one pass, so
+extraction doesn't cross the JS bridge for every element and comes back as python objects.
+
+A field of the schema is either a CSS selector, whose first match gives its text, or an object with:
+    selector  CSS selector that finds the field within the element of its parent. Without one the field is that
+              element itself. The selector of the schema itself is searched in the whole document.
+    list      true for a list with a value for every match instead of the value of the first match
+    fields    {name: field} for an object of these fields of the match, instead of a text or an attribute
+    attr      name of the attribute of the match to take instead of its text
+    text      'shown' for the text the match shows, like innerText, which is the default. 'content' for its
+              textContent, like jQuery's .text(), with hidden text and whitespace as they are in the page.
+    url       true to make the value an absolute url, like SjCtrl.relativeToAbsolute
+    type      'int' or 'float' to parse the value like parseInt and parseFloat
+    value     a constant, for fields that are the same for every match
+    default   the value of a field that has none, e.g. '' or null. Not for lists.
+
+A field without a match, without its attribute or whose value is not a number has no value. Objects leave out the
+fields without a value, like SjCtrl.post_obj leaves out undefined, unless they have a default. A default of null keeps
+the field as null. Lists leave out the matches without a value or with an empty one.
+
+    SjCtrl.extract({selector: '.feed-item', list: true, fields: {
+        id: {attr: 'data-li-update-id'},
+        title: '.share-title .title',
+        urls: {selector: '.share-body a', attr: 'href', url: true, list: true}
+    }});
+"""
+from collections import namedtuple
+import re
+
+from PyQt5.QtCore import QUrl
+
+FIELD_KEYS = ('selector', 'list', 'fields', 'attr', 'text', 'url', 'type', 'value', 'default')
+TEXT_SHOWN = 'shown'
+TEXT_CONTENT = 'content'
+# The default of a field without one. None can't be it, it is the default null.
+NO_DEFAULT = object()
+NUMBER_PATTERNS = {
+    'int': re.compile(r'\s*([-+]?\d+)'),
+    'float': re.compile(r'\s*([-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?)'),
+}
+NUMBER_TYPES = {'int': int, 'float': float}
+
+
+class Field(namedtuple('Field', FIELD_KEYS)):
+    """A field of a schema checked once, before the page is read"""
+
+    @staticmethod
+    def compile(field, path='schema'):
+        """Raises ValueError when field is not a valid schema"""
+        if isinstance(field, str):
+            field = {'selector': field}
+        if not isinstance(field, dict):
+            raise ValueError('{} must be a selector or an object'.format(path))
+
+        unknown = set(field) - set(FIELD_KEYS)
+        if unknown:
+            raise ValueError('Unknown keys in {}: {}'.format(path, ', '.join(sorted(unknown))))
+        if field.get('selector') is not None and not isinstance(field['selector'], str):
+            raise ValueError('The selector of {} must be a string'.format(path))
+        if field.get('attr') is not None and not isinstance(field['attr'], str):
+            raise ValueError('The attr of {} must be a string'.format(path))
+        if field.get('text') not in (None, TEXT_SHOWN, TEXT_CONTENT):
+            raise ValueError('Unknown text {} in {}'.format(field['text'], path))
+        if field.get('type') not in (None,) + tuple(NUMBER_TYPES):
+            raise ValueError('Unknown type {} in {}'.format(field['type'], path))
+        if 'default' in field and field.get('list'):
+            raise ValueError('{} is a list and can\'t have a default'.format(path))
+
+        fields = field.get('fields')
+        if fields is not None:
+            if not isinstance(fields, dict):
+                raise ValueError('The fields of {} must be an object'.format(path))
+            for name in fields:
+                if not isinstance(name, str):
+                    raise ValueError('The field names of {} must be strings, not {!r}'.format(path, name))
+            fields = tuple((name, Field.compile(sub_field, '{}.{}'.format(path, name)))
+                           for name, sub_field in fields.items())
+        return Field(field.get('selector') or None, bool(field.get('list')), fields, field.get('attr') or None,
+                     field.get('text') or TEXT_SHOWN, bool(field.get('url')), field.get('type'), field.get('value'),
+                     field.get('default', NO_DEFAULT))
+
+
+def extract_dom(element, schema, base_url):
+    """The value of schema for element, a QWebElement. Urls are made absolute with base_url, a QUrl. Raises
+    ValueError when schema is not valid."""
+    return extract_field(element, Field.compile(schema), base_url)
+
+
+def extract_field(element, field, base_url):
+    if field.value is not None:
+        return field.value
+
+    if field.list:
+        matches = element.findAll(field.selector).toList() if field.selector else [element]
+        values = (extract_match(match, field, base_url) for match in matches)
+        return [value for value in values if value is not None and value != '']
+
+    match = element.findFirst(field.selector) if field.selector else element
+    value = None if match.isNull() else extract_match(match, field, base_url)
+    if value is None and field.default is not NO_DEFAULT:
+        return field.default
+    return value
+
+
+def extract_match(element, field, base_url):
+    if field.fields is not None:
+        values = ((name, sub_field, extract_field(element, sub_field, base_url)) for name, sub_field in field.fields)
+        return {name: value for name, sub_field, value in values if value is not None or sub_field.default is None}
+
+    if field.attr:
+        if not element.hasAttribute(field.attr):
+            return None
+        value = element.attribute(field.attr)
+    elif field.text == TEXT_CONTENT:
+        # QWebElement has no textContent of its own
+        value = element.evaluateJavaScript('this.textContent') or ''
+    else:
+        value = element.toPlainText()
+
+    if field.url and value:
+        value = base_url.resolved(QUrl(value)).toString()
+    if field.type:
+        number = NUMBER_PATTERNS[field.type].match(value)
+        value = NUMBER_TYPES[field.type](number.group(1)) if number else None
+    return value
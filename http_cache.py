@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from PyQt5.QtCore import QDateTime
+from PyQt5.QtNetwork import QAbstractNetworkCache, QNetworkDiskCache
+
+from settings import HTTP_CACHE_DIRECTORY, HTTP_CACHE_MAX_BYTES, HTTP_CACHE_FORCED_TTL_SECONDS
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SharedCache(QAbstractNetworkCache):
+    """Per AccessManager front for the one QNetworkDiskCache shared by every page of the process.
+
+    A QNetworkAccessManager takes ownership of its cache, so the disk cache itself can't be handed to every page.
+    Each page gets one of these instead and they all delegate to the same disk cache, which evicts the least
+    recently used entries once HTTP_CACHE_MAX_BYTES is reached. Freshness, ETag and Last-Modified revalidation are
+    handled by Qt from the response headers. Responses from hosts the job asked to force cache are stored even when
+    the headers say otherwise and kept for HTTP_CACHE_FORCED_TTL_SECONDS.
+    """
+    directory = HTTP_CACHE_DIRECTORY
+    disk_cache = None
+    # Shared by all the pages of the process
+    lookups = 0
+    hits = 0
+    bytes_saved = 0
+
+    @staticmethod
+    def configure(directory):
+        """Must be called before the first page is created. Processes must not share a directory."""
+        SharedCache.directory = directory
+
+    @staticmethod
+    def get_disk_cache():
+        if SharedCache.disk_cache is None:
+            SharedCache.disk_cache = QNetworkDiskCache()
+            SharedCache.disk_cache.setCacheDirectory(SharedCache.directory)
+            SharedCache.disk_cache.setMaximumCacheSize(HTTP_CACHE_MAX_BYTES)
+            logger.info('Http cache at {} using {} bytes'.format(SharedCache.directory, SharedCache.disk_cache.cacheSize()))
+        return SharedCache.disk_cache
+
+    @staticmethod
+    def stats():
+        lookups = SharedCache.lookups
+        return {'lookups': lookups,
+                'hits': SharedCache.hits,
+                'hit_ratio': SharedCache.hits / lookups if lookups else 0.0,
+                'bytes_saved': SharedCache.bytes_saved,
+                'size': SharedCache.disk_cache.cacheSize() if SharedCache.disk_cache else 0}
+
+    def __init__(self, access_manager):
+        super().__init__(access_manager)
+        self.access_manager = access_manager
+        self.disk = self.get_disk_cache()
+
+    def metaData(self, url):
+        SharedCache.lookups += 1
+        return self.disk.metaData(url)
+
+    def data(self, url):
+        device = self.disk.data(url)
+        if device is not None:
+            SharedCache.hits += 1
+            SharedCache.bytes_saved += device.size()
+        return device
+
+    def updateMetaData(self, meta_data):
+        self.disk.updateMetaData(meta_data)
+
+    def prepare(self, meta_data):
+        if self.access_manager.is_force_cached(meta_data.url()):
+            meta_data.setSaveToDisk(True)
+            expiration = meta_data.expirationDate()
+            if not expiration.isValid() or expiration < QDateTime.currentDateTime():
+                meta_data.setExpirationDate(QDateTime.currentDateTime().addSecs(HTTP_CACHE_FORCED_TTL_SECONDS))
+        return self.disk.prepare(meta_data)
+
+    def insert(self, device):
+        self.disk.insert(device)
+
+    def remove(self, url):
+        return self.disk.remove(url)
+
+    def cacheSize(self):
+        return self.disk.cacheSize()
+
+    def clear(self):
+        self.disk.clear()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+
+from PyQt5.QtCore import QObject, QTimer, QUrl, pyqtSignal, pyqtSlot
+from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkReply, QNetworkRequest
+
+from result_cache import ResultCache
+from settings import HTTP_CLIENT_MAX_PER_HOST, HTTP_CLIENT_TIMEOUT_SECONDS, HTTP_CLIENT_DECODE_THREADS, \
+    HTTP_CLIENT_CACHE_TTL_SECONDS, HTTP_CLIENT_CACHE_MAX_BYTES
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Error code passed to the callback when the body is not JSON. The others are QNetworkReply errors.
+INVALID_JSON = -1
+
+
+class PendingRequest(object):
+    def __init__(self, url, callback, archive=None):
+        self.url = url
+        self.callback = callback
+        self.archive = archive
+        self.timed_out = False
+
+
+class HttpClient(QObject):
+    """The http client of the job scripts, shared by all the pages of the process.
+
+    One QNetworkAccessManager keeps the connections alive between requests and handles gzip. Requests beyond
+    HTTP_CLIENT_MAX_PER_HOST for a host wait their turn, and replies taking longer than HTTP_CLIENT_TIMEOUT_SECONDS
+    are aborted. Bodies are decoded on HTTP_CLIENT_DECODE_THREADS threads and the parsed object is handed to the
+    callback on the Qt thread. With HTTP_CLIENT_CACHE_TTL_SECONDS set, bodies are cached by url for that long.
+    """
+    # (request, error, data) from the decoding threads
+    decoded = pyqtSignal(object)
+    instance = None
+
+    @staticmethod
+    def get():
+        if HttpClient.instance is None:
+            HttpClient.instance = HttpClient()
+        return HttpClient.instance
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.network_manager = QNetworkAccessManager(self)
+        self.executor = ThreadPoolExecutor(HTTP_CLIENT_DECODE_THREADS)
+        self.cache = ResultCache(HTTP_CLIENT_CACHE_TTL_SECONDS, HTTP_CLIENT_CACHE_MAX_BYTES) \
+            if HTTP_CLIENT_CACHE_TTL_SECONDS else None
+        # host -> requests in flight
+        self.running = Counter()
+        # host -> PendingRequests waiting for a free slot
+        self.waiting = {}
+        # Replies in flight. Nothing else holds their wrappers, and the garbage collector deleting one drops the reply
+        # without it ever finishing.
+        self.replies = set()
+        self.decoded.connect(self.deliver)
+
+    def get_json(self, url, callback, archive=None):
+        """Calls callback(error, data) on the Qt thread. error is 0 when data holds the parsed body. The request is
+        recorded to or replayed from archive, the NetArchive of the job, when there is one."""
+        if self.cache and not archive:
+            body = self.cache.get(url)
+            if body is not None:
+                self.executor.submit(self.decode, PendingRequest(QUrl(url), callback), body)
+                return
+
+        pending = PendingRequest(QUrl(url), callback, archive)
+        host = pending.url.host()
+        if self.running[host] >= HTTP_CLIENT_MAX_PER_HOST:
+            self.waiting.setdefault(host, deque()).append(pending)
+            return
+        self.send(pending)
+
+    def send(self, pending):
+        self.running[pending.url.host()] += 1
+        request = QNetworkRequest(pending.url)
+        request.setRawHeader(b'Accept', b'application/json')
+        if pending.archive and pending.archive.replaying:
+            reply = pending.archive.replay(QNetworkAccessManager.GetOperation, request, self)
+        else:
+            reply = self.network_manager.get(request)
+            if pending.archive:
+                reply = pending.archive.record(QNetworkAccessManager.GetOperation, request, None, reply)
+        self.replies.add(reply)
+
+        timer = QTimer(reply)
+        timer.setSingleShot(True)
+        timer.timeout.connect(lambda: self.timeout(pending, reply))
+        timer.start(HTTP_CLIENT_TIMEOUT_SECONDS * 1000)
+        reply.finished.connect(lambda: self.finished(pending, reply, timer))
+
+    def timeout(self, pending, reply):
+        logger.warning('Timed out after {}sec: {}'.format(HTTP_CLIENT_TIMEOUT_SECONDS, pending.url.toString()))
+        pending.timed_out = True
+        reply.abort()
+
+    def finished(self, pending, reply, timer):
+        timer.stop()
+        self.replies.discard(reply)
+        host = pending.url.host()
+        self.running[host] -= 1
+        if not self.running[host]:
+            del self.running[host]
+        waiting = self.waiting.get(host)
+        if waiting:
+            self.send(waiting.popleft())
+            if not waiting:
+                del self.waiting[host]
+
+        error = reply.error()
+        if error == QNetworkReply.NoError:
+            body = reply.readAll().data()
+            if self.cache:
+                self.cache.put(pending.url.toString(), body)
+            self.executor.submit(self.decode, pending, body)
+        else:
+            if pending.timed_out:
+                error = QNetworkReply.TimeoutError
+            logger.error('e_id="{};{}" url="{}"'.format(error, reply.errorString(), pending.url.toString()))
+            pending.callback(error, None)
+        reply.deleteLater()
+
+    def decode(self, pending, body):
+        # Runs on a decoding thread
+        try:
+            self.decoded.emit((pending, 0, json.loads(body.decode('utf-8'))))
+        except ValueError as e:
+            logger.error('Invalid JSON from {}: {}'.format(pending.url.toString(), e))
+            self.decoded.emit((pending, INVALID_JSON, None))
+
+    @pyqtSlot(object)
+    def deliver(self, decoded):
+        pending, error, data = decoded
+        pending.callback(error, data)
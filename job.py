@@ -1,4 +1,14 @@
 from collections import namedtuple
+import json
+import os
+from job_scheduler import PRIORITY_FANOUT, PRIORITY_INTERACTIVE, PRIORITY_RETRY
+from settings import BASE_PROJECT_DIR
+
+# How a job runs. Page jobs load their url in a WebKit page. Fetch and script jobs run on the JobLane without one.
+MODE_PAGE = 'page'
+MODE_FETCH = 'fetch'
+MODE_SCRIPT = 'script'
+JOB_MODES = (MODE_PAGE, MODE_FETCH, MODE_SCRIPT)
 
 
 class Job(namedtuple('Job', ['file',
@@ -13,7 +23,14 @@ class Job(namedtuple('Job', ['file',
                              'is_crawlera',
                              'meta_data',
                              'retry',
-                             'timeout'])):
+                             'timeout',
+                             'priority',
+                             'request_id',
+                             'cache_hosts',
+                             'block_profile',
+                             'mode',
+                             'stall_timeout',
+                             'cursor'])):
     def __new__(cls, **args):
         if not args:
             raise Exception('Empty job request')
@@ -24,12 +41,51 @@ class Job(namedtuple('Job', ['file',
     def new_state(self, **args):
         args['file'] = self.file
         args['schedule'] = self.schedule
+        args.setdefault('priority', PRIORITY_FANOUT)
+        # Only the job the client submitted answers the client
+        args.pop('request_id', None)
         return Job(**args)
 
     def get_retry_job(self):
         d = self.dict()
         d['retry'] += 1
+        d['priority'] = PRIORITY_RETRY
         return Job(**d)
 
+    def key(self):
+        """Jobs with the same key do the same work"""
+        meta_data = json.dumps(self.meta_data, sort_keys=True, default=str) if self.meta_data else None
+        return self.file, self.state, self.url, meta_data, bool(self.request_id)
+
     def dict(self):
-        return {x: getattr(self, x) for x in Job._fields}
\ No newline at end of file
+        return {x: getattr(self, x) for x in Job._fields}
+
+    @staticmethod
+    def from_request(data):
+        """Builds a job submitted from outside. Raises ValueError when the request is not a valid job."""
+        if not isinstance(data, dict) or not data:
+            raise ValueError('A job must be a non empty object')
+
+        unknown = set(data) - set(Job._fields)
+        if unknown:
+            raise ValueError('Unknown job fields: {}'.format(', '.join(sorted(unknown))))
+
+        if not data.get('file'):
+            raise ValueError('No job file specified')
+
+        if data.get('mode') not in (None,) + JOB_MODES:
+            raise ValueError('Unknown job mode {}'.format(data['mode']))
+
+        if data.get('request_id') is not None:
+            raise ValueError('request_id is assigned by the server')
+
+        # Submitted jobs can only run the scripts in the jobs directory
+        jobs_directory = os.path.join(BASE_PROJECT_DIR, 'jobs')
+        file = os.path.abspath(os.path.join(jobs_directory, data['file']))
+        if os.path.dirname(file) != jobs_directory or not os.path.isfile(file):
+            raise ValueError('Unknown job file {}'.format(data['file']))
+
+        args = dict(data)
+        args['file'] = file
+        args.setdefault('priority', PRIORITY_INTERACTIVE)
+        return Job(**args)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from time import monotonic
+
+from PyQt5.QtCore import QObject, QTimer, Qt, pyqtSignal
+
+from settings import JOB_STALL_CHECK_MILLISECONDS, JOB_STALL_IN_FLIGHT_SECONDS
+
+
+class JobActivity(QObject):
+    """Tells a job that is still getting somewhere from one that stalled.
+
+    Progress is a request of the job starting, receiving data or finishing, a DOM mutation, or the script calling
+    SjCtrl. With a stall_seconds, stalled is emitted once nothing progressed for that long, or for
+    JOB_STALL_IN_FLIGHT_SECONDS if that is longer and a request is in flight. A job waiting in SjCtrl.waitForNetworkIdle
+    or SjCtrl.waitForSelector is waiting rather than stalled, the waits' own timeouts bound those. It also answers
+    SjCtrl.waitForNetworkIdle, which waits until no request has been in flight for a while.
+    """
+    # Seconds since the last progress
+    stalled = pyqtSignal(float)
+
+    def __init__(self, parent, dom_mutations=None):
+        super().__init__(parent)
+        # Returns a count of DOM mutations that grows as the page changes, or None before it can tell
+        self.dom_mutations = dom_mutations
+        self.stall_seconds = None
+        self.in_flight = 0
+        self.last_progress = 0
+        # When in_flight last changed. DOM progress doesn't make the network busy.
+        self.network_changed_at = 0
+        self.last_mutations = None
+        # [idle seconds, deadline, callback(idle)] of the waitForNetworkIdle calls not answered yet
+        self.idle_waiters = []
+        # wait id -> deadline of the SjCtrl.waitForSelector calls not answered yet
+        self.selector_waits = {}
+
+        self.watchdog = QTimer(self)
+        self.watchdog.setTimerType(Qt.CoarseTimer)
+        self.watchdog.setInterval(JOB_STALL_CHECK_MILLISECONDS)
+        self.watchdog.timeout.connect(self.check)
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.timeout.connect(self.answer_waiters)
+
+    def start(self, stall_seconds=None):
+        self.stall_seconds = stall_seconds
+        self.in_flight = 0
+        self.last_progress = self.network_changed_at = monotonic()
+        self.last_mutations = None
+        self.selector_waits = {}
+        if stall_seconds:
+            self.watchdog.start()
+
+    def stop(self):
+        """The job is over. Its waiters are dropped without an answer."""
+        self.watchdog.stop()
+        self.idle_timer.stop()
+        self.idle_waiters = []
+        self.selector_waits = {}
+        self.in_flight = 0
+
+    def progress(self):
+        self.last_progress = monotonic()
+
+    def request_started(self):
+        self.in_flight += 1
+        self.last_progress = self.network_changed_at = monotonic()
+        if self.idle_waiters:
+            self.schedule()
+
+    def request_finished(self):
+        self.in_flight = max(0, self.in_flight - 1)
+        self.last_progress = self.network_changed_at = monotonic()
+        if self.idle_waiters:
+            self.schedule()
+
+    def selector_wait_started(self, wait_id, timeout_seconds):
+        self.selector_waits[wait_id] = monotonic() + timeout_seconds
+
+    def selector_wait_finished(self, wait_id):
+        self.selector_waits.pop(wait_id, None)
+        self.progress()
+
+    def wait_for_idle(self, idle_seconds, timeout_seconds, callback):
+        self.idle_waiters.append([idle_seconds, monotonic() + timeout_seconds, callback])
+        self.schedule()
+
+    def schedule(self):
+        """Wakes up when the next waiter is due, either because the network went idle or because it timed out"""
+        due = min(deadline if self.in_flight else min(deadline, self.network_changed_at + idle_seconds)
+                  for idle_seconds, deadline, _ in self.idle_waiters)
+        self.idle_timer.start(max(0, int((due - monotonic()) * 1000)))
+
+    def answer_waiters(self):
+        now = monotonic()
+        waiting = []
+        answered = []
+        for waiter in self.idle_waiters:
+            idle_seconds, deadline, callback = waiter
+            if not self.in_flight and now >= self.network_changed_at + idle_seconds:
+                answered.append((callback, True))
+            elif now >= deadline:
+                answered.append((callback, False))
+            else:
+                waiting.append(waiter)
+        self.idle_waiters = waiting
+        if waiting:
+            self.schedule()
+        # Last, the callbacks may wait again or end the job
+        for callback, idle in answered:
+            callback(idle)
+
+    def check(self):
+        now = monotonic()
+        if self.dom_mutations:
+            mutations = self.dom_mutations()
+            if mutations != self.last_mutations:
+                self.last_mutations = mutations
+                self.last_progress = now
+        # The stall window starts over once the job stops waiting. A wait whose page went away never finishes, its
+        # deadline still ends it.
+        if self.idle_waiters or any(deadline > now for deadline in self.selector_waits.values()):
+            self.last_progress = now
+        # A request that receives data makes progress, one that hangs doesn't. Qt has no transfer timeout of its own.
+        stall_seconds = max(self.stall_seconds, JOB_STALL_IN_FLIGHT_SECONDS) if self.in_flight else self.stall_seconds
+        if now - self.last_progress >= stall_seconds:
+            self.watchdog.stop()
+            self.stalled.emit(now - self.last_progress)
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from importlib.machinery import SourceFileLoader
+import json
+import os
+import types
+from time import monotonic
+
+from PyQt5.QtCore import QObject, QTimer, QUrl, QVariant, Qt, pyqtSignal, pyqtSlot
+from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkProxy, QNetworkReply, QNetworkRequest
+from PyQt5.QtQml import QJSEngine, QJSValue
+
+from metrics import HOST_BYTES, PROXY_BYTES
+from job import Job, MODE_FETCH, MODE_SCRIPT
+from job_activity import JobActivity
+from net_archive import open_archive
+from proxy_pool import ProxyPool, parse_proxy
+from rate_limiter import RateLimiter, proxy_key
+from retry_policy import classify_reply, is_proxy_failure, CAUSE_INVALID_URL, CAUSE_PROXY, CAUSE_SCRIPT, \
+    CAUSE_TIMEOUT, THROTTLE_STATUSES
+from tracing import start_trace
+from webpage_custom import JSControllerObject, WebPageCustom
+from settings import DEFAULT_JOB_TIMEOUT_SECONDS, HTTP_HEADER_CHARSET, LANE_MAX_JOBS, LANE_HOOK_THREADS, \
+    LANE_MAX_REDIRECTS
+
+import logging
+logger = logging.getLogger(__name__)
+
+LANE_MODES = (MODE_FETCH, MODE_SCRIPT)
+
+# Evaluated before controller.js in the script engine, which has no window and no console of its own
+SCRIPT_PRELUDE = """
+var window = this;
+var console = {
+  log: function(message) { SjCtrl.log_message(message); },
+  info: function(message) { SjCtrl.log_message(message); },
+  warn: function(message) { SjCtrl.log_message(message); },
+  error: function(message) { SjCtrl.log_error(message); }
+};
+"""
+
+
+class FetchResponse(namedtuple('FetchResponse', ['url', 'status', 'headers', 'body'])):
+    """What a fetch hook is given. headers has lower case names and body is bytes."""
+
+    def text(self):
+        charset = 'utf-8'
+        for param in self.headers.get('content-type', '').split(';')[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'charset' and value.strip():
+                charset = value.strip().strip('"')
+        try:
+            return self.body.decode(charset, errors='replace')
+        except LookupError:
+            return self.body.decode('utf-8', errors='replace')
+
+
+class FetchContext(object):
+    """The SjCtrl of a fetch hook. It only records what the hook asks for, which is done on the Qt thread once the
+    hook returns. A hook that raises fails the job."""
+
+    def __init__(self, job):
+        self.job = job
+        self.new_jobs = []
+        self.posts = []
+        self.result = None
+        # Set by the lane around the call of the hook
+        self.started_at = 0
+        self.finished_at = 0
+
+    def load(self, job_dict):
+        self.new_jobs.append(self.job.new_state(**job_dict))
+
+    def load_many(self, job_dicts):
+        self.new_jobs.extend(self.job.new_state(**job_dict) for job_dict in job_dicts)
+
+    def load_cursor(self, job_dict):
+        self.load(dict(job_dict, cursor=True))
+
+    def post_obj(self, url, obj):
+        self.posts.append((url, json.dumps(obj, default=str)))
+
+    def set_result(self, result):
+        self.result = result
+
+
+@lru_cache(maxsize=64)
+def load_hook_module(path, mtime):
+    # Keyed by mtime so that an edited hook file is loaded again
+    loader = SourceFileLoader('sj_hook_{}'.format(os.path.splitext(os.path.basename(path))[0]), path)
+    module = types.ModuleType(loader.name)
+    module.__file__ = path
+    loader.exec_module(module)
+    return module
+
+
+def find_hook(job):
+    """The function named after the state of the job in the python file next to its script, e.g. main() in
+    jobs/linkedin.py for the main state of jobs/linkedin.js. It is called with a FetchContext and a FetchResponse."""
+    path = os.path.splitext(job.file)[0] + '.py'
+    try:
+        module = load_hook_module(path, os.stat(path).st_mtime)
+    except OSError:
+        return None
+    return getattr(module, job.state or 'main', None)
+
+
+class LaneRun(QObject):
+    """One job on the lane. It stands in for the page that a JSControllerObject expects as its parent."""
+    job_finished = pyqtSignal()
+    new_job_received = pyqtSignal(Job)
+    new_jobs_received = pyqtSignal(list)
+    job_failed = pyqtSignal(Job, str, int)
+    render_finished = pyqtSignal(int, bool, str)
+    controller_class = JSControllerObject
+    id_gen = 0
+
+    def __init__(self, lane, entry):
+        super().__init__(lane)
+        LaneRun.id_gen += 1
+        self.id = 'lane-{}'.format(LaneRun.id_gen)
+        self.lane = lane
+        self.entry = entry
+        self.current_job = entry.job
+        self.job_result = None
+        self.jobs_done = 0
+        self.job_started_at = monotonic()
+        self.trace = start_trace(entry.job, self.id, self.job_started_at - entry.queued_at)
+        self.net_archive = open_archive(entry.job)
+        self.control = self.controller_class(self)
+        # Lane jobs hold no page, the job timeout is enough for them
+        self.activity = JobActivity(self)
+        self.activity.start()
+
+        self.timeout_timer = QTimer(self)
+        self.timeout_timer.setTimerType(Qt.VeryCoarseTimer)
+        self.timeout_timer.setSingleShot(True)
+        self.timeout_timer.timeout.connect(self.timeout)
+        self.timeout_timer.start((self.current_job.timeout or DEFAULT_JOB_TIMEOUT_SECONDS) * 1000)
+
+    def timeout(self):
+        logger.error(self.control.prepend_id('Job timed out in {}sec - {}'.format(
+            self.current_job.timeout or DEFAULT_JOB_TIMEOUT_SECONDS, self.current_job)))
+        self.control.abort(cause=CAUSE_TIMEOUT)
+
+    def finish_render(self, ok, error=None):
+        if not self.current_job or not self.current_job.request_id:
+            return
+
+        payload = self.render_payload() if ok else {'error': error}
+        self.render_finished.emit(self.current_job.request_id, ok, json.dumps(payload, default=str))
+
+    def render_payload(self):
+        return {'result': self.job_result}
+
+    def reset(self):
+        if self.current_job:
+            self.jobs_done += 1
+        self.current_job = None
+        self.timeout_timer.stop()
+        self.activity.stop()
+
+
+class FetchRun(LaneRun):
+    """Gets the url of the job over plain http and hands the response to the fetch hook of the job. Cookies are
+    neither sent nor kept. Crawlera needs the request rewriting of the pages, here its proxy is a plain http proxy."""
+
+    def __init__(self, lane, entry):
+        super().__init__(lane, entry)
+        self.reply = None
+        self.response = None
+        self.redirects = 0
+        self.pool_proxy = None
+        self.proxy = None
+
+    def start(self):
+        url = QUrl(self.current_job.url)
+        if not self.current_job.url or not url.isValid():
+            logger.error(self.control.prepend_id('Invalid URL {}'.format(self.current_job.url)))
+            self.control.abort(cause=CAUSE_INVALID_URL)
+            return
+
+        if self.net_archive and self.net_archive.replaying:
+            # Nothing is sent, so no proxy is needed
+            self.get(url)
+            return
+
+        if self.current_job.proxy == ProxyPool.name:
+            self.pool_proxy = ProxyPool.get().acquire()
+            if self.pool_proxy:
+                self.proxy = self.pool_proxy.network_proxy
+        elif self.current_job.proxy:
+            try:
+                self.proxy = parse_proxy(self.current_job.proxy, self.current_job.proxy_auth or None)
+            except ValueError:
+                logger.error(self.control.prepend_id('Invalid proxy string {}, auth {}'.format(
+                    self.current_job.proxy, self.current_job.proxy_auth)))
+                self.control.abort(cause=CAUSE_PROXY)
+                return
+        self.get(url)
+
+    def get(self, url):
+        request = QNetworkRequest(url)
+        request.setRawHeader(b'User-Agent', WebPageCustom.user_agent.encode(HTTP_HEADER_CHARSET))
+        request.setAttribute(QNetworkRequest.CookieLoadControlAttribute, QNetworkRequest.Manual)
+        request.setAttribute(QNetworkRequest.CookieSaveControlAttribute, QNetworkRequest.Manual)
+        request.setAttribute(QNetworkRequest.CacheLoadControlAttribute, QNetworkRequest.AlwaysNetwork)
+        if self.proxy:
+            RateLimiter.get().take(proxy_key('{}:{}'.format(self.proxy.hostName(), self.proxy.port())))
+        if self.pool_proxy:
+            self.pool_proxy.in_flight += 1
+
+        started = monotonic()
+        if self.net_archive and self.net_archive.replaying:
+            self.reply = self.net_archive.replay(QNetworkAccessManager.GetOperation, request, self)
+        else:
+            self.reply = self.lane.network_manager(self.proxy).get(request)
+            if self.net_archive:
+                self.reply = self.net_archive.record(QNetworkAccessManager.GetOperation, request, None, self.reply)
+        self.reply.finished.connect(lambda reply=self.reply, started=started: self.finished(reply, started))
+
+    def finished(self, reply, started):
+        reply.deleteLater()
+        if self.pool_proxy:
+            self.pool_proxy.in_flight -= 1
+        if not self.current_job:
+            # Timed out or cancelled
+            return
+
+        self.reply = None
+        error = reply.error()
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if self.trace:
+            url_str = reply.url().toString()
+            self.trace.async_span(url_str[:100], started, url=url_str, error=int(error), status=status,
+                                  size=reply.bytesAvailable())
+        if self.pool_proxy:
+            self.pool_proxy.request_finished(monotonic() - started, not is_proxy_failure(error, status))
+
+        headers = {}
+        for header in reply.rawHeaderList():
+            headers[header.data().decode(HTTP_HEADER_CHARSET).lower()] = \
+                reply.rawHeader(header).data().decode(HTTP_HEADER_CHARSET)
+
+        if error != QNetworkReply.NoError:
+            retry_after = None
+            if headers.get('retry-after', '').strip().isdigit():
+                retry_after = int(headers['retry-after'].strip())
+            logger.error(self.control.prepend_id('e_id="{};{}" status={} url="{}"'.format(
+                error, reply.errorString(), status, reply.url().toString())))
+            if status in THROTTLE_STATUSES or retry_after is not None:
+                RateLimiter.get().throttle(reply.url().host(), retry_after or 0)
+            self.control.abort(retry_after or 0, classify_reply(error, status, retry_after))
+            return
+
+        redirect = reply.attribute(QNetworkRequest.RedirectionTargetAttribute)
+        if redirect is not None:
+            if self.redirects >= LANE_MAX_REDIRECTS:
+                logger.error(self.control.prepend_id('Too many redirects from {}'.format(self.current_job.url)))
+                self.control.abort(cause=classify_reply(error, status))
+                return
+            self.redirects += 1
+            self.get(reply.url().resolved(redirect))
+            return
+
+        try:
+            hook = find_hook(self.current_job)
+        except Exception as e:
+            logger.exception(self.control.prepend_id('Could not load the fetch hook of {}'.format(self.current_job.file)))
+            self.control.script_error('{}: {}'.format(type(e).__name__, e))
+            return
+        if hook is None:
+            self.control.script_error('No fetch hook {}() next to {}'.format(
+                self.current_job.state or 'main', self.current_job.file))
+            return
+
+        body = reply.readAll().data()
+        HOST_BYTES.labels(reply.url().host()).inc(len(body))
+        if self.proxy:
+            PROXY_BYTES.labels('{}:{}'.format(self.proxy.hostName(), self.proxy.port())).inc(len(body))
+        self.response = FetchResponse(reply.url().toString(), status, headers, body)
+        self.lane.executor.submit(self.lane.run_hook, self, hook, FetchContext(self.current_job), self.response)
+
+    def hook_finished(self, context, error):
+        if not self.current_job:
+            return
+        if self.trace:
+            self.trace.span('hook', context.started_at, context.finished_at, error=error)
+        if error:
+            self.control.script_error(error)
+            return
+
+        if context.new_jobs:
+            self.new_jobs_received.emit(context.new_jobs)
+        for url, body in context.posts:
+            self.control.post_request(url, body)
+        self.job_result = context.result
+        self.control.done()
+
+    def render_payload(self):
+        return {'result': self.job_result, 'html': self.response.text() if self.response else None}
+
+    def reset(self):
+        super().reset()
+        if self.reply:
+            reply, self.reply = self.reply, None
+            reply.abort()
+        if self.pool_proxy:
+            ProxyPool.get().release(self.pool_proxy)
+            self.pool_proxy = None
+
+
+class ScriptController(JSControllerObject):
+    """The script engine hands JS objects to slots as QJSValue where WebKit hands them as python objects"""
+
+    @staticmethod
+    def to_python(value):
+        return value.toVariant() if isinstance(value, QJSValue) else value
+
+    @pyqtSlot(QVariant)
+    def log_message(self, message):
+        super().log_message(self.to_python(message))
+
+    @pyqtSlot(QVariant)
+    def log_error(self, message):
+        super().log_error(self.to_python(message))
+
+    @pyqtSlot(QVariant)
+    def set_result(self, result):
+        super().set_result(self.to_python(result))
+
+    @pyqtSlot(QVariant)
+    def load(self, job_dict):
+        super().load(self.to_python(job_dict))
+
+    @pyqtSlot(QVariant)
+    def load_many(self, job_dicts):
+        super().load_many(self.to_python(job_dicts))
+
+    @pyqtSlot(QVariant)
+    def load_cursor(self, job_dict):
+        super().load_cursor(self.to_python(job_dict))
+
+    @pyqtSlot(str, result=str)
+    def extract_json(self, schema):
+        self.script_error('SjCtrl.extract needs the DOM of a page, which script jobs do not have')
+        return 'null'
+
+
+class ScriptRun(LaneRun):
+    """Runs the state callback of the job script in a bare JS engine. There is no page, so no DOM, no jQuery and
+    no timers, only SjCtrl. Meant for states that just call SjCtrl.getJson, SjCtrl.load and SjCtrl.post_obj."""
+    controller_class = ScriptController
+
+    def __init__(self, lane, entry):
+        super().__init__(lane, entry)
+        self.engine = QJSEngine(self)
+        self.engine.globalObject().setProperty('SjCtrl', self.engine.newQObject(self.control))
+
+    def start(self):
+        job_source = None
+        if self.lane.job_registry:
+            job_source = self.lane.job_registry.get_source(self.current_job.file)
+        else:
+            try:
+                with open(self.current_job.file, 'r') as job_file:
+                    job_source = job_file.read()
+            except OSError as e:
+                logger.error(self.control.prepend_id('Could not read the job file {}: {}'.format(self.current_job.file, e)))
+
+        if job_source is None:
+            logger.error(self.control.prepend_id('Could not load the job file {}'.format(self.current_job.file)))
+            self.control.abort(cause=CAUSE_SCRIPT)
+            return
+
+        started = monotonic()
+        sources = ((SCRIPT_PRELUDE, 'prelude'),
+                   (WebPageCustom.get_controller_string(), WebPageCustom.controller_js_file),
+                   (job_source, self.current_job.file))
+        for source, file_name in sources:
+            result = self.engine.evaluate(source, file_name)
+            if not self.current_job:
+                # The script finished the job while being evaluated
+                return
+            if result.isError():
+                self.control.script_error('{} at {}:{}'.format(result.toString(), file_name,
+                                                               result.property('lineNumber').toInt()))
+                return
+        if self.trace:
+            self.trace.span('inject', started)
+
+
+class JobLane(QObject):
+    """Runs the jobs that don't need WebKit, up to LANE_MAX_JOBS at a time, without taking a page.
+
+    Fetch jobs get their url with one shared QNetworkAccessManager per proxy, so thousands of them cost little more
+    than their sockets, and extract with a python hook on LANE_HOOK_THREADS threads. Script jobs get a JS engine
+    each, which is a small fraction of a page.
+    """
+    job_finished = pyqtSignal(object)
+    new_job_received = pyqtSignal(Job)
+    new_jobs_received = pyqtSignal(list)
+    job_failed = pyqtSignal(Job, str, int)
+    render_finished = pyqtSignal(int, bool, str)
+    # (run, context, error) from the hook threads
+    hook_done = pyqtSignal(object)
+    run_classes = {MODE_FETCH: FetchRun, MODE_SCRIPT: ScriptRun}
+
+    def __init__(self, job_registry=None, parent=None):
+        super().__init__(parent)
+        self.job_registry = job_registry
+        self.runs = set()
+        # host -> jobs running on the lane
+        self.hosts = Counter()
+        self.finished = Counter()
+        # proxy key -> QNetworkAccessManager. None is the one without a proxy.
+        self.network_managers = {}
+        self.executor = ThreadPoolExecutor(LANE_HOOK_THREADS)
+        self.hook_done.connect(self.deliver_hook)
+
+    def __len__(self):
+        return len(self.runs)
+
+    def has_capacity(self):
+        return len(self.runs) < LANE_MAX_JOBS
+
+    def network_manager(self, proxy):
+        key = (proxy.hostName(), proxy.port(), proxy.user()) if proxy else None
+        network_manager = self.network_managers.get(key)
+        if network_manager is None:
+            network_manager = self.network_managers[key] = QNetworkAccessManager(self)
+            network_manager.setProxy(proxy if proxy else QNetworkProxy(QNetworkProxy.NoProxy))
+        return network_manager
+
+    def run(self, entry):
+        run = self.run_classes[entry.job.mode](self, entry)
+        run.new_job_received.connect(self.new_job_received)
+        run.new_jobs_received.connect(self.new_jobs_received)
+        run.job_failed.connect(self.job_failed)
+        run.render_finished.connect(self.render_finished)
+        run.job_finished.connect(lambda: self.run_finished(run))
+        self.runs.add(run)
+        self.hosts[entry.host] += 1
+        logger.info(run.control.prepend_id('Job Request {}'.format(entry.job)))
+        run.start()
+
+    def run_finished(self, run):
+        self.runs.discard(run)
+        self.hosts[run.entry.host] -= 1
+        if not self.hosts[run.entry.host]:
+            del self.hosts[run.entry.host]
+        self.finished[run.entry.job.mode] += 1
+        run.deleteLater()
+        self.job_finished.emit(run.entry)
+
+    def run_hook(self, run, hook, context, response):
+        # Runs on a hook thread
+        context.started_at = monotonic()
+        try:
+            hook(context, response)
+            error = None
+        except Exception as e:
+            logger.exception('Fetch hook failed for {}'.format(context.job))
+            error = '{}: {}'.format(type(e).__name__, e)
+        context.finished_at = monotonic()
+        self.hook_done.emit((run, context, error))
+
+    @pyqtSlot(object)
+    def deliver_hook(self, done):
+        run, context, error = done
+        run.hook_finished(context, error)
+
+    def cancel(self, request_id):
+        for run in list(self.runs):
+            if run.current_job and run.current_job.request_id == request_id:
+                logger.info('Cancelling running render request {} on {}'.format(request_id, run.id))
+                run.control.cancel()
+                return True
+        return False
+
+    def stats(self):
+        return {'running': len(self.runs), 'finished': dict(self.finished)}
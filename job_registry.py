@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+import glob
+import os
+
+from PyQt5.QtCore import QObject, QFileSystemWatcher, QTimer, Qt, pyqtSignal, pyqtSlot
+
+from job import Job
+from job_scheduler import PRIORITY_SCHEDULED
+from settings import JOB_REGISTRY_POLL_SECONDS
+
+import logging
+logger = logging.getLogger(__name__)
+
+JobScript = namedtuple('JobScript', ['path', 'mtime', 'header', 'source'])
+
+
+def parse_header(source, marker='//!>'):
+    header = {}
+    for line in source.splitlines():
+        line = line.strip()
+        if not line.startswith(marker):
+            break
+
+        line = line.split(marker, 1)[1]
+        if ':' not in line:
+            break
+
+        key, value = line.split(':', 1)
+        header[key.strip()] = value.strip()
+    return header
+
+
+class JobRegistry(QObject):
+    """Caches the header and the source of every job script and reloads them when they change on disk.
+
+    The jobs directory is watched with QFileSystemWatcher (inotify on linux). Editors that save by replacing the
+    file make the watcher lose track of it, so the directory is also rescanned every JOB_REGISTRY_POLL_SECONDS.
+    """
+    schedule_key = 'schedule'
+    # Emitted with the job to schedule whenever a scheduled job is added or its header changes
+    scheduled_job_changed = pyqtSignal(Job)
+    # Emitted with the path of a job file that was removed or is no longer scheduled
+    scheduled_job_removed = pyqtSignal(str)
+
+    def __init__(self, jobs_directory, parent=None):
+        super().__init__(parent)
+        self.jobs_directory = jobs_directory
+        # path -> JobScript
+        self.scripts = {}
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.addPath(jobs_directory)
+        self.watcher.directoryChanged.connect(self.scan)
+        self.watcher.fileChanged.connect(self.file_changed)
+
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setTimerType(Qt.VeryCoarseTimer)
+        self.poll_timer.timeout.connect(self.scan)
+        self.poll_timer.start(JOB_REGISTRY_POLL_SECONDS * 1000)
+
+    def scheduled_jobs(self):
+        return [self.scheduled_job(script) for script in self.scripts.values() if self.schedule_key in script.header]
+
+    def scheduled_job(self, script):
+        job_conf = dict(script.header)
+        job_conf['file'] = script.path
+        job_conf['priority'] = PRIORITY_SCHEDULED
+        return Job(**job_conf)
+
+    def get_source(self, path):
+        script = self.scripts.get(path)
+        if script is None:
+            # Jobs outside the jobs directory, like the debug script, are loaded and watched on first use
+            script = self.load(path)
+        return script.source if script else None
+
+    @pyqtSlot()
+    def scan(self):
+        paths = set(glob.glob('{}/*.js'.format(self.jobs_directory)))
+        for path in paths:
+            script = self.scripts.get(path)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if script is None or script.mtime != mtime:
+                self.load(path)
+
+        for path in list(self.scripts):
+            if os.path.dirname(path) == self.jobs_directory and path not in paths:
+                self.unload(path)
+
+    @pyqtSlot(str)
+    def file_changed(self, path):
+        if os.path.exists(path):
+            self.load(path)
+        else:
+            self.unload(path)
+
+    def load(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+            with open(path, encoding='utf-8', mode='r') as job_file:
+                source = job_file.read()
+        except OSError as e:
+            logger.error('Could not read job file {}: {}'.format(path, e))
+            return None
+
+        old_script = self.scripts.get(path)
+        script = JobScript(path, mtime, parse_header(source), source)
+        self.scripts[path] = script
+        if path not in self.watcher.files():
+            self.watcher.addPath(path)
+        logger.info('{} job file {}'.format('Reloaded' if old_script else 'Loaded', path))
+
+        if self.schedule_key in script.header:
+            if not old_script or old_script.header != script.header:
+                self.scheduled_job_changed.emit(self.scheduled_job(script))
+        elif old_script and self.schedule_key in old_script.header:
+            self.scheduled_job_removed.emit(path)
+        return script
+
+    def unload(self, path):
+        script = self.scripts.pop(path, None)
+        if script is None:
+            return
+        logger.info('Removed job file {}'.format(path))
+        if path in self.watcher.files():
+            self.watcher.removePath(path)
+        if self.schedule_key in script.header:
+            self.scheduled_job_removed.emit(path)
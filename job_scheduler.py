@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from collections import deque, namedtuple, OrderedDict
+from time import monotonic
+from urllib.parse import urlsplit
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_SCHEDULED = 'scheduled'
+PRIORITY_RETRY = 'retry'
+PRIORITY_FANOUT = 'fanout'
+
+# Highest priority first. A class is only served when every class before it has nothing dispatchable.
+PRIORITY_ORDER = (PRIORITY_INTERACTIVE, PRIORITY_SCHEDULED, PRIORITY_RETRY, PRIORITY_FANOUT)
+
+
+def job_host(job):
+    if not job.url:
+        return ''
+    try:
+        return urlsplit(job.url).hostname or ''
+    except ValueError:
+        return ''
+
+
+class WaitStats(object):
+    sample_size = 1024
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=self.sample_size)
+
+    def add(self, wait):
+        self.count += 1
+        self.total += wait
+        if wait > self.max:
+            self.max = wait
+        self.samples.append(wait)
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class HostRoundRobin(object):
+    """Per host FIFO queues served round robin across hosts"""
+
+    def __init__(self):
+        self.queues = {}
+        self.rotation = deque()
+        self.size = 0
+
+    def push(self, entry):
+        host_queue = self.queues.get(entry.host)
+        if host_queue is None:
+            host_queue = self.queues[entry.host] = deque()
+            self.rotation.append(entry.host)
+        host_queue.append(entry)
+        self.size += 1
+
+    def pop(self, host_allowed):
+        for _ in range(len(self.rotation)):
+            host = self.rotation[0]
+            self.rotation.rotate(-1)
+            if not host_allowed(host):
+                continue
+
+            host_queue = self.queues[host]
+            entry = host_queue.popleft()
+            if not host_queue:
+                del self.queues[host]
+                self.rotation.remove(host)
+            self.size -= 1
+            return entry
+        return None
+
+    def remove(self, predicate):
+        removed = []
+        for host in list(self.queues):
+            kept = deque()
+            for entry in self.queues[host]:
+                (removed if predicate(entry) else kept).append(entry)
+            if kept:
+                self.queues[host] = kept
+            else:
+                del self.queues[host]
+                self.rotation.remove(host)
+        self.size -= len(removed)
+        return removed
+
+
+class JobScheduler(object):
+    Entry = namedtuple('Entry', ['job', 'priority', 'host', 'token', 'queued_at'])
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.classes = OrderedDict((priority, HostRoundRobin()) for priority in PRIORITY_ORDER)
+        self.wait_stats = {priority: WaitStats() for priority in PRIORITY_ORDER}
+
+    def __len__(self):
+        return sum(c.size for c in self.classes.values())
+
+    def empty(self):
+        return len(self) == 0
+
+    def is_saturated(self):
+        return len(self) >= self.max_size
+
+    def entry(self, job, token=None):
+        priority = job.priority if job.priority in self.classes else PRIORITY_INTERACTIVE
+        return self.Entry(job, priority, job_host(job), token, monotonic())
+
+    def push(self, job, token=None):
+        """Jobs are never dropped. Producers that can wait should check is_saturated() first."""
+        entry = self.entry(job, token)
+        self.classes[entry.priority].push(entry)
+        return entry
+
+    def pop(self, host_allowed=lambda host: True):
+        for priority, host_queues in self.classes.items():
+            if not host_queues.size:
+                continue
+            entry = host_queues.pop(host_allowed)
+            if entry is not None:
+                self.wait_stats[priority].add(monotonic() - entry.queued_at)
+                return entry
+        return None
+
+    def remove(self, predicate):
+        removed = []
+        for host_queues in self.classes.values():
+            removed.extend(host_queues.remove(predicate))
+        return removed
+
+    def stats(self):
+        return {priority: dict(self.wait_stats[priority].dict(), depth=self.classes[priority].size)
+                for priority in self.classes}
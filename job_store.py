@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sqlite3
+from time import time
+
+from PyQt5.QtCore import QObject, QTimer, Qt, pyqtSlot
+
+from job import Job
+from settings import JOB_STORE_BATCH_SIZE, JOB_STORE_FLUSH_MILLISECONDS
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class JobStore(QObject):
+    """Keeps every queued, running and delayed job in SQLite so that they survive a restart.
+
+    Writes are buffered and committed together, either every JOB_STORE_FLUSH_MILLISECONDS or as soon as
+    JOB_STORE_BATCH_SIZE changes are pending. A crash can lose at most the changes of the last interval.
+    """
+    _insert = 'insert'
+    _running = 'running'
+    _delete = 'delete'
+
+    def __init__(self, path, parent=None):
+        super().__init__(parent)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                        'id INTEGER PRIMARY KEY, '
+                        'job TEXT NOT NULL, '
+                        'due REAL NOT NULL, '
+                        'retry INTEGER NOT NULL, '
+                        'running INTEGER NOT NULL DEFAULT 0)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cron_state (file TEXT PRIMARY KEY, last_fire REAL NOT NULL)')
+        # Jobs that won't be retried. Kept for inspection, nothing reads them back.
+        self.db.execute('CREATE TABLE IF NOT EXISTS dead_jobs ('
+                        'id INTEGER PRIMARY KEY, '
+                        'job TEXT NOT NULL, '
+                        'cause TEXT NOT NULL, '
+                        'retry INTEGER NOT NULL, '
+                        'failed_at REAL NOT NULL)')
+        self.db.commit()
+
+        self.next_id = (self.db.execute('SELECT MAX(id) FROM jobs').fetchone()[0] or 0) + 1
+        # id -> pending change. Changes to the same id are folded together before they reach the database.
+        self.pending = {}
+
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setTimerType(Qt.CoarseTimer)
+        self.flush_timer.setInterval(JOB_STORE_FLUSH_MILLISECONDS)
+        self.flush_timer.timeout.connect(self.flush)
+
+    def add(self, job, due=None):
+        job_id = self.next_id
+        self.next_id += 1
+        self.pending[job_id] = (self._insert, [job_id, json.dumps(job.dict()), due or time(), job.retry or 0, 0])
+        self.changed()
+        return job_id
+
+    def mark_running(self, job_id):
+        change = self.pending.get(job_id)
+        if change and change[0] == self._insert:
+            change[1][4] = 1
+        else:
+            self.pending[job_id] = (self._running, None)
+        self.changed()
+
+    def remove(self, job_id):
+        change = self.pending.get(job_id)
+        if change and change[0] == self._insert:
+            # Never reached the database
+            del self.pending[job_id]
+        else:
+            self.pending[job_id] = (self._delete, None)
+            self.changed()
+
+    def changed(self):
+        if len(self.pending) >= JOB_STORE_BATCH_SIZE:
+            self.flush()
+        elif not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    @pyqtSlot()
+    def flush(self):
+        self.flush_timer.stop()
+        if not self.pending:
+            return
+
+        inserts, running, deletes = [], [], []
+        for job_id, (change, row) in self.pending.items():
+            if change == self._insert:
+                inserts.append(row)
+            elif change == self._running:
+                running.append((job_id,))
+            else:
+                deletes.append((job_id,))
+        self.pending = {}
+
+        try:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO jobs (id, job, due, retry, running) VALUES (?, ?, ?, ?, ?)', inserts)
+                self.db.executemany('UPDATE jobs SET running = 1 WHERE id = ?', running)
+                self.db.executemany('DELETE FROM jobs WHERE id = ?', deletes)
+        except sqlite3.Error:
+            logger.exception('Could not write {} changes to the job store {}'.format(len(inserts) + len(running) + len(deletes), self.path))
+
+    def recover(self):
+        """Returns (id, job, due) for every job left over from the last run. Jobs that were running are due now."""
+        rows = self.db.execute('SELECT id, job, due, running FROM jobs ORDER BY due, id').fetchall()
+        now = time()
+        recovered = []
+        for job_id, job_json, due, running in rows:
+            try:
+                job = Job(**json.loads(job_json))
+            except (ValueError, TypeError):
+                logger.exception('Dropping unreadable job {} from the job store: {}'.format(job_id, job_json))
+                self.remove(job_id)
+                continue
+            recovered.append((job_id, job, now if running else due))
+
+        with self.db:
+            self.db.execute('UPDATE jobs SET running = 0 WHERE running = 1')
+        return recovered
+
+    def get_cron_last_fire(self, file):
+        row = self.db.execute('SELECT last_fire FROM cron_state WHERE file = ?', (file,)).fetchone()
+        return row[0] if row else None
+
+    def set_cron_last_fire(self, file, last_fire):
+        # At most one write per job per minute, so this is committed straight away
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO cron_state (file, last_fire) VALUES (?, ?)', (file, last_fire))
+
+    def add_dead_job(self, job, cause):
+        # Rare enough to be committed straight away
+        with self.db:
+            self.db.execute('INSERT INTO dead_jobs (job, cause, retry, failed_at) VALUES (?, ?, ?, ?)',
+                            (json.dumps(job.dict()), cause, job.retry or 0, time()))
+
+    def dead_jobs(self, limit=100):
+        """Returns (job, cause, failed at) for the latest jobs that were given up on"""
+        rows = self.db.execute('SELECT job, cause, failed_at FROM dead_jobs ORDER BY id DESC LIMIT ?', (limit,))
+        return [(Job(**json.loads(job_json)), cause, failed_at) for job_json, cause, failed_at in rows]
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -1,4 +1,5 @@
 //!> schedule: 0 * * * *
+//!> mode: script
 
 (function() {
   'use strict';
@@ -25,7 +26,7 @@
      */
 
     SjCtrl.getJson('http://sites.contify.com/social_peek/api/getlinkedindata/', function(data) {
-      var result = data.result, id;
+      var result = data.result, id, company_jobs = [];
       for (id in result) {
         var company_req = result[id];
 
@@ -34,7 +35,7 @@
         }
 
         SjCtrl.log_message(company_req);
-        SjCtrl.load({
+        company_jobs.push({
           url: 'https://www.linkedin.com/company/' + company_req.linkedin_company,
           state: 'company_page',
           filter_list: [
@@ -50,6 +51,7 @@
           timeout: 180
         });
       }
+      SjCtrl.loadMany(company_jobs);
       SjCtrl.done();
     }, function(error_id) {
       console.log('Failed ' + error_id);
@@ -88,45 +90,34 @@
       return (last_ac.length !== 0);
     }
 
+    // Posts what the jQuery version did: texts as textContent like .text(), '' for a missing title or commentary and
+    // null for missing engagement counts.
     function parseAndSubmit() {
-      var result_list = [];
-      $('.feed-item').each(function(index, element) {
-        var title_element = $(element).find('.share-title .title'),
-          urls = [];
-
-        if (title_element) {
-          var main_url = SjCtrl.relativeToAbsolute(title_element.attr('href'));
-          if (main_url) {
-            urls.push(main_url);
-          }
-        }
-
-        $(element).find('.share-body a').each(function(index, element) {
-          var url = SjCtrl.relativeToAbsolute($(element).attr('href'));
-          if (url) {
-            urls.push(url);
-          }
-        });
-
-        var result = {
-          id: $(element).attr('data-li-update-id'),
-          title: title_element.text(),
-          urls: urls,
-          share_url: SjCtrl.relativeToAbsolute($(element).find('.feed-item-meta > a').attr('href')),
-          share_text: $(element).find('.share-body .commentary').text(),
-          share_title: 'published a new update on LinkedIn',
-          pub_date: $(element).attr('data-li-update-date'),
+      var result_list = SjCtrl.extract({
+        selector: '.feed-item',
+        list: true,
+        fields: {
+          id: {attr: 'data-li-update-id'},
+          title: {selector: '.share-title .title', text: 'content', default: ''},
+          urls: {selector: '.share-title .title, .share-body a', attr: 'href', url: true, list: true},
+          share_url: {selector: '.feed-item-meta > a', attr: 'href', url: true},
+          share_text: {selector: '.share-body .commentary', text: 'content', default: ''},
+          share_title: {value: 'published a new update on LinkedIn'},
+          pub_date: {attr: 'data-li-update-date'},
           engagement: {
-            'ln_likes': parseInt($(element).find('[data-li-num-liked]').attr('data-li-num-liked')),
-            'ln_comments': parseInt($(element).find('[data-li-num-commented]').attr('data-li-num-commented'))
+            fields: {
+              'ln_likes': {selector: '[data-li-num-liked]', attr: 'data-li-num-liked', type: 'int', default: null},
+              'ln_comments': {selector: '[data-li-num-commented]', attr: 'data-li-num-commented', type: 'int',
+                default: null}
+            }
           }
-        };
-        SjCtrl.log_message(result);
-        result_list.push(result);
+        }
       });
+      SjCtrl.log_message('Extracted ' + result_list.length + ' updates');
 
       if (result_list.length !== 0) {
-        SjCtrl.post_obj("http://sites.contify.com/social_peek/api/addlinkedindata/", {"data": result_list, "search_keyword_id": job.meta_data.search_keyword_id});
+        // Extracted values are never undefined, so they don't need SjCtrl.post_obj
+        SjCtrl.post_request("http://sites.contify.com/social_peek/api/addlinkedindata/", JSON.stringify({"data": result_list, "search_keyword_id": job.meta_data.search_keyword_id}));
       }
 
       done = true;
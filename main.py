@@ -7,10 +7,12 @@ import logging.config
 import signal
 import os
 import settings
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QCoreApplication
 from PyQt5.QtWidgets import QApplication
 from page_coordinator import PageCoordinator
 from request_server import RequestServer
+from result_spool import ResultSpool
+from worker_pool import WorkerPool
 
 logger = logging.getLogger(__name__)
 
@@ -20,23 +22,47 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='SpiderJuice Service')
     parser.add_argument('-d', '--scriptdebug', nargs='?', help='Debug the script given on path')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='Run the pages in this many worker processes. By default everything runs in this process')
+    parser.add_argument('-p', '--pages', type=int, default=10, help='Number of pages per process')
     args = parser.parse_args()
 
     rq = RequestServer()
-    #rq.start()
 
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-    a = QApplication(sys.argv)
-
     debug_file = None
     if args.scriptdebug:
         debug_file = os.path.abspath(args.scriptdebug)
 
-    pc = PageCoordinator(10, debug_file=debug_file)
+    if args.workers and not debug_file:
+        # The supervisor owns the queue and the cron and only hands out jobs. WebKit runs in the workers.
+        a = QCoreApplication(sys.argv)
+        pool = WorkerPool(args.workers, args.pages)
+        pool.start()
+        pc = PageCoordinator(pool.instances(), page_factory=pool.take_page)
+        pool.worker_started.connect(pc.distribute_jobs)
+        a.aboutToQuit.connect(pool.stop)
+    else:
+        a = QApplication(sys.argv)
+        pc = PageCoordinator(args.pages, debug_file=debug_file)
+
+    # Starts delivering what the last run left in the spool. With workers this one gets the results of the lane.
+    a.aboutToQuit.connect(ResultSpool.get().close)
+
+    if pc.job_store:
+        a.aboutToQuit.connect(pc.job_store.close)
 
     # We don't need to specify QueuedConnection because that will happen by default when
     # the request comes from another thread. We are just making it explicit to the reader that this will happen.
-    #rq.job_request.connect(pc.add_job_to_queue, type=Qt.QueuedConnection | Qt.UniqueConnection)
+    rq.job_request.connect(pc.add_job_to_queue, type=Qt.QueuedConnection | Qt.UniqueConnection)
+    rq.job_batch.connect(pc.add_jobs_to_queue, type=Qt.QueuedConnection | Qt.UniqueConnection)
+    pc.capacity_changed.connect(rq.set_capacity)
+    pc.batch_queued.connect(rq.batch_done)
+    rq.render_request.connect(pc.queue_new_job, type=Qt.QueuedConnection | Qt.UniqueConnection)
+    rq.render_cancelled.connect(pc.cancel_render, type=Qt.QueuedConnection | Qt.UniqueConnection)
+    pc.render_finished.connect(rq.complete_render)
+    rq.start()
+    rq.set_capacity(pc.has_capacity())
 
     sys.exit(a.exec_())
\ No newline at end of file
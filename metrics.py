@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+import os
+
+import psutil
+
+from settings import METRICS_MAX_LABEL_SETS
+
+import logging
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+OTHER = 'other'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in zip(names, values)) + '}'
+
+
+class Registry(object):
+    """Every metric of the process, plus the last snapshot sent by each worker.
+
+    Metrics are only written from the Qt thread and read from the server thread. Nothing takes a lock: the GIL
+    keeps each update whole, and a scrape that lands in the middle of a histogram update is off by one sample.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        # source label -> snapshot() of a worker process
+        self.remote = {}
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """A picklable copy of every metric, for a worker to send to the supervisor"""
+        return [metric.snapshot() for metric in self.metrics]
+
+    def set_remote(self, source, snapshot):
+        self.remote[source] = snapshot
+
+    def exposition(self):
+        # name -> (kind, help, [(extra label names, extra label values, snapshot)])
+        families = {}
+        sources = [((), (), self.snapshot())]
+        sources.extend((('worker',), (source,), snapshot) for source, snapshot in sorted(self.remote.items()))
+        for extra_names, extra_values, snapshot in sources:
+            for metric in snapshot:
+                family = families.setdefault(metric['name'], (metric['kind'], metric['help'], []))
+                family[2].append((extra_names, extra_values, metric))
+
+        lines = []
+        for name in sorted(families):
+            kind, help_text, parts = families[name]
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for extra_names, extra_values, metric in parts:
+                names = tuple(metric['labels']) + extra_names
+                for values, sample in metric['samples']:
+                    values = tuple(values) + extra_values
+                    if kind == 'histogram':
+                        lines.extend(self.histogram_lines(name, names, values, metric['buckets'], sample))
+                    else:
+                        lines.append('{}{} {}'.format(name, format_labels(names, values), sample))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def histogram_lines(name, names, values, buckets, sample):
+        counts, total, count = sample
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            yield '{}_bucket{} {}'.format(name, format_labels(names + ('le',), values + (bound,)), cumulative)
+        yield '{}_bucket{} {}'.format(name, format_labels(names + ('le',), values + ('+Inf',)), count)
+        yield '{}_sum{} {}'.format(name, format_labels(names, values), total)
+        yield '{}_count{} {}'.format(name, format_labels(names, values), count)
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help_text, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        # label values -> child. The metric without labels is its own only child.
+        self.children = {}
+        self.function = None
+        registry.register(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(self.children) >= METRICS_MAX_LABEL_SETS:
+                # Keeps a label like the host from growing the metric without bound
+                values = (OTHER,) * len(self.label_names)
+                child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = self.new_child()
+        return child
+
+    def set_function(self, function):
+        """function() returns {label values: value} and is called on every scrape instead of keeping children.
+        It runs on the server thread, so it must only read."""
+        self.function = function
+
+    def samples(self):
+        if self.function:
+            try:
+                return list(self.function().items())
+            except Exception:
+                logger.exception('Could not collect {}'.format(self.name))
+                return []
+        return [(values, child.sample()) for values, child in list(self.children.items())]
+
+    def snapshot(self):
+        return {'name': self.name, 'kind': self.kind, 'help': self.help, 'labels': self.label_names,
+                'samples': self.samples()}
+
+
+class CounterChild(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Counter(Metric):
+    kind = 'counter'
+    new_child = CounterChild
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+    new_child = GaugeChild
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class HistogramChild(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def sample(self):
+        return list(self.counts), self.sum, self.count
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DURATION_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_text, labels, registry)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def snapshot(self):
+        return dict(super().snapshot(), buckets=self.buckets)
+
+
+def job_labels(job):
+    return os.path.basename(job.file or ''), job.state or 'main'
+
+
+QUEUE_DEPTH = Gauge('sj_queue_depth', 'Jobs waiting to run', ['queue', 'priority'])
+QUEUE_WAIT = Histogram('sj_queue_wait_seconds', 'Time jobs waited in the queue before running', ['queue', 'priority'])
+PAGES = Gauge('sj_pages', 'Pages by whether they are running a job', ['state'])
+LANE_RUNNING = Gauge('sj_lane_running', 'Jobs running on the lane')
+JOB_DURATION = Histogram('sj_job_duration_seconds', 'Time from starting a job to its end', ['file', 'state', 'outcome'])
+LOAD_TO_INJECT = Histogram('sj_load_to_inject_seconds', 'Time from starting a job to injecting its script once the '
+                                                        'page loaded', ['file', 'state'])
+SUBREQUESTS = Counter('sj_subrequests_total', 'Requests made by pages', ['decision'])
+JOB_SUBREQUESTS = Histogram('sj_job_subrequests', 'Requests made by the page of a job', ['decision'],
+                            buckets=COUNT_BUCKETS)
+HOST_BYTES = Counter('sj_host_bytes_total', 'Bytes received by host, from Content-Length', ['host'])
+PROXY_BYTES = Counter('sj_proxy_bytes_total', 'Bytes received through each proxy, from Content-Length', ['proxy'])
+JOB_FAILURES = Counter('sj_job_failures_total', 'Jobs that failed, by cause', ['cause'])
+JOB_RETRIES = Counter('sj_job_retries_total', 'Failed jobs queued to run again, by cause', ['cause'])
+JOB_GIVEN_UP = Counter('sj_job_given_up_total', 'Failed jobs that will not run again, by cause', ['cause'])
+PROCESS_RSS = Gauge('sj_process_rss_bytes', 'Resident memory of the process')
+
+process = psutil.Process(os.getpid())
+PROCESS_RSS.set_function(lambda: {(): process.memory_info().rss})
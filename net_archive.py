@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+import base64
+from collections import Counter, OrderedDict
+import gzip
+import hashlib
+import json
+import os
+from time import monotonic, time
+
+from PyQt5.QtCore import QIODevice, QTimer, QUrl
+from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkReply, QNetworkRequest
+
+from settings import NET_ARCHIVE_MODE, NET_ARCHIVE_DIRECTORY, NET_REPLAY_LATENCY_SCALE, HTTP_HEADER_CHARSET
+
+import logging
+logger = logging.getLogger(__name__)
+
+MODE_RECORD = 'record'
+MODE_REPLAY = 'replay'
+NET_ARCHIVE_MODES = (MODE_RECORD, MODE_REPLAY)
+# Archives parsed for replay, kept so that a job replayed over and over reads its archive once
+LOADED_ARCHIVES = 64
+
+METHODS = {QNetworkAccessManager.HeadOperation: 'HEAD',
+           QNetworkAccessManager.GetOperation: 'GET',
+           QNetworkAccessManager.PutOperation: 'PUT',
+           QNetworkAccessManager.PostOperation: 'POST',
+           QNetworkAccessManager.DeleteOperation: 'DELETE'}
+# Replayed bodies are already decoded and whole
+REPLACED_HEADERS = frozenset(['content-encoding', 'content-length', 'transfer-encoding'])
+
+
+def open_archive(job):
+    """The NetArchive of a job, None when NET_ARCHIVE_MODE is off"""
+    if not NET_ARCHIVE_MODE:
+        return None
+    if NET_ARCHIVE_MODE not in NET_ARCHIVE_MODES:
+        raise ValueError('Unknown net archive mode {}'.format(NET_ARCHIVE_MODE))
+    return NetArchive(job, NET_ARCHIVE_MODE)
+
+
+def archive_path(job):
+    """Runs of the same work share an archive, whatever their retry or the process that ran them"""
+    name = os.path.splitext(os.path.basename(job.file or ''))[0]
+    key = json.dumps([name, job.state, job.url, job.meta_data], sort_keys=True, default=str)
+    return os.path.join(NET_ARCHIVE_DIRECTORY, '{}-{}-{}.jsonl.gz'.format(
+        name, job.state or 'main', hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+
+def method_of(operation, request):
+    if operation == QNetworkAccessManager.CustomOperation:
+        verb = request.attribute(QNetworkRequest.CustomVerbAttribute)
+        return bytes(verb).decode(HTTP_HEADER_CHARSET) if verb else 'CUSTOM'
+    return METHODS.get(operation, 'GET')
+
+
+def without_query(url_str):
+    return QUrl(url_str).adjusted(QUrl.RemoveQuery | QUrl.RemoveFragment).toString()
+
+
+def encode_body(data):
+    """(text, encoding) like the content of a HAR entry. Bodies that are not utf-8 are base64."""
+    if data is None:
+        return None, None
+    try:
+        return data.decode('utf-8'), None
+    except UnicodeDecodeError:
+        return base64.b64encode(data).decode('ascii'), 'base64'
+
+
+def decode_body(text, encoding):
+    if text is None:
+        return b''
+    if encoding == 'base64':
+        return base64.b64decode(text)
+    return text.encode('utf-8')
+
+
+def raw_headers(message):
+    return [[header.data().decode(HTTP_HEADER_CHARSET), message.rawHeader(header).data().decode(HTTP_HEADER_CHARSET)]
+            for header in message.rawHeaderList()]
+
+
+class NetArchive(object):
+    """The network traffic of one job, in NET_ARCHIVE_DIRECTORY as gzipped JSON lines.
+
+    The first line describes the job, the others are its requests in the order they finished, HAR like, and the
+    results it posted. When recording, replies are wrapped so that their bodies are copied as they are read, and the
+    archive is written when the job ends. When replaying, requests are answered from the archive without touching
+    the network. A request is matched by method and url, then by method and url without its query, which catches
+    cache busters. Repeated requests get the recorded responses in order, then the last one again. Requests that
+    are not in the archive fail as not found, nothing is ever sent. Posts are compared with the recorded ones
+    instead of being delivered.
+    """
+    # path -> (mtime, entries, posts) of the archives parsed for replay. Most recently used last.
+    loaded = OrderedDict()
+
+    def __init__(self, job, mode):
+        self.job = job
+        self.mode = mode
+        self.replaying = mode == MODE_REPLAY
+        self.path = archive_path(job)
+        self.started_at = monotonic()
+        self.entries = []
+        self.posts = []
+        # Replay only. (method, url) and (method, url without query) -> recorded entries
+        self.exact = {}
+        self.loose = {}
+        self.taken = Counter()
+        self.recorded_posts = []
+        if self.replaying:
+            self.load()
+
+    def load(self):
+        try:
+            entries, self.recorded_posts = self.read(self.path)
+        except OSError:
+            logger.warning('No net archive for {} at {}, its requests will fail'.format(self.job, self.path))
+            return
+        for entry in entries:
+            self.exact.setdefault((entry['method'], entry['url']), []).append(entry)
+            self.loose.setdefault((entry['method'], without_query(entry['url'])), []).append(entry)
+
+    @staticmethod
+    def read(path):
+        mtime = os.stat(path).st_mtime
+        loaded = NetArchive.loaded.get(path)
+        if loaded and loaded[0] == mtime:
+            NetArchive.loaded.move_to_end(path)
+            return loaded[1], loaded[2]
+
+        entries = []
+        posts = []
+        with gzip.open(path, 'rt', encoding='utf-8') as archive_file:
+            for line in archive_file:
+                record = json.loads(line)
+                if record.get('kind') == 'request':
+                    entries.append(record)
+                elif record.get('kind') == 'post':
+                    posts.append((record['url'], record['data']))
+        NetArchive.loaded[path] = (mtime, entries, posts)
+        while len(NetArchive.loaded) > LOADED_ARCHIVES:
+            NetArchive.loaded.popitem(last=False)
+        return entries, posts
+
+    def find(self, method, url_str):
+        for key, entries in (((method, url_str), self.exact), ((method, without_query(url_str)), self.loose)):
+            recorded = entries.get(key)
+            if recorded:
+                taken = self.taken[key]
+                self.taken[key] += 1
+                return recorded[min(taken, len(recorded) - 1)]
+        return None
+
+    def record(self, operation, request, device, reply, url_str=None):
+        """Wraps reply, just returned by a QNetworkAccessManager for request, to copy its response as it is read.
+        url_str is the url the job asked for when the request was rewritten before being sent."""
+        body = None
+        if device is not None and device.isOpen():
+            body = device.peek(device.size()) if device.size() > 0 else b''
+        return RecordingReply(self, method_of(operation, request), url_str or request.url().toString(), operation,
+                              request, body, reply)
+
+    def replay(self, operation, request, parent):
+        """A reply to request from the archive, in place of sending it"""
+        method = method_of(operation, request)
+        url_str = request.url().toString()
+        entry = self.find(method, url_str)
+        if entry is None:
+            logger.warning('{} {} is not in the net archive {}'.format(method, url_str, self.path))
+        return ReplayReply(operation, request, entry, NET_REPLAY_LATENCY_SCALE, parent)
+
+    def add(self, entry):
+        entry['started'] = round(entry['started'] - self.started_at, 6)
+        self.entries.append(entry)
+
+    def add_post(self, url, data):
+        self.posts.append((url, data))
+
+    def close(self):
+        if self.replaying:
+            self.compare_posts()
+        else:
+            self.write()
+
+    def compare_posts(self):
+        if self.posts == self.recorded_posts:
+            logger.info('Replayed {}: {} posts as recorded'.format(self.job, len(self.posts)))
+            return
+        for index, (recorded, replayed) in enumerate(zip(self.recorded_posts, self.posts)):
+            if recorded != replayed:
+                logger.warning('Replayed {}: post {} to {} differs from the recording'.format(self.job, index,
+                                                                                             replayed[0]))
+                return
+        logger.warning('Replayed {}: {} posts where {} were recorded'.format(self.job, len(self.posts),
+                                                                            len(self.recorded_posts)))
+
+    def write(self):
+        os.makedirs(NET_ARCHIVE_DIRECTORY, exist_ok=True)
+        partial_path = self.path + '.partial'
+        try:
+            with gzip.open(partial_path, 'wt', encoding='utf-8') as archive_file:
+                archive_file.write(json.dumps({'kind': 'job', 'job': self.job.dict(), 'recorded_at': time()},
+                                              default=str) + '\n')
+                for entry in self.entries:
+                    archive_file.write(json.dumps(entry) + '\n')
+                for url, data in self.posts:
+                    archive_file.write(json.dumps({'kind': 'post', 'url': url, 'data': data}, default=str) + '\n')
+            os.replace(partial_path, self.path)
+        except OSError:
+            logger.exception('Could not write the net archive of {}'.format(self.job))
+            return
+        logger.info('Recorded {} requests of {} to {}'.format(len(self.entries), self.job, self.path))
+
+
+class BufferedReply(QNetworkReply):
+    """A reply whose body is handed to it in memory and read from there"""
+
+    def __init__(self, operation, request, parent):
+        super().__init__(parent)
+        self.setOperation(operation)
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.unread = bytearray()
+        self.open(QIODevice.ReadOnly | QIODevice.Unbuffered)
+
+    def isSequential(self):
+        return True
+
+    def bytesAvailable(self):
+        return len(self.unread) + super().bytesAvailable()
+
+    def readData(self, max_size):
+        data = bytes(self.unread[:max_size])
+        del self.unread[:max_size]
+        return data
+
+    def append(self, data):
+        if data:
+            self.unread.extend(data)
+            self.readyRead.emit()
+
+    def finish(self, error=QNetworkReply.NoError, error_string=''):
+        if self.isFinished():
+            return
+        if error != QNetworkReply.NoError:
+            self.setError(error, error_string)
+        self.setFinished(True)
+        self.finished.emit()
+
+
+class RecordingReply(BufferedReply):
+    """Stands in for a reply on its way from the network, copying what is read from it into the archive"""
+    copied_attributes = (QNetworkRequest.HttpStatusCodeAttribute, QNetworkRequest.HttpReasonPhraseAttribute,
+                         QNetworkRequest.RedirectionTargetAttribute, QNetworkRequest.SourceIsFromCacheAttribute)
+
+    def __init__(self, archive, method, url_str, operation, request, request_body, reply):
+        super().__init__(operation, request, reply.parent())
+        # Deleted along with this one by whoever is done with it
+        reply.setParent(self)
+        self.archive = archive
+        self.reply = reply
+        self.started_at = monotonic()
+        self.headers_at = None
+        self.body = bytearray()
+        request_text, request_encoding = encode_body(request_body)
+        self.entry = {'kind': 'request', 'method': method, 'url': url_str, 'request_headers': raw_headers(request),
+                      'request_body': request_text, 'request_encoding': request_encoding}
+
+        reply.metaDataChanged.connect(self.copy_meta_data)
+        reply.readyRead.connect(self.copy_data)
+        reply.finished.connect(self.reply_finished)
+        reply.uploadProgress.connect(self.uploadProgress)
+        reply.downloadProgress.connect(self.downloadProgress)
+
+    def copy_meta_data(self):
+        if self.headers_at is None:
+            self.headers_at = monotonic()
+        for attribute in self.copied_attributes:
+            value = self.reply.attribute(attribute)
+            if value is not None:
+                self.setAttribute(attribute, value)
+        for header in self.reply.rawHeaderList():
+            self.setRawHeader(header, self.reply.rawHeader(header))
+        self.setUrl(self.reply.url())
+        self.metaDataChanged.emit()
+
+    def copy_data(self):
+        data = self.reply.readAll().data()
+        self.body.extend(data)
+        self.append(data)
+
+    def reply_finished(self):
+        self.copy_data()
+        if self.headers_at is None:
+            self.copy_meta_data()
+        finished_at = monotonic()
+        redirect = self.reply.attribute(QNetworkRequest.RedirectionTargetAttribute)
+        body_text, body_encoding = encode_body(bytes(self.body))
+        self.entry.update({
+            'started': self.started_at,
+            'wait': round(self.headers_at - self.started_at, 6),
+            'duration': round(finished_at - self.started_at, 6),
+            'status': self.reply.attribute(QNetworkRequest.HttpStatusCodeAttribute),
+            'reason': self.reply.attribute(QNetworkRequest.HttpReasonPhraseAttribute),
+            'redirect': redirect.toString() if redirect else None,
+            'from_cache': bool(self.reply.attribute(QNetworkRequest.SourceIsFromCacheAttribute)),
+            'error': int(self.reply.error()),
+            'error_string': self.reply.errorString() if self.reply.error() else None,
+            'headers': raw_headers(self.reply),
+            'body': body_text,
+            'encoding': body_encoding})
+        self.archive.add(self.entry)
+        self.finish(self.reply.error(), self.reply.errorString())
+
+    def abort(self):
+        self.reply.abort()
+        self.finish(QNetworkReply.OperationCanceledError, 'Operation canceled')
+
+
+class ReplayReply(BufferedReply):
+    """Answers a request with a recorded response. The headers come after the recorded wait and the body after the
+    recorded duration, both multiplied by latency_scale."""
+
+    def __init__(self, operation, request, entry, latency_scale, parent):
+        super().__init__(operation, request, parent)
+        self.entry = entry
+        self.body = decode_body(entry['body'], entry['encoding']) if entry else b''
+        self.meta_data_sent = False
+        wait, duration = (entry['wait'], entry['duration']) if entry else (0, 0)
+
+        self.meta_data_timer = QTimer(self)
+        self.meta_data_timer.setSingleShot(True)
+        self.meta_data_timer.timeout.connect(self.send_meta_data)
+        self.meta_data_timer.start(int(wait * latency_scale * 1000))
+        self.body_timer = QTimer(self)
+        self.body_timer.setSingleShot(True)
+        self.body_timer.timeout.connect(self.send_body)
+        self.body_timer.start(int(duration * latency_scale * 1000))
+
+    def send_meta_data(self):
+        if self.meta_data_sent or self.isFinished() or not self.entry:
+            return
+        self.meta_data_sent = True
+        entry = self.entry
+        if entry['status'] is not None:
+            self.setAttribute(QNetworkRequest.HttpStatusCodeAttribute, entry['status'])
+            self.setAttribute(QNetworkRequest.HttpReasonPhraseAttribute, entry['reason'] or '')
+        if entry['redirect']:
+            self.setAttribute(QNetworkRequest.RedirectionTargetAttribute, QUrl(entry['redirect']))
+        for name, value in entry['headers']:
+            if name.lower() not in REPLACED_HEADERS:
+                self.setRawHeader(name.encode(HTTP_HEADER_CHARSET), value.encode(HTTP_HEADER_CHARSET))
+        self.setHeader(QNetworkRequest.ContentLengthHeader, len(self.body))
+        self.metaDataChanged.emit()
+
+    def send_body(self):
+        if self.isFinished():
+            return
+        if not self.entry:
+            self.finish(QNetworkReply.ContentNotFoundError, 'Not in the net archive')
+            return
+        self.send_meta_data()
+        # Whoever got the headers may have aborted
+        if self.isFinished():
+            return
+        self.append(self.body)
+        self.finish(QNetworkReply.NetworkError(self.entry['error']), self.entry['error_string'] or '')
+
+    def abort(self):
+        self.meta_data_timer.stop()
+        self.body_timer.stop()
+        self.finish(QNetworkReply.OperationCanceledError, 'Operation canceled')
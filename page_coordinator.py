@@ -1,32 +1,48 @@
 # -*- coding: utf-8 -*-
-from collections import namedtuple
-import glob
+from collections import deque
 
-from PyQt5.QtCore import QObject, pyqtSlot, QTimer, Qt
+from PyQt5.QtCore import QObject, pyqtSlot, pyqtSignal, QTimer, Qt
+from PyQt5.QtWebKit import QWebSettings
 from PyQt5.QtWebKitWidgets import QWebView
 from PyQt5.QtWidgets import QMainWindow
-from croniter import croniter
 import gc
 import os
 import psutil
+from time import monotonic, time
 from job import Job
+from job_lane import JobLane, LANE_MODES
+from job_registry import JobRegistry
+from job_scheduler import JobScheduler
+from job_store import JobStore
+from block_profiles import BlockStats
+from http_cache import SharedCache
+from metrics import QUEUE_DEPTH, QUEUE_WAIT, PAGES, LANE_RUNNING, JOB_RETRIES, JOB_GIVEN_UP
+from proxy_pool import ProxyPool
+from rate_limiter import RateLimiter
+from retry_policy import RetryPolicy
+from result_cache import ResultCache
+from result_spool import ResultSpool
+from cron_scheduler import CronScheduler
+from timer_heap import TimerHeap
 from webpage_custom import WebPageCustom
-import queue
-from queue import Queue
-from datetime import datetime
-from settings import BASE_PROJECT_DIR
+from settings import BASE_PROJECT_DIR, JOB_QUEUE_SIZE, MAX_PAGES_PER_HOST, HOST_MAX_PAGES, PROCESS_MAX_RSS_MB, \
+    PROCESS_RESUME_RSS_MB, MEMORY_CHECK_SECONDS, JOB_STORE_PATH, RESULT_CACHE_TTL_SECONDS, RESULT_CACHE_MAX_BYTES, \
+    LANE_QUEUE_SIZE, LANE_MAX_PER_HOST, FAN_OUT_CURSOR_HEADROOM, FAN_OUT_MAX_CURSORS
 
 import logging
 logger = logging.getLogger(__name__)
 
 
 class PageCoordinator(QObject):
-    marker = '//!>'
-    schedule_key = 'schedule'
-    job_recalculate_minutes = 15
-    job_limit = 100
+    # True when the queue can take more jobs. Emitted when saturation starts and ends.
+    capacity_changed = pyqtSignal(bool)
+    # Number of jobs queued from a batch submitted by another thread
+    batch_queued = pyqtSignal(int)
+    # request id, success and JSON payload of a job somebody is waiting on. See WebPageCustom.render_finished
+    render_finished = pyqtSignal(int, bool, str)
 
-    def __init__(self, instances, parent=None, debug_file=None, queue_size=1000):
+    def __init__(self, instances, parent=None, debug_file=None, queue_size=JOB_QUEUE_SIZE, page_factory=WebPageCustom,
+                 local_jobs=True):
         super().__init__(parent)
         if debug_file:
             # When in debugging mode we only load and single instance and show it to the user
@@ -35,14 +51,53 @@ class PageCoordinator(QObject):
             self.instances = instances
 
         self.web_pages = []
-        self.job_list = []
-        self.job_queue = Queue(maxsize=queue_size)
+        self.job_registry = JobRegistry('{base}/jobs'.format(base=BASE_PROJECT_DIR), self)
+        self.job_queue = JobScheduler(max_size=queue_size)
+        # Jobs that don't need WebKit wait here for the lane instead of a page
+        self.lane_queue = JobScheduler(max_size=LANE_QUEUE_SIZE)
+        self.lane = JobLane(self.job_registry, self)
+        # Queued, so that jobs failing as they start don't recurse into distribute_jobs
+        self.lane.job_finished.connect(self.on_lane_job_finished, type=Qt.QueuedConnection)
+        self.lane.new_job_received.connect(self.queue_new_job)
+        self.lane.new_jobs_received.connect(self.queue_new_jobs)
+        self.lane.job_failed.connect(self.on_job_failed)
+        self.lane.render_finished.connect(self.on_render_finished)
+        # web page -> scheduler entry of the job it is running
+        self.running_jobs = {}
+        # Job.key() -> request ids of renders waiting on that job, for every job that is queued or running.
+        # An identical job that comes in meanwhile is coalesced into the one already there.
+        self.in_flight = {}
+        # request id -> Job.key() of the job that answers it
+        self.render_keys = {}
+        self.coalesced = 0
+        # (job, store id) of the cursor jobs waiting for room in their queue, and Job.key() of the ones queued or running
+        self.cursors = deque()
+        self.expanding = set()
+        self.result_cache = ResultCache(RESULT_CACHE_TTL_SECONDS, RESULT_CACHE_MAX_BYTES) if RESULT_CACHE_TTL_SECONDS else None
+        # Only the process that owns the queue persists it. Workers and the debug window don't.
+        self.job_store = None
+        # Delayed jobs and cron fires share one timer
+        self.timer_heap = TimerHeap(self)
+        self.cron = None
+        self.rate_limiter = RateLimiter.get()
+        # Pending call to distribute_jobs for jobs held back by the rate limiter
+        self.rate_wake = None
+        self.retry_policy = RetryPolicy()
+        self.saturated = False
+        self.page_factory = page_factory
+        self.process = psutil.Process(os.getpid())
+        # Pages shown in the debug window are never recycled
+        self.recycle_pages = not debug_file
+        # Pages still to drain while the process RSS is over PROCESS_MAX_RSS_MB, None while it is not
+        self.memory_drain = None
 
         for _ in range(self.instances):
-            wp = WebPageCustom(self)
-            wp.job_finished.connect(self.distribute_jobs)
-            wp.new_job_received.connect(self.queue_new_job)
-            self.web_pages.append(wp)
+            self.web_pages.append(self.create_page())
+
+        self.memory_timer = QTimer(self)
+        self.memory_timer.setTimerType(Qt.VeryCoarseTimer)
+        self.memory_timer.timeout.connect(self.check_memory)
+        self.memory_timer.start(MEMORY_CHECK_SECONDS * 1000)
 
         if debug_file:
             # When in debugging mode we only load and single instance and show it to the user
@@ -55,93 +110,383 @@ class PageCoordinator(QObject):
             self.main_window.setWindowTitle("SpiderJuice Debug Window")
             self.main_window.show()
             self.queue_new_job(Job(file=debug_file))
-        else:
-            self.parse_local_jobs()
-            self.recalculate_timer = QTimer(self)
-            self.recalculate_timer.timeout.connect(self.shedule_for_next_15_min)
-            self.recalculate_timer.setTimerType(Qt.VeryCoarseTimer)
-            self.recalculate_timer.start(self.job_recalculate_minutes * 60 * 1000)
-            self.shedule_for_next_15_min()
-
-    def parse_local_jobs(self):
-        logger.info('Parsing Local Jobs')
-        for file in glob.glob("{base}/jobs/*.js".format(base=BASE_PROJECT_DIR)):
-            with open(file, encoding='utf-8', mode='r') as job_file:
-                job_conf = {}
-                while True:
-                    line = job_file.readline().strip()
-                    if not line.startswith(self.marker):
-                        break
-
-                    line = line.split(self.marker, 1)[1]
-                    if ':' not in line:
-                        break
-
-                    key, value = line.split(':', 1)
-                    job_conf[key.strip()] = value.strip()
-
-                if self.schedule_key in job_conf:
-                    job_conf['file'] = file
-                    self.job_list.append(Job(**job_conf))
+        elif local_jobs:
+            if JOB_STORE_PATH:
+                self.job_store = JobStore(JOB_STORE_PATH, self)
+                self.recover_jobs()
+            self.cron = CronScheduler(self.timer_heap, self.job_store, self)
+            self.cron.fired.connect(self.queue_new_job)
+            self.cron.caught_up.connect(self.queue_catch_up_job)
+            self.job_registry.scheduled_job_changed.connect(self.cron.add_job)
+            self.job_registry.scheduled_job_removed.connect(self.cron.remove_job)
+            # Workers leave these to the supervisor, whose pages stand for theirs
+            QUEUE_DEPTH.set_function(self.queue_depths)
+            PAGES.set_function(self.page_states)
+            LANE_RUNNING.set_function(lambda: {(): len(self.lane)})
+
+        # Loads every job file. In the process that owns the cron this also schedules them.
+        self.job_registry.scan()
+
+    def create_page(self):
+        wp = self.page_factory(self, job_registry=self.job_registry)
+        wp.job_finished.connect(lambda: self.on_job_finished(wp))
+        wp.new_job_received.connect(self.queue_new_job)
+        wp.new_jobs_received.connect(self.queue_new_jobs)
+        wp.job_failed.connect(self.on_job_failed)
+        wp.render_finished.connect(self.on_render_finished)
+        return wp
+
+    def retire_page(self, web_page):
+        index = self.web_pages.index(web_page)
+        logger.info('Retiring page {} after {} jobs and {:.1f}MB of process RSS growth during them'.format(
+            web_page.id, web_page.jobs_done, web_page.process_rss_growth / 1024 / 1024))
+        web_page.job_finished.disconnect()
+        web_page.new_job_received.disconnect()
+        web_page.new_jobs_received.disconnect()
+        web_page.job_failed.disconnect()
+        web_page.render_finished.disconnect()
+        web_page.deleteLater()
+        QWebSettings.clearMemoryCaches()
+        self.web_pages[index] = self.create_page()
+
+    def release_page(self, web_page):
+        entry = self.running_jobs.pop(web_page, None)
+        if entry:
+            self.release_entry(entry)
+        if self.recycle_pages and web_page.should_retire():
+            self.retire_page(web_page)
+
+    def release_entry(self, entry):
+        self.in_flight.pop(entry.job.key(), None)
+        self.expanding.discard(entry.job.key())
+        if entry.token is not None and self.job_store:
+            self.job_store.remove(entry.token)
+
+    @pyqtSlot()
+    def check_memory(self):
+        if not self.recycle_pages or not PROCESS_MAX_RSS_MB:
+            return
+
+        rss = self.process.memory_info().rss
+        if self.memory_drain is None:
+            if rss < PROCESS_MAX_RSS_MB * 1024 * 1024:
+                return
+            logger.warning('Process RSS {:.1f}MB is over the limit. Draining the pages one at a time'.format(
+                rss / 1024 / 1024))
+            # Each of the pages there are now is drained once
+            self.memory_drain = set(wp for wp in self.web_pages if wp.recyclable)
+        elif rss < PROCESS_RESUME_RSS_MB * 1024 * 1024:
+            logger.info('Process RSS {:.1f}MB is back under {}MB'.format(rss / 1024 / 1024, PROCESS_RESUME_RSS_MB))
+            self.memory_drain = None
+            return
+
+        # Drain one page per check so that we don't lose all the capacity at once.
+        # The page whose jobs saw the process grow the most is the most likely to be holding on to the leaked memory.
+        candidates = [wp for wp in self.web_pages if wp in self.memory_drain and not wp.draining]
+        if not candidates:
+            return
+        web_page = max(candidates, key=lambda wp: (wp.process_rss_growth, wp.jobs_done))
+        # Pages replaced for another reason meanwhile are left out too
+        self.memory_drain = set(candidates) - {web_page}
+        logger.info('Draining page {} for the process RSS of {:.1f}MB'.format(web_page.id, rss / 1024 / 1024))
+        if not self.memory_drain:
+            logger.warning('Every page is being replaced. No more are drained until the process RSS is under '
+                           '{}MB'.format(PROCESS_RESUME_RSS_MB))
+        web_page.draining = True
+        if not web_page.current_job:
+            self.retire_page(web_page)
+
+    def recover_jobs(self):
+        recovered = self.job_store.recover()
+        if recovered:
+            logger.info('Recovered {} jobs from the job store'.format(len(recovered)))
+
+        now = time()
+        for job_id, job, due in recovered:
+            if due <= now:
+                # Through push_job so that identical jobs loaded or fired later are coalesced into it
+                self.push_job(job, job_id)
+            else:
+                self.arm_delayed_job(job, job_id, due - now)
+        self.distribute_jobs()
 
     @pyqtSlot(Job)
-    def queue_new_job(self, job):
-        try:
-            self.job_queue.put(job, block=False)
-            self.distribute_jobs()
-        except queue.Full as e:
-            logger.exception('The queue is full. Ignored Job {}, {}'.format(job, e))
+    def queue_new_job(self, job, store_id=None):
+        self.push_job(job, store_id)
+        self.distribute_jobs()
+
+    @pyqtSlot(Job)
+    def queue_catch_up_job(self, job):
+        """A missed cron fire run under 'fire_all'. It runs even though the fire before it is still in flight."""
+        self.push_job(job, coalesce=False)
+        self.distribute_jobs()
+
+    def push_job(self, job, store_id=None, coalesce=True):
+        key = job.key()
+        if job.request_id:
+            self.render_keys[job.request_id] = key
+            if self.result_cache:
+                payload = self.result_cache.get(key)
+                if payload is not None:
+                    self.render_keys.pop(job.request_id)
+                    self.render_finished.emit(job.request_id, True, payload)
+                    return
+
+        waiting = self.in_flight.get(key)
+        if waiting is not None and coalesce:
+            self.coalesced += 1
+            logger.debug('Coalesced job {}'.format(job))
+            if job.request_id:
+                waiting.append(job.request_id)
+            if store_id is not None and self.job_store:
+                self.job_store.remove(store_id)
+            return
+        if waiting is None:
+            self.in_flight[key] = []
+
+        # Nobody would be waiting for a render request after a restart, so those are not persisted
+        if store_id is None and self.job_store and not job.request_id:
+            store_id = self.job_store.add(job)
+        self.enqueue(job, store_id)
+        if self.is_saturated() and not self.saturated:
+            self.saturated = True
+            logger.warning('The queue is saturated with {} jobs. Stats: {}'.format(len(self.job_queue), self.job_queue.stats()))
+            self.capacity_changed.emit(False)
+
+    def enqueue(self, job, store_id):
+        if job.cursor:
+            # Queued by expand_cursors once there is room for the jobs it fans out to
+            self.cursors.append((job, store_id))
+        else:
+            self.queue_for(job).push(job, store_id)
+
+    def expand_cursors(self):
+        """Queues the cursor jobs held back by enqueue, in order, while their queue has room for a page of fan out"""
+        while self.cursors and len(self.expanding) < FAN_OUT_MAX_CURSORS:
+            job, store_id = self.cursors[0]
+            queue = self.queue_for(job)
+            if not queue.empty() and len(queue) + FAN_OUT_CURSOR_HEADROOM > queue.max_size:
+                break
+            self.cursors.popleft()
+            self.expanding.add(job.key())
+            queue.push(job, store_id)
+
+    @pyqtSlot(list)
+    def queue_new_jobs(self, jobs):
+        """Jobs a job loaded at once with SjCtrl.loadMany. They are distributed once."""
+        for job in jobs:
+            self.push_job(job)
+        self.distribute_jobs()
+
+    @pyqtSlot(list)
+    def add_jobs_to_queue(self, jobs):
+        """Queues a batch of jobs and distributes them once. Safe to call from another thread."""
+        self.queue_new_jobs(jobs)
+        self.batch_queued.emit(len(jobs))
+
+    @pyqtSlot(int)
+    def cancel_render(self, request_id):
+        """The client went away or its deadline passed. Safe to call from another thread."""
+        key = self.render_keys.get(request_id)
+        waiting = self.in_flight.get(key)
+        if waiting:
+            # Other clients are waiting on the same job, so it carries on for them
+            if request_id in waiting:
+                waiting.remove(request_id)
+                self.render_keys.pop(request_id)
+            return
+        self.render_keys.pop(request_id, None)
+
+        removed = self.job_queue.remove(lambda entry: entry.job.request_id == request_id) or \
+            self.lane_queue.remove(lambda entry: entry.job.request_id == request_id)
+        if removed:
+            logger.info('Cancelled queued render request {}'.format(request_id))
+            self.in_flight.pop(key, None)
+            self.expanding.discard(key)
+            return
+
+        for web_page, entry in list(self.running_jobs.items()):
+            if entry.job.request_id == request_id:
+                logger.info('Cancelling running render request {} on page {}'.format(request_id, web_page.id))
+                web_page.cancel_job()
+                return
+        self.lane.cancel(request_id)
+
+    @pyqtSlot(int, bool, str)
+    def on_render_finished(self, request_id, ok, payload):
+        key = self.render_keys.pop(request_id, None)
+        if ok and self.result_cache and key is not None:
+            self.result_cache.put(key, payload)
+
+        self.render_finished.emit(request_id, ok, payload)
+        for waiting_id in self.in_flight.get(key) or []:
+            self.render_keys.pop(waiting_id, None)
+            self.render_finished.emit(waiting_id, ok, payload)
+
+    def cache_stats(self):
+        stats = self.result_cache.stats() if self.result_cache else {}
+        stats['coalesced'] = self.coalesced
+        stats['http'] = SharedCache.stats()
+        stats['blocked'] = BlockStats.stats()
+        return stats
+
+    @pyqtSlot(Job, str, int)
+    def on_job_failed(self, job, cause, retry_after_sec):
+        decision = self.retry_policy.decide(job, cause, retry_after_sec)
+        if decision.retry:
+            retry_job = job.get_retry_job()
+            logger.info('Retrying ({}) after {:.0f}sec: {}'.format(cause, decision.delay, retry_job))
+            self.queue_delayed_job(retry_job, decision.delay)
+            JOB_RETRIES.labels(cause).inc()
+            return
+
+        JOB_GIVEN_UP.labels(cause).inc()
+        logger.error('{} ({}): {}'.format(decision.reason, cause, job))
+        if self.job_store:
+            self.job_store.add_dead_job(job, cause)
+
+    @pyqtSlot(Job, int)
+    def queue_delayed_job(self, job, delay_sec):
+        store_id = None
+        if self.job_store:
+            store_id = self.job_store.add(job, due=time() + delay_sec)
+        self.arm_delayed_job(job, store_id, delay_sec)
+
+    def arm_delayed_job(self, job, store_id, delay_sec):
+        self.timer_heap.call_later(delay_sec, lambda: self.queue_new_job(job, store_id))
+
+    def queue_for(self, job):
+        return self.lane_queue if job.mode in LANE_MODES else self.job_queue
+
+    def is_saturated(self):
+        return self.job_queue.is_saturated() or self.lane_queue.is_saturated()
+
+    def has_capacity(self):
+        return not self.is_saturated()
+
+    def host_allowed(self, host):
+        if not host:
+            return True
+        running = sum(1 for entry in self.running_jobs.values() if entry.host == host)
+        if running >= HOST_MAX_PAGES.get(host, MAX_PAGES_PER_HOST):
+            return False
+        return self.rate_allowed(host)
+
+    def lane_host_allowed(self, host):
+        if not host:
+            return True
+        if self.lane.hosts[host] >= LANE_MAX_PER_HOST:
+            return False
+        return self.rate_allowed(host)
+
+    def rate_allowed(self, host):
+        wait = self.rate_limiter.wait_time(host)
+        if wait:
+            self.wake_after(wait)
+            return False
+        return True
+
+    def wake_after(self, wait):
+        """Comes back to distribute jobs once the earliest rate limited host has a token"""
+        now = time()
+        if self.rate_wake and not self.rate_wake.cancelled and now < self.rate_wake.when <= now + wait:
+            return
+        if self.rate_wake:
+            self.rate_wake.cancel()
+        self.rate_wake = self.timer_heap.call_later(wait, self.distribute_jobs)
+
+    def on_job_finished(self, web_page):
+        self.release_page(web_page)
+        self.distribute_jobs()
+
+    @pyqtSlot(object)
+    def on_lane_job_finished(self, entry):
+        self.release_entry(entry)
+        self.distribute_jobs()
+
+    def dispatched(self, entry):
+        queue = 'lane' if entry.job.mode in LANE_MODES else 'page'
+        QUEUE_WAIT.labels(queue, entry.priority).observe(monotonic() - entry.queued_at)
+        if entry.host:
+            self.rate_limiter.take(entry.host)
+        self.retry_policy.budget.dispatched()
+        if entry.token is not None and self.job_store:
+            self.job_store.mark_running(entry.token)
 
     @pyqtSlot()
     def distribute_jobs(self):
+        self.expand_cursors()
         self.check_no_work()
-        if self.job_queue.empty():
-            return
+
+        while not self.lane_queue.empty() and self.lane.has_capacity():
+            entry = self.lane_queue.pop(self.lane_host_allowed)
+            if entry is None:
+                break
+            self.dispatched(entry)
+            self.lane.run(entry)
 
         for web_page in self.web_pages:
             if self.job_queue.empty():
-                return
+                break
 
             if not web_page.is_busy():
-                job = self.job_queue.get(block=False)
-                web_page.load_job(job)
+                entry = self.job_queue.pop(self.host_allowed)
+                if entry is None:
+                    # Everything left in the queue is waiting on a host that is at its page limit
+                    break
+                self.running_jobs[web_page] = entry
+                self.dispatched(entry)
+                web_page.load_job(entry.job, monotonic() - entry.queued_at)
+
+        if self.saturated and not self.is_saturated():
+            self.saturated = False
+            logger.info('The queue is no longer saturated')
+            self.capacity_changed.emit(True)
+
+    def queue_depths(self):
+        """For the metrics, read from the server thread"""
+        depths = {}
+        for queue, scheduler in (('page', self.job_queue), ('lane', self.lane_queue)):
+            for priority, host_queues in scheduler.classes.items():
+                depths[(queue, priority)] = host_queues.size
+        return depths
+
+    def page_states(self):
+        busy = sum(1 for web_page in list(self.web_pages) if web_page.is_busy())
+        return {('busy',): busy, ('idle',): len(self.web_pages) - busy}
+
+    def queue_stats(self):
+        return dict(self.job_queue.stats(), lane=self.lane_queue.stats(), cursors=len(self.cursors))
 
     def check_no_work(self):
-        if not self.job_queue.empty():
+        if not self.job_queue.empty() or not self.lane_queue.empty() or len(self.lane) or self.cursors:
             return
         for web_page in self.web_pages:
             if web_page.is_busy():
                 return
 
         # Means that nothing is running
-        proc = psutil.Process(os.getpid())
+        logger.info('Queue wait stats: {}'.format(self.queue_stats()))
+        logger.info('Cache stats: {}'.format(self.cache_stats()))
+        logger.info('Lane stats: {}'.format(self.lane.stats()))
+        if ProxyPool.instance:
+            logger.info('Proxy stats: {}'.format(ProxyPool.instance.stats()))
+        logger.info('Rate limited: {}'.format(self.rate_limiter.stats()))
+        logger.info('Retry stats: {}'.format(self.retry_policy.stats()))
+        if ResultSpool.instance:
+            logger.info('Result spool: {}'.format(ResultSpool.instance.stats()))
+        proc = self.process
         logger.info('Running Garbage Collector. {}: {}'.format(proc.memory_percent(), proc.memory_info()))
         gc.collect()
         logger.info('After Garbage Collector. {}: {}'.format(proc.memory_percent(), proc.memory_info()))
 
-    @pyqtSlot()
-    def shedule_for_next_15_min(self):
-        now = datetime.now()
-        for job in self.job_list:
-            if job.schedule == 'once':
-                self.queue_new_job(job)
-                continue
-
-            cron_iter = croniter(job.schedule, datetime.now())
-            for _ in range(self.job_limit):
-                next_job_time = cron_iter.get_next(datetime)
-                second_till_next_job = (next_job_time - now).total_seconds()
-                job_recalculate_seconds = self.job_recalculate_minutes * 60
-                if second_till_next_job <= job_recalculate_seconds:
-                    milliseconds = second_till_next_job * 1000
-                    QTimer.singleShot(milliseconds, Qt.VeryCoarseTimer, lambda: self.queue_new_job(job))
-                else:
-                    break
-
     @pyqtSlot(dict)
     def add_job_to_queue(self, data):
         """Safe to call from another thread"""
         logger.debug('Recieved data: {}'.format(data))
-        # job_queue.
-        # url = data.get('start_url')
-        # if url:
+        try:
+            job = Job.from_request(data)
+        except ValueError as e:
+            logger.error('Invalid job request {}: {}'.format(data, e))
+            return
+        self.queue_new_job(job)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from functools import lru_cache
+import random
+from time import monotonic
+
+from PyQt5.QtNetwork import QNetworkProxy
+
+from rate_limiter import RateLimiter, proxy_key
+from settings import PROXY_POOL, PROXY_POOL_MAX_JOBS, PROXY_LATENCY_ALPHA, PROXY_CIRCUIT_FAILURES, \
+    PROXY_CIRCUIT_ERROR_RATE, PROXY_CIRCUIT_OPEN_SECONDS
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def parse_proxy(proxy_string, auth_string=None):
+    """'host:port' and 'user:password' to a QNetworkProxy. Raises ValueError for invalid strings."""
+    pr = proxy_string.split(':', 1)
+    if len(pr) != 2 or not pr[0] or not pr[1].isdigit() or not int(pr[1]):
+        raise ValueError('Invalid proxy string {}'.format(proxy_string))
+    host = pr[0]
+    port = int(pr[1])
+
+    if auth_string:
+        aus = auth_string.split(':', 1)
+        if len(aus) != 2:
+            raise ValueError('Invalid proxy auth for {}'.format(proxy_string))
+        return QNetworkProxy(QNetworkProxy.HttpProxy, host, port, aus[0], aus[1])
+    return QNetworkProxy(QNetworkProxy.HttpProxy, host, port)
+
+
+class UpstreamProxy(object):
+    """One proxy of the pool and what we know about its health.
+
+    Latency and error rate are moving averages over the requests sent through it. After PROXY_CIRCUIT_FAILURES
+    failures in a row, or once the error rate goes over PROXY_CIRCUIT_ERROR_RATE, the circuit opens and the proxy
+    gets no new jobs for PROXY_CIRCUIT_OPEN_SECONDS. Then a single job is let through to probe it.
+    """
+    min_samples = 10
+
+    def __init__(self, proxy, auth=None, is_crawlera=False, max_jobs=PROXY_POOL_MAX_JOBS):
+        self.name = proxy
+        self.network_proxy = parse_proxy(proxy, auth)
+        self.is_crawlera = is_crawlera
+        self.max_jobs = max_jobs
+        self.jobs = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def available(self, now):
+        if self.is_open():
+            # Half open. One job at a time probes the proxy.
+            return now - self.opened_at >= PROXY_CIRCUIT_OPEN_SECONDS and not self.probing and not self.jobs
+        return self.jobs < self.max_jobs
+
+    def weight(self):
+        # Fast, reliable and idle proxies get more jobs
+        free = 1.0 - self.jobs / self.max_jobs if self.max_jobs else 1.0
+        return max(free, 0.05) * (1.0 - self.error_rate) ** 2 / (self.latency + 0.1)
+
+    def request_finished(self, latency, ok):
+        self.requests += 1
+        if self.requests == 1:
+            self.latency = latency
+        else:
+            self.latency += PROXY_LATENCY_ALPHA * (latency - self.latency)
+        self.error_rate += PROXY_LATENCY_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+
+        if ok:
+            self.failures = 0
+            if self.is_open():
+                logger.info('Proxy {} is healthy again'.format(self.name))
+                self.opened_at = None
+                self.probing = False
+                self.error_rate = 0.0
+            return
+
+        self.failures += 1
+        if self.is_open():
+            if self.probing:
+                # The probe failed, wait another PROXY_CIRCUIT_OPEN_SECONDS
+                self.opened_at = monotonic()
+                self.probing = False
+        elif self.failures >= PROXY_CIRCUIT_FAILURES or \
+                (self.requests >= self.min_samples and self.error_rate >= PROXY_CIRCUIT_ERROR_RATE):
+            logger.warning('Proxy {} is failing, {} failures in a row, error rate {:.2f}. Not using it for {}sec'.format(
+                self.name, self.failures, self.error_rate, PROXY_CIRCUIT_OPEN_SECONDS))
+            self.opened_at = monotonic()
+
+    def stats(self):
+        return {'jobs': self.jobs, 'in_flight': self.in_flight, 'requests': self.requests,
+                'latency': round(self.latency, 3), 'error_rate': round(self.error_rate, 3), 'open': self.is_open()}
+
+
+class ProxyPool(object):
+    """The proxies of settings.PROXY_POOL, shared by all the pages of the process.
+
+    A job whose proxy is ProxyPool.name is given one proxy when it starts and keeps it until it ends, so that the
+    site sees one client per job. Proxies are picked at random weighted by their health and load.
+    """
+    name = 'pool'
+    instance = None
+
+    @staticmethod
+    def get():
+        if ProxyPool.instance is None:
+            ProxyPool.instance = ProxyPool(PROXY_POOL)
+        return ProxyPool.instance
+
+    def __init__(self, proxy_confs):
+        self.proxies = []
+        for proxy_conf in proxy_confs:
+            try:
+                self.proxies.append(UpstreamProxy(**proxy_conf))
+            except (TypeError, ValueError) as e:
+                logger.error('Invalid proxy pool entry {}: {}'.format(proxy_conf, e))
+
+    def acquire(self):
+        if not self.proxies:
+            logger.error('A job asked for a proxy from the pool but PROXY_POOL is empty')
+            return None
+
+        now = monotonic()
+        rate_limiter = RateLimiter.get()
+        candidates = [proxy for proxy in self.proxies
+                      if proxy.available(now) and not rate_limiter.wait_time(proxy_key(proxy.name))]
+        if candidates:
+            proxy = self.weighted_choice(candidates)
+        else:
+            # Everything is busy or failing. Overload the best closed proxy, or probe the one that failed first.
+            closed = [proxy for proxy in self.proxies if not proxy.is_open()]
+            if closed:
+                proxy = max(closed, key=lambda p: p.weight())
+            else:
+                proxy = min(self.proxies, key=lambda p: p.opened_at)
+            logger.warning('No proxy available in the pool, using {}'.format(proxy.name))
+
+        if proxy.is_open():
+            proxy.probing = True
+        proxy.jobs += 1
+        return proxy
+
+    @staticmethod
+    def weighted_choice(proxies):
+        weights = [proxy.weight() for proxy in proxies]
+        point = random.uniform(0, sum(weights))
+        for proxy, weight in zip(proxies, weights):
+            point -= weight
+            if point <= 0:
+                return proxy
+        return proxies[-1]
+
+    def release(self, proxy):
+        proxy.jobs -= 1
+        if proxy.is_open():
+            # A probe job that made no request through the proxy
+            proxy.probing = False
+
+    def stats(self):
+        return {proxy.name: proxy.stats() for proxy in self.proxies}
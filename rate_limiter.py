@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+from time import monotonic
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from settings import DEFAULT_HOST_RATE_LIMIT, HOST_RATE_LIMITS, DEFAULT_PROXY_RATE_LIMIT, PROXY_RATE_LIMITS, \
+    RATE_LIMIT_BACKOFF, RATE_LIMIT_MIN_FRACTION, RATE_LIMIT_RECOVERY_SECONDS
+
+import logging
+logger = logging.getLogger(__name__)
+
+PROXY_PREFIX = 'proxy:'
+
+
+def proxy_key(name):
+    return PROXY_PREFIX + name
+
+
+class TokenBucket(object):
+    """rate requests per second with bursts of up to burst requests.
+
+    Requests that can't wait, like the subrequests of a page, are charged anyway and leave the bucket in debt, which
+    holds back the next jobs for the host instead. Throttling multiplies the rate by RATE_LIMIT_BACKOFF, down to
+    RATE_LIMIT_MIN_FRACTION of the configured rate, and empties the bucket. The rate then climbs back to the configured
+    one over RATE_LIMIT_RECOVERY_SECONDS.
+    """
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = monotonic()
+        self.paused_until = 0
+
+    def refill(self, now):
+        elapsed = now - self.updated_at
+        if elapsed <= 0:
+            return
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * elapsed / RATE_LIMIT_RECOVERY_SECONDS)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now):
+        self.refill(now)
+        wait = self.paused_until - now
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return max(wait, 0)
+
+    def charge(self, now, requests=1):
+        self.refill(now)
+        self.tokens = max(self.tokens - requests, -self.burst)
+
+    def throttle(self, now, retry_after_sec=0):
+        self.refill(now)
+        self.rate = max(self.max_rate * RATE_LIMIT_MIN_FRACTION, self.rate * RATE_LIMIT_BACKOFF)
+        self.tokens = min(self.tokens, 0)
+        if retry_after_sec:
+            self.paused_until = max(self.paused_until, now + retry_after_sec)
+
+    def is_idle(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst and self.rate >= self.max_rate and self.paused_until <= now
+
+
+class RateLimiter(QObject):
+    """Token buckets per host and per proxy, shared by all the pages of the process.
+
+    Limits come from HOST_RATE_LIMITS and PROXY_RATE_LIMITS, with DEFAULT_HOST_RATE_LIMIT and
+    DEFAULT_PROXY_RATE_LIMIT for everything else. A limit of None means unlimited.
+    """
+    # key and Retry-After in seconds, 0 when there was none. Lets workers tell the supervisor.
+    throttled = pyqtSignal(str, float)
+    max_buckets = 10000
+    instance = None
+
+    @staticmethod
+    def get():
+        if RateLimiter.instance is None:
+            RateLimiter.instance = RateLimiter()
+        return RateLimiter.instance
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # key -> TokenBucket, or None for unlimited keys
+        self.buckets = {}
+        # key -> requests charged since the last report. Only kept by workers, see report_charges.
+        self.charges = None
+
+    def bucket(self, key):
+        try:
+            return self.buckets[key]
+        except KeyError:
+            pass
+
+        if len(self.buckets) >= self.max_buckets:
+            self.prune()
+        if key.startswith(PROXY_PREFIX):
+            limit = PROXY_RATE_LIMITS.get(key[len(PROXY_PREFIX):], DEFAULT_PROXY_RATE_LIMIT)
+        else:
+            limit = HOST_RATE_LIMITS.get(key, DEFAULT_HOST_RATE_LIMIT)
+        bucket = TokenBucket(*limit) if limit else None
+        self.buckets[key] = bucket
+        return bucket
+
+    def prune(self):
+        now = monotonic()
+        for key, bucket in list(self.buckets.items()):
+            if bucket is None or bucket.is_idle(now):
+                del self.buckets[key]
+
+    def wait_time(self, key):
+        """Seconds until a request for key is allowed"""
+        bucket = self.bucket(key)
+        return bucket.wait_time(monotonic()) if bucket else 0
+
+    def take(self, key, requests=1):
+        bucket = self.bucket(key)
+        if bucket:
+            bucket.charge(monotonic(), requests)
+            if self.charges is not None:
+                self.charges[key] += requests
+
+    def report_charges(self):
+        """Starts keeping the charges for a supervisor, whose buckets decide when jobs are dispatched"""
+        self.charges = Counter()
+
+    def take_charges(self):
+        """{key: requests} charged since the last call"""
+        charges, self.charges = self.charges, Counter()
+        return dict(charges)
+
+    def throttle(self, key, retry_after_sec=0):
+        bucket = self.bucket(key)
+        if bucket is None:
+            return
+        bucket.throttle(monotonic(), retry_after_sec)
+        logger.warning('Throttled {} to {:.2f} requests/sec{}'.format(
+            key, bucket.rate, ', paused for {}sec'.format(retry_after_sec) if retry_after_sec else ''))
+        self.throttled.emit(key, retry_after_sec)
+
+    def stats(self):
+        """The buckets that are currently held back"""
+        now = monotonic()
+        return {key: {'rate': round(bucket.rate, 3), 'tokens': round(bucket.tokens, 1),
+                      'paused': round(max(bucket.paused_until - now, 0), 1)}
+                for key, bucket in self.buckets.items() if bucket and not bucket.is_idle(now)}
@@ -1,11 +1,27 @@
 import asyncio
+from itertools import count
+import json
 import threading
 from aiohttp import web
-from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
+from job import Job
+from metrics import REGISTRY
+from settings import INGEST_BATCH_SIZE, INGEST_MAX_PENDING_BATCHES, INGEST_BACKPRESSURE_TIMEOUT_SECONDS, \
+    INGEST_MAX_ERRORS, RENDER_DEFAULT_DEADLINE_SECONDS, RENDER_MAX_DEADLINE_SECONDS
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 class RequestServer(QObject):
     job_request = pyqtSignal(dict)
+    # A list of validated Jobs. Connect it to PageCoordinator.add_jobs_to_queue
+    job_batch = pyqtSignal(list)
+    # A job with a request_id. Somebody is waiting for it, connect it to PageCoordinator.queue_new_job
+    render_request = pyqtSignal(Job)
+    # The request id of a render nobody is waiting for anymore. Connect it to PageCoordinator.cancel_render
+    render_cancelled = pyqtSignal(int)
+    render_outputs = ('result', 'html', 'both')
 
     def __init__(self, parent=None, port=8080):
         super().__init__(parent)
@@ -18,16 +34,195 @@ class RequestServer(QObject):
         self.server = None
         self.started = False
 
+        # Backpressure for the ingestion endpoint. Both are only touched from the event loop thread.
+        # has_capacity mirrors PageCoordinator.capacity_changed and pending_batches bounds the batches that are
+        # emitted but not yet queued by the Qt thread.
+        self.has_capacity = None
+        self.pending_batches = None
+
+        # request id -> future resolved with (ok, payload) by complete_render. Only touched from the event loop thread.
+        self.pending_renders = {}
+        self.render_ids = count(1)
+
     @asyncio.coroutine
     def handle(self, request):
         data = yield from request.json()
         self.job_request.emit(data)
         return web.Response()
 
+    @asyncio.coroutine
+    def handle_jobs(self, request):
+        """Takes a stream of newline delimited job objects and queues them in batches.
+
+        The body is read only as fast as the queue accepts jobs, so a large submission is never held in memory.
+        When the queue stays saturated for INGEST_BACKPRESSURE_TIMEOUT_SECONDS the request ends with a 429 and
+        the number of jobs that were accepted, so that the client can resume from there.
+        """
+        accepted = 0
+        errors = []
+        batch = []
+        line_number = 0
+
+        while True:
+            try:
+                line = yield from request.content.readline()
+            except ValueError as e:
+                # The line is longer than the stream reader allows
+                return self.json_response({'accepted': accepted, 'errors': errors,
+                                           'error': 'Line {}: {}'.format(line_number + 1, e)}, status=400)
+            if not line:
+                break
+
+            line_number += 1
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                batch.append(Job.from_request(json.loads(line.decode('utf-8'))))
+            except (ValueError, UnicodeDecodeError) as e:
+                if len(errors) < INGEST_MAX_ERRORS:
+                    errors.append({'line': line_number, 'error': str(e)})
+                continue
+
+            if len(batch) >= INGEST_BATCH_SIZE:
+                submitted = yield from self.submit_batch(batch)
+                if not submitted:
+                    return self.too_busy(accepted, errors)
+                accepted += len(batch)
+                batch = []
+
+        if batch:
+            submitted = yield from self.submit_batch(batch)
+            if not submitted:
+                return self.too_busy(accepted, errors)
+            accepted += len(batch)
+
+        return self.json_response({'accepted': accepted, 'errors': errors})
+
+    @asyncio.coroutine
+    def submit_batch(self, batch):
+        try:
+            yield from asyncio.wait_for(self.wait_for_capacity(), INGEST_BACKPRESSURE_TIMEOUT_SECONDS, loop=self.loop)
+        except asyncio.TimeoutError:
+            return False
+        self.job_batch.emit(batch)
+        return True
+
+    @asyncio.coroutine
+    def wait_for_capacity(self):
+        yield from self.pending_batches.acquire()
+        try:
+            yield from self.has_capacity.wait()
+        except asyncio.CancelledError:
+            self.pending_batches.release()
+            raise
+
+    def too_busy(self, accepted, errors):
+        logger.warning('Job queue saturated. Rejecting the rest of the submission after {} jobs'.format(accepted))
+        return self.json_response({'accepted': accepted, 'errors': errors, 'error': 'Job queue is full'}, status=429,
+                                  headers={'Retry-After': str(INGEST_BACKPRESSURE_TIMEOUT_SECONDS)})
+
+    @staticmethod
+    def json_response(data, status=200, headers=None):
+        return web.Response(body=json.dumps(data).encode('utf-8'), status=status, headers=headers,
+                            content_type='application/json')
+
+    @asyncio.coroutine
+    def handle_metrics(self, request):
+        """Prometheus text format. Only reads what the Qt thread writes, so it never waits on it."""
+        return web.Response(body=REGISTRY.exposition().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    @asyncio.coroutine
+    def handle_render(self, request):
+        """Runs a job and answers with what it produced.
+
+        The body is a job object with two optional extra keys: 'deadline' in seconds and 'return', one of
+        'result' (what the job passed to SjCtrl.setResult), 'html' (the page html when the job was done) or 'both'.
+        If the client goes away or the deadline passes the job is cancelled and its page is freed.
+        """
+        try:
+            data = yield from request.json()
+        except ValueError:
+            return self.json_response({'error': 'The body must be a JSON object'}, status=400)
+        if not isinstance(data, dict):
+            return self.json_response({'error': 'The body must be a JSON object'}, status=400)
+
+        data = dict(data)
+        deadline = data.pop('deadline', RENDER_DEFAULT_DEADLINE_SECONDS)
+        output = data.pop('return', 'result')
+        if not isinstance(deadline, (int, float)) or deadline <= 0:
+            return self.json_response({'error': 'Invalid deadline {}'.format(deadline)}, status=400)
+        if output not in self.render_outputs:
+            return self.json_response({'error': 'return must be one of {}'.format(', '.join(self.render_outputs))},
+                                      status=400)
+
+        try:
+            job = Job.from_request(data)
+        except ValueError as e:
+            return self.json_response({'error': str(e)}, status=400)
+
+        request_id = next(self.render_ids)
+        future = asyncio.Future(loop=self.loop)
+        self.pending_renders[request_id] = future
+        self.render_request.emit(Job(**dict(job.dict(), request_id=request_id)))
+        try:
+            ok, payload = yield from asyncio.wait_for(future, min(deadline, RENDER_MAX_DEADLINE_SECONDS), loop=self.loop)
+        except asyncio.TimeoutError:
+            self.render_cancelled.emit(request_id)
+            return self.json_response({'error': 'Deadline of {}sec passed'.format(deadline)}, status=504)
+        except asyncio.CancelledError:
+            # The client disconnected
+            self.render_cancelled.emit(request_id)
+            raise
+        finally:
+            self.pending_renders.pop(request_id, None)
+
+        if not ok:
+            return web.Response(body=payload.encode('utf-8'), status=502, content_type='application/json')
+
+        rendered = json.loads(payload)
+        if output == 'html':
+            return web.Response(text=rendered['html'], content_type='text/html')
+        if output == 'result':
+            rendered.pop('html', None)
+        return self.json_response(rendered)
+
+    @pyqtSlot(int, bool, str)
+    def complete_render(self, request_id, ok, payload):
+        """Safe to call from another thread"""
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.resolve_render, request_id, ok, payload)
+
+    def resolve_render(self, request_id, ok, payload):
+        future = self.pending_renders.get(request_id)
+        if future and not future.done():
+            future.set_result((ok, payload))
+
+    @pyqtSlot(bool)
+    def set_capacity(self, has_capacity):
+        """Safe to call from another thread"""
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.has_capacity.set if has_capacity else self.has_capacity.clear)
+
+    @pyqtSlot(int)
+    def batch_done(self, count):
+        """Safe to call from another thread"""
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.pending_batches.release)
+
     @asyncio.coroutine
     def init(self, loop):
+        self.has_capacity = asyncio.Event(loop=loop)
+        self.has_capacity.set()
+        self.pending_batches = asyncio.Semaphore(INGEST_MAX_PENDING_BATCHES, loop=loop)
+
         self.app = web.Application(loop=loop)
         self.app.router.add_route('POST', '/get_html', self.handle)
+        self.app.router.add_route('POST', '/jobs', self.handle_jobs)
+        self.app.router.add_route('POST', '/render', self.handle_render)
+        self.app.router.add_route('GET', '/metrics', self.handle_metrics)
         self.handler = self.app.make_handler()
         srv = yield from loop.create_server(self.handler, '127.0.0.1', self.port)
         print("Server started at http://127.0.0.1:8080")
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from time import monotonic
+
+
+class ResultCache(object):
+    """Keeps str payloads for ttl seconds, evicting the least recently used ones once max_bytes is reached"""
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # key -> (expires at, payload). Most recently used last.
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, payload = entry
+        if expires_at < monotonic():
+            self.discard(key)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return payload
+
+    def put(self, key, payload):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+
+        self.discard(key)
+        while self.entries and self.bytes + size > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+
+        self.entries[key] = (monotonic() + self.ttl, payload)
+        self.bytes += size
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.bytes -= len(entry[1])
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.bytes}
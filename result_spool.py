@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict, deque, namedtuple
+import glob
+import gzip
+import json
+import os
+from time import monotonic
+
+from PyQt5.QtCore import QObject, QTimer, QUrl, Qt, pyqtSlot
+from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkReply, QNetworkRequest
+
+from settings import RESULT_SPOOL_DIRECTORY, RESULT_SPOOL_SEGMENT_BYTES, RESULT_SPOOL_FLUSH_MILLISECONDS, \
+    RESULT_SPOOL_BATCH_RECORDS, RESULT_SPOOL_BATCH_BYTES, RESULT_SPOOL_MAX_IN_FLIGHT, RESULT_SPOOL_MAX_BACKOFF_SECONDS, \
+    RESULT_DESTINATIONS
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Where a record is in its segment. The body is read back from there when the record is sent.
+Record = namedtuple('Record', ['id', 'url', 'segment', 'offset', 'length', 'spooled_at'])
+# 4xx answers that say to try again later. Any other 4xx rejects the records for good.
+RETRY_STATUSES = frozenset([408, 429])
+
+
+class Destination(object):
+    def __init__(self, url):
+        conf = RESULT_DESTINATIONS.get(url, {})
+        self.url = url
+        # Receivers that take newline delimited batches of records. The others get one POST per record.
+        self.batch = conf.get('batch', False)
+        self.gzip = conf.get('gzip', False)
+        # Record ids waiting to be sent, oldest first
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.in_flight = 0
+        self.failures = 0
+        self.retry_at = 0
+
+    def next_batch(self, pending):
+        size = 0
+        batch = []
+        limit = RESULT_SPOOL_BATCH_RECORDS if self.batch else 1
+        while self.queue and len(batch) < limit:
+            record = pending[self.queue[0]]
+            if batch and size + record.length > RESULT_SPOOL_BATCH_BYTES:
+                break
+            self.queue.popleft()
+            self.queued_bytes -= record.length
+            size += record.length
+            batch.append(record)
+        return batch
+
+
+class ResultSpool(QObject):
+    """Delivers what jobs post with SjCtrl.post_obj, at least once and across restarts.
+
+    Every record is appended to a journal segment in RESULT_SPOOL_DIRECTORY before anything is sent. A record is
+    acknowledged in acks.log once its destination answers with a 2xx. On startup the records that were never
+    acknowledged are sent again. Segments whose records are all acknowledged are deleted.
+
+    Records are sent every RESULT_SPOOL_FLUSH_MILLISECONDS, or as soon as RESULT_SPOOL_BATCH_BYTES are waiting for
+    a destination. Destinations in RESULT_DESTINATIONS can take batches as newline delimited JSON and gzip. A
+    destination that fails is retried with exponential backoff up to RESULT_SPOOL_MAX_BACKOFF_SECONDS.
+
+    A 4xx other than 408 and 429 rejects records for good. A rejected batch is sent again in halves until the records
+    it is rejected for are found, and those are acknowledged and moved to dead-letters.jsonl so they don't hold back
+    the rest.
+    """
+    segment_prefix = 'segment-'
+    instance = None
+    directory = RESULT_SPOOL_DIRECTORY
+
+    @staticmethod
+    def configure(directory):
+        """Must be called before the spool is first used. Processes must not share a directory."""
+        ResultSpool.directory = directory
+
+    @staticmethod
+    def get():
+        if ResultSpool.instance is None:
+            ResultSpool.instance = ResultSpool(ResultSpool.directory)
+        return ResultSpool.instance
+
+    def __init__(self, directory, parent=None):
+        super().__init__(parent)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.network_manager = QNetworkAccessManager(self)
+        # id -> Record, for every record that isn't acknowledged
+        self.pending = OrderedDict()
+        # segment number -> file the bodies of its records are read back from
+        self.readers = {}
+        # segment number -> ids in the segment that aren't acknowledged
+        self.segments = OrderedDict()
+        # segment number -> id of its first record. Ids only grow, so a segment holds the ids from there to the next.
+        self.segment_first_ids = {}
+        # url -> Destination
+        self.destinations = {}
+        # Deliveries in flight. Nothing else holds their wrappers, and the garbage collector deleting one drops the
+        # reply without it ever finishing, which would leave its destination.in_flight up for good.
+        self.replies = set()
+        self.next_id = 1
+        self.segment = None
+        self.segment_file = None
+        self.acks_file = None
+        self.dead_letters_file = None
+        self.delivered = 0
+        self.failures = 0
+        self.dead_letters = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setTimerType(Qt.CoarseTimer)
+        self.flush_timer.timeout.connect(self.flush)
+
+        self.replay()
+        self.flush_timer.start(RESULT_SPOOL_FLUSH_MILLISECONDS)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, '{}{:08d}.jsonl'.format(self.segment_prefix, segment))
+
+    def acks_path(self):
+        return os.path.join(self.directory, 'acks.log')
+
+    def dead_letters_path(self):
+        return os.path.join(self.directory, 'dead-letters.jsonl')
+
+    def replay(self):
+        acked = set()
+        if os.path.exists(self.acks_path()):
+            with open(self.acks_path(), encoding='utf-8') as acks_file:
+                acked = set(int(line) for line in acks_file if line.strip().isdigit())
+
+        paths = sorted(glob.glob(os.path.join(self.directory, self.segment_prefix + '*.jsonl')))
+        last_segment = 0
+        for path in paths:
+            segment = int(os.path.basename(path)[len(self.segment_prefix):-len('.jsonl')])
+            last_segment = max(last_segment, segment)
+            ids = set()
+            first_id = None
+            offset = 0
+            with open(path, mode='rb') as segment_file:
+                for line in segment_file:
+                    line_offset, offset = offset, offset + len(line)
+                    try:
+                        entry = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # The last line of a segment that was being written when the process died
+                        logger.warning('Skipping a torn record in {}'.format(path))
+                        continue
+                    self.next_id = max(self.next_id, entry['id'] + 1)
+                    if first_id is None:
+                        first_id = entry['id']
+                    if entry['id'] not in acked:
+                        ids.add(entry['id'])
+                        self.queue(Record(entry['id'], entry['url'], segment, line_offset, len(line), monotonic()))
+            if ids:
+                self.segments[segment] = ids
+                self.segment_first_ids[segment] = first_id
+            else:
+                os.remove(path)
+
+        self.compact_acks()
+        self.acks_file = open(self.acks_path(), mode='a', encoding='utf-8')
+        self.dead_letters_file = open(self.dead_letters_path(), mode='a', encoding='utf-8')
+
+        self.open_segment(last_segment + 1)
+        if self.pending:
+            logger.info('Replaying {} undelivered results from {}'.format(len(self.pending), self.directory))
+
+    def compact_acks(self):
+        """Rewrites acks.log with only the acks of the segments that are left"""
+        min_id = min(self.segment_first_ids.values()) if self.segment_first_ids else self.next_id
+        acks = []
+        if os.path.exists(self.acks_path()):
+            with open(self.acks_path(), encoding='utf-8') as acks_file:
+                acks = [line for line in acks_file if line.strip().isdigit() and int(line) >= min_id]
+        with open(self.acks_path() + '.tmp', mode='w', encoding='utf-8') as acks_file:
+            acks_file.writelines(acks)
+        os.replace(self.acks_path() + '.tmp', self.acks_path())
+
+    def open_segment(self, segment):
+        if self.segment_file:
+            self.segment_file.close()
+            if not self.segments[self.segment]:
+                self.remove_segment(self.segment)
+        self.segment = segment
+        self.segment_file = open(self.segment_path(segment), mode='ab')
+        self.segments[segment] = set()
+        self.segment_first_ids[segment] = self.next_id
+
+    def remove_segment(self, segment):
+        del self.segments[segment]
+        del self.segment_first_ids[segment]
+        reader = self.readers.pop(segment, None)
+        if reader:
+            reader.close()
+        os.remove(self.segment_path(segment))
+
+    def read_body(self, record):
+        reader = self.readers.get(record.segment)
+        if reader is None:
+            reader = self.readers[record.segment] = open(self.segment_path(record.segment), mode='rb')
+        reader.seek(record.offset)
+        return json.loads(reader.read(record.length).decode('utf-8'))['body']
+
+    def queue(self, record):
+        self.pending[record.id] = record
+        destination = self.destinations.get(record.url)
+        if destination is None:
+            destination = self.destinations[record.url] = Destination(record.url)
+        destination.queue.append(record.id)
+        destination.queued_bytes += record.length
+        return destination
+
+    def append(self, url, body):
+        """Spools body, a JSON string, for url"""
+        if '\n' in body and RESULT_DESTINATIONS.get(url, {}).get('batch'):
+            # A line of a newline delimited batch
+            try:
+                body = json.dumps(json.loads(body, strict=False), separators=(',', ':'))
+            except ValueError:
+                self.failures += 1
+                self.dead_letter(url, body, 'not JSON, so it can\'t be a line of a batch')
+                return
+
+        line = (json.dumps({'id': self.next_id, 'url': url, 'body': body}) + '\n').encode('utf-8')
+        record = Record(self.next_id, url, self.segment, self.segment_file.tell(), len(line), monotonic())
+        self.next_id += 1
+        self.segment_file.write(line)
+        # Into the OS buffers, so the record survives the process. os.fsync happens once per flush.
+        self.segment_file.flush()
+        self.segments[self.segment].add(record.id)
+
+        destination = self.queue(record)
+        if destination.queued_bytes >= RESULT_SPOOL_BATCH_BYTES:
+            self.send(destination)
+
+        if self.segment_file.tell() >= RESULT_SPOOL_SEGMENT_BYTES:
+            self.open_segment(self.segment + 1)
+
+    @pyqtSlot()
+    def flush(self):
+        if not self.pending:
+            return
+        os.fsync(self.segment_file.fileno())
+        for destination in self.destinations.values():
+            self.send(destination)
+
+    def send(self, destination):
+        now = monotonic()
+        while destination.queue and destination.in_flight < RESULT_SPOOL_MAX_IN_FLIGHT and destination.retry_at <= now:
+            self.post(destination, destination.next_batch(self.pending))
+
+    def post(self, destination, batch):
+        body = '\n'.join(self.read_body(record) for record in batch).encode('utf-8')
+
+        request = QNetworkRequest(QUrl(destination.url))
+        request.setHeader(QNetworkRequest.ContentTypeHeader,
+                          'application/x-ndjson' if destination.batch else 'application/json')
+        if destination.gzip:
+            body = gzip.compress(body)
+            request.setRawHeader(b'Content-Encoding', b'gzip')
+
+        destination.in_flight += 1
+        reply = self.network_manager.post(request, body)
+        self.replies.add(reply)
+        reply.finished.connect(lambda: self.sent(destination, batch, reply))
+
+    def sent(self, destination, batch, reply):
+        destination.in_flight -= 1
+        self.replies.discard(reply)
+        error = reply.error()
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        reply.deleteLater()
+
+        if status and 400 <= status < 500 and status not in RETRY_STATUSES:
+            self.rejected(destination, batch, status)
+        elif error != QNetworkReply.NoError or not status or not 200 <= status < 300:
+            self.failures += 1
+            destination.failures += 1
+            backoff = min(2 ** destination.failures, RESULT_SPOOL_MAX_BACKOFF_SECONDS)
+            destination.retry_at = monotonic() + backoff
+            logger.error('Could not deliver {} results to {}, retrying in {}sec. e_id="{};{}" status={}'.format(
+                len(batch), destination.url, backoff, error, reply.errorString(), status))
+            # Back to the front of the queue, in order
+            for record in reversed(batch):
+                destination.queue.appendleft(record.id)
+                destination.queued_bytes += record.length
+        else:
+            destination.failures = 0
+            destination.retry_at = 0
+            now = monotonic()
+            for record in batch:
+                self.ack(record)
+                self.delivered += 1
+                latency = now - record.spooled_at
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+            self.flush_acks()
+
+    def rejected(self, destination, batch, status):
+        """The destination answered, so it isn't failing, but it won't take batch as it is"""
+        destination.failures = 0
+        destination.retry_at = 0
+        if len(batch) > 1:
+            logger.warning('{} rejected {} results with status {}, sending them again in halves'.format(
+                destination.url, len(batch), status))
+            half = len(batch) // 2
+            self.post(destination, batch[:half])
+            self.post(destination, batch[half:])
+            return
+
+        record = batch[0]
+        self.failures += 1
+        self.dead_letter(destination.url, self.read_body(record), 'rejected with status {}'.format(status))
+        self.ack(record)
+        self.flush_acks()
+
+    def dead_letter(self, url, body, reason):
+        self.dead_letters += 1
+        logger.error('Moving a result for {} to {}, it was {}: {}'.format(url, self.dead_letters_path(), reason,
+                                                                          body[:200]))
+        self.dead_letters_file.write(json.dumps({'url': url, 'reason': reason, 'body': body}) + '\n')
+        self.dead_letters_file.flush()
+
+    def flush_acks(self):
+        self.acks_file.flush()
+        if self.acks_file.tell() >= RESULT_SPOOL_SEGMENT_BYTES:
+            self.acks_file.close()
+            self.compact_acks()
+            self.acks_file = open(self.acks_path(), mode='a', encoding='utf-8')
+
+    def ack(self, record):
+        self.acks_file.write('{}\n'.format(record.id))
+        del self.pending[record.id]
+
+        ids = self.segments.get(record.segment)
+        if ids is None:
+            return
+        ids.discard(record.id)
+        if not ids and record.segment != self.segment:
+            self.remove_segment(record.segment)
+
+    def stats(self):
+        return {'depth': len(self.pending),
+                'bytes': sum(destination.queued_bytes for destination in self.destinations.values()),
+                'in_flight': sum(destination.in_flight for destination in self.destinations.values()),
+                'delivered': self.delivered,
+                'failures': self.failures,
+                'dead_letters': self.dead_letters,
+                'latency_avg': round(self.latency_total / self.delivered, 3) if self.delivered else 0.0,
+                'latency_max': round(self.latency_max, 3),
+                'segments': len(self.segments)}
+
+    def close(self):
+        self.flush_timer.stop()
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+        self.segment_file.close()
+        for reader in self.readers.values():
+            reader.close()
+        self.acks_file.close()
+        self.dead_letters_file.close()
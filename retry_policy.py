@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+from collections import Counter, deque, namedtuple
+import random
+from time import monotonic
+
+from PyQt5.QtNetwork import QNetworkReply
+
+from settings import RETRY_POLICIES, RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN, RETRY_BUDGET_WINDOW_SECONDS
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Why a job failed
+CAUSE_NETWORK = 'network'
+CAUSE_PROXY = 'proxy'
+CAUSE_THROTTLED = 'throttled'
+CAUSE_HTTP = 'http'
+CAUSE_NOT_FOUND = 'not_found'
+CAUSE_TIMEOUT = 'timeout'
+CAUSE_SCRIPT = 'script'
+CAUSE_INVALID_URL = 'invalid_url'
+# The job script called SjCtrl.abort
+CAUSE_ABORTED = 'aborted'
+# The page made no progress for JOB_STALL_SECONDS
+CAUSE_STALLED = 'stalled'
+# The worker process running the job died
+CAUSE_CRASHED = 'crashed'
+
+PROXY_ERRORS = frozenset([QNetworkReply.ProxyConnectionRefusedError, QNetworkReply.ProxyConnectionClosedError,
+                          QNetworkReply.ProxyNotFoundError, QNetworkReply.ProxyTimeoutError,
+                          QNetworkReply.ProxyAuthenticationRequiredError, QNetworkReply.UnknownProxyError])
+# Statuses the proxy answers with itself
+PROXY_STATUSES = frozenset([407])
+THROTTLE_STATUSES = frozenset([429, 503])
+NOT_FOUND_STATUSES = frozenset([404, 410])
+
+
+def is_proxy_failure(error, status):
+    """Whether the proxy, not the site, is in trouble. Counts against the health of a pool proxy."""
+    return error in PROXY_ERRORS or status in PROXY_STATUSES
+
+
+def classify_reply(error, status, retry_after_sec=None):
+    if status in THROTTLE_STATUSES or retry_after_sec is not None:
+        return CAUSE_THROTTLED
+    if is_proxy_failure(error, status):
+        return CAUSE_PROXY
+    if error == QNetworkReply.TimeoutError:
+        return CAUSE_TIMEOUT
+    if status in NOT_FOUND_STATUSES:
+        return CAUSE_NOT_FOUND
+    if status and status >= 400:
+        return CAUSE_HTTP
+    return CAUSE_NETWORK
+
+
+Decision = namedtuple('Decision', ['retry', 'delay', 'reason'])
+
+
+class RetryBudget(object):
+    """Retries may be at most RETRY_BUDGET_RATIO of the dispatches of the last RETRY_BUDGET_WINDOW_SECONDS, plus
+    RETRY_BUDGET_MIN so that a quiet process can still retry"""
+    slots = 10
+
+    def __init__(self):
+        self.slot_seconds = RETRY_BUDGET_WINDOW_SECONDS / self.slots
+        # [slot start, dispatches, retries], oldest first
+        self.window = deque()
+
+    def current_slot(self):
+        now = monotonic()
+        while self.window and self.window[0][0] <= now - RETRY_BUDGET_WINDOW_SECONDS:
+            self.window.popleft()
+        if not self.window or self.window[-1][0] <= now - self.slot_seconds:
+            self.window.append([now, 0, 0])
+        return self.window[-1]
+
+    def dispatched(self):
+        self.current_slot()[1] += 1
+
+    def take(self):
+        slot = self.current_slot()
+        dispatches = sum(s[1] for s in self.window)
+        retries = sum(s[2] for s in self.window)
+        if retries >= dispatches * RETRY_BUDGET_RATIO + RETRY_BUDGET_MIN:
+            return False
+        slot[2] += 1
+        return True
+
+    def stats(self):
+        self.current_slot()
+        return {'dispatches': sum(s[1] for s in self.window), 'retries': sum(s[2] for s in self.window)}
+
+
+class RetryPolicy(object):
+    """Decides if and when a failed job runs again.
+
+    RETRY_POLICIES maps every cause to (tries, base delay, max delay). A job is tried at most tries times in all.
+    The n-th retry waits a random time between half and all of base * 2 ** (n - 1), capped to max delay, so that
+    jobs that failed together don't come back together. A Retry-After from the site is honoured when longer.
+    """
+
+    def __init__(self):
+        self.budget = RetryBudget()
+        self.retries = Counter()
+        self.given_up = Counter()
+
+    def decide(self, job, cause, retry_after_sec=0):
+        tries, base_delay, max_delay = RETRY_POLICIES.get(cause, RETRY_POLICIES[CAUSE_ABORTED])
+        attempt = job.retry or 1
+        if attempt >= tries:
+            self.given_up[cause] += 1
+            return Decision(False, None, 'Gave up after {} tries'.format(attempt))
+
+        if not self.budget.take():
+            self.given_up[cause] += 1
+            return Decision(False, None, 'Retry budget exhausted')
+
+        delay = min(base_delay * 2 ** (attempt - 1), max_delay)
+        delay = random.uniform(delay / 2, delay)
+        if retry_after_sec:
+            # Slightly above what the site asked for
+            delay = max(delay, min(retry_after_sec + random.uniform(1, max(retry_after_sec / 10, 5)), max_delay))
+        self.retries[cause] += 1
+        return Decision(True, delay, None)
+
+    def stats(self):
+        return dict(self.budget.stats(), by_cause=dict(self.retries), given_up=dict(self.given_up))
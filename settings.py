@@ -57,5 +57,197 @@ LOGGING = {
 # Technically this should only be the default and we should use the encoding specified in the http header
 HTTP_HEADER_CHARSET = 'ISO-8859-8'
 DEFAULT_JOB_TIMEOUT_SECONDS = 300
+# A page job that made no progress for JOB_STALL_SECONDS is aborted as 'stalled' instead of holding its page until it
+# times out. Progress is a subrequest or getJson starting, receiving data or finishing, a DOM mutation, or the script
+# loading a job, posting or setting its result. While a request is in flight the job gets JOB_STALL_IN_FLIGHT_SECONDS
+# instead, for servers that are slow to answer, but a request that receives nothing for that long stalls it. A job is
+# never stalled while it waits in SjCtrl.waitForNetworkIdle or SjCtrl.waitForSelector, their own timeouts bound those.
+# Jobs can set their own stall_timeout, 0 turns it off for them and None for every job. Pages are checked every
+# JOB_STALL_CHECK_MILLISECONDS.
+JOB_STALL_SECONDS = 30
+JOB_STALL_IN_FLIGHT_SECONDS = 90
+JOB_STALL_CHECK_MILLISECONDS = 1000
 
-MAX_RETRIES = 5
\ No newline at end of file
+MAX_RETRIES = 5
+
+# How failed jobs are retried, by cause: (tries in all, base delay sec, max delay sec). The n-th retry waits a random
+# time between half and all of base * 2 ** (n - 1), capped to the max delay, or longer if the site sent Retry-After.
+RETRY_POLICIES = {
+    'network': (MAX_RETRIES, 10, 600),
+    'proxy': (MAX_RETRIES, 5, 300),
+    'throttled': (MAX_RETRIES, 60, 3600),
+    'http': (3, 30, 900),
+    'not_found': (1, 0, 0),
+    'timeout': (3, 30, 900),
+    'script': (2, 30, 300),
+    'invalid_url': (1, 0, 0),
+    'aborted': (MAX_RETRIES, 60, 1800),
+    'stalled': (2, 30, 600),
+    'crashed': (2, 60, 600),
+}
+# Retries may be at most RETRY_BUDGET_RATIO of the jobs dispatched in the last RETRY_BUDGET_WINDOW_SECONDS, plus
+# RETRY_BUDGET_MIN. Jobs over the budget are given up on like jobs out of tries and kept in the job store.
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MIN = 10
+RETRY_BUDGET_WINDOW_SECONDS = 600
+
+JOB_QUEUE_SIZE = 1000
+# Maximum number of pages that can work on the same host at the same time. Jobs without a url are not capped
+MAX_PAGES_PER_HOST = 4
+# Per host overrides for MAX_PAGES_PER_HOST e.g. {'www.linkedin.com': 6}
+HOST_MAX_PAGES = {}
+
+# Cursor jobs, loaded with SjCtrl.loadCursor, fan out one page of a long list and load the cursor for the next page.
+# They are held back until the queue they run from has FAN_OUT_CURSOR_HEADROOM free slots, about the most jobs one
+# page fans out to, and at most FAN_OUT_MAX_CURSORS of them are queued or running at once.
+FAN_OUT_CURSOR_HEADROOM = 200
+FAN_OUT_MAX_CURSORS = 2
+
+# Jobs whose mode is 'fetch' or 'script' don't need WebKit and run on the lane instead of a page, up to
+# LANE_MAX_JOBS at a time and LANE_MAX_PER_HOST per host. A fetch job gets its url over plain http and hands the
+# response to the function named after its state in the python file next to its script, on one of LANE_HOOK_THREADS
+# threads. A script job runs the state callback of its script without loading a page.
+LANE_QUEUE_SIZE = 10000
+LANE_MAX_JOBS = 1000
+LANE_MAX_PER_HOST = 16
+LANE_HOOK_THREADS = 4
+LANE_MAX_REDIRECTS = 10
+
+# Multi process mode. The supervisor checks that the workers are alive and restarts them after a crash.
+# A worker that dies within WORKER_RESTART_DELAY_SECONDS of starting is restarted after that delay.
+WORKER_HEALTH_CHECK_SECONDS = 5
+WORKER_RESTART_DELAY_SECONDS = 10
+
+# Page recycling. A page is replaced with a fresh one after PAGE_MAX_JOBS jobs or once the process RSS grew by
+# PAGE_MAX_PROCESS_RSS_GROWTH_MB while it had a job. That growth is of the whole process, so the jobs of the other
+# pages add to it too. When the whole process goes over PROCESS_MAX_RSS_MB
+# pages are drained one at a time, every MEMORY_CHECK_SECONDS, until each page has been replaced once. Freed memory
+# is rarely given back to the OS, so after that nothing more is drained until the RSS has gone under
+# PROCESS_RESUME_RSS_MB. A page is never replaced while it has a job.
+PAGE_MAX_JOBS = 200
+PAGE_MAX_PROCESS_RSS_GROWTH_MB = 300
+PROCESS_MAX_RSS_MB = 3072
+PROCESS_RESUME_RSS_MB = 2560
+MEMORY_CHECK_SECONDS = 30
+
+# Queued, running and delayed jobs are kept in this SQLite database and recovered on startup. Set to None to disable.
+JOB_STORE_PATH = os.path.join(BASE_PROJECT_DIR, 'data/jobs.db')
+JOB_STORE_FLUSH_MILLISECONDS = 200
+JOB_STORE_BATCH_SIZE = 500
+
+# What to do with cron fires missed while the process was down or busy: 'skip', 'fire_once' or 'fire_all'.
+# A fire more than CRON_MISFIRE_GRACE_SECONDS late counts as missed. 'fire_all' runs at most CRON_MAX_CATCHUP_FIRES.
+CRON_MISFIRE_POLICY = 'fire_once'
+CRON_MISFIRE_GRACE_SECONDS = 60
+CRON_MAX_CATCHUP_FIRES = 10
+
+# Job files are watched for changes. The jobs directory is also rescanned this often in case a change was missed.
+JOB_REGISTRY_POLL_SECONDS = 30
+
+# Job ingestion over http. Jobs are handed to the queue in batches of INGEST_BATCH_SIZE with at most
+# INGEST_MAX_PENDING_BATCHES waiting for the Qt thread. A submission that can't make progress for
+# INGEST_BACKPRESSURE_TIMEOUT_SECONDS because the queue is saturated is answered with a 429.
+INGEST_BATCH_SIZE = 500
+INGEST_MAX_PENDING_BATCHES = 2
+INGEST_BACKPRESSURE_TIMEOUT_SECONDS = 60
+INGEST_MAX_ERRORS = 100
+
+# POST /render holds the request until the job is done. Clients can ask for a shorter deadline, never a longer one.
+RENDER_DEFAULT_DEADLINE_SECONDS = 120
+RENDER_MAX_DEADLINE_SECONDS = 600
+
+# Results of render requests are kept for RESULT_CACHE_TTL_SECONDS and identical requests in that window are
+# answered from the cache. 0 disables the cache. Identical queued or running jobs are always coalesced.
+RESULT_CACHE_TTL_SECONDS = 0
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Disk cache for the subresources of all the pages of a process. Jobs can force caching for hosts matching the
+# regexes in their cache_hosts, those responses are kept for HTTP_CACHE_FORCED_TTL_SECONDS whatever their headers say.
+HTTP_CACHE_DIRECTORY = os.path.join(BASE_PROJECT_DIR, 'cache/http')
+HTTP_CACHE_MAX_BYTES = 512 * 1024 * 1024
+HTTP_CACHE_FORCED_TTL_SECONDS = 24 * 3600
+
+# Named sets of resource types a job can stop its pages from loading with block_profile. The types are image, font,
+# media, stylesheet, script and tracker (the hosts in block_profiles.TRACKER_HOSTS). The page itself always loads.
+BLOCK_PROFILES = {
+    'trackers': ['tracker'],
+    'lean': ['font', 'media', 'tracker'],
+    'text': ['image', 'font', 'media', 'tracker'],
+    'html': ['image', 'font', 'media', 'stylesheet', 'tracker'],
+}
+
+# Proxies shared by the jobs whose proxy is 'pool', e.g.
+# [{'proxy': 'proxy1.example.com:8010', 'auth': 'user:password', 'is_crawlera': True, 'max_jobs': 20}]
+# A job keeps its proxy until it ends. Proxies are picked by latency, error rate and load, a proxy with
+# PROXY_CIRCUIT_FAILURES failures in a row or an error rate over PROXY_CIRCUIT_ERROR_RATE gets no new jobs for
+# PROXY_CIRCUIT_OPEN_SECONDS. PROXY_LATENCY_ALPHA is the weight of the latest request in the moving averages.
+PROXY_POOL = []
+PROXY_POOL_MAX_JOBS = 20
+PROXY_LATENCY_ALPHA = 0.2
+PROXY_CIRCUIT_FAILURES = 5
+PROXY_CIRCUIT_ERROR_RATE = 0.5
+PROXY_CIRCUIT_OPEN_SECONDS = 30
+
+# Politeness. Token buckets of (requests per second, burst) per host and per proxy, shared by all the pages.
+# Jobs wait in the queue until their host has a token. Subrequests can't wait so they are charged anyway and
+# hold back the next jobs for their host. None means unlimited. A 429 or 503 multiplies the rate of the host by
+# RATE_LIMIT_BACKOFF, down to RATE_LIMIT_MIN_FRACTION of its limit, and honours Retry-After. The rate then climbs
+# back to the limit over RATE_LIMIT_RECOVERY_SECONDS. Workers report what their subrequests were charged to the
+# supervisor, which dispatches the jobs, every RATE_LIMIT_REPORT_MILLISECONDS.
+DEFAULT_HOST_RATE_LIMIT = (10.0, 100)
+# e.g. {'www.linkedin.com': (0.5, 5)}
+HOST_RATE_LIMITS = {}
+DEFAULT_PROXY_RATE_LIMIT = None
+# Keyed by 'host:port' of the proxy
+PROXY_RATE_LIMITS = {}
+RATE_LIMIT_BACKOFF = 0.5
+RATE_LIMIT_MIN_FRACTION = 0.05
+RATE_LIMIT_RECOVERY_SECONDS = 300
+RATE_LIMIT_REPORT_MILLISECONDS = 250
+
+# The http client of SjCtrl.getJson, shared by all the pages of a process. Responses are parsed on
+# HTTP_CLIENT_DECODE_THREADS threads. HTTP_CLIENT_CACHE_TTL_SECONDS caches bodies by url, 0 disables it.
+HTTP_CLIENT_MAX_PER_HOST = 4
+HTTP_CLIENT_TIMEOUT_SECONDS = 60
+HTTP_CLIENT_DECODE_THREADS = 2
+HTTP_CLIENT_CACHE_TTL_SECONDS = 0
+HTTP_CLIENT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Results posted with SjCtrl.post_obj are journaled here and delivered at least once, even across restarts.
+# Records are sent every RESULT_SPOOL_FLUSH_MILLISECONDS, or once RESULT_SPOOL_BATCH_BYTES are waiting for a url.
+# Failed deliveries back off exponentially up to RESULT_SPOOL_MAX_BACKOFF_SECONDS. Records a destination rejects
+# with a 4xx other than 408 or 429 go to dead-letters.jsonl in the directory instead.
+RESULT_SPOOL_DIRECTORY = os.path.join(BASE_PROJECT_DIR, 'data/spool')
+RESULT_SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024
+RESULT_SPOOL_FLUSH_MILLISECONDS = 1000
+RESULT_SPOOL_BATCH_RECORDS = 500
+RESULT_SPOOL_BATCH_BYTES = 1024 * 1024
+RESULT_SPOOL_MAX_IN_FLIGHT = 4
+RESULT_SPOOL_MAX_BACKOFF_SECONDS = 300
+# Destinations that accept batches of records as newline delimited JSON and gzipped bodies, e.g.
+# {'http://example.com/ingest/': {'batch': True, 'gzip': True}}. Others get one plain POST per record.
+RESULT_DESTINATIONS = {}
+
+# Metrics are served at GET /metrics in the Prometheus text format. Workers send theirs to the supervisor every
+# METRICS_PUSH_SECONDS. A metric keeps at most METRICS_MAX_LABEL_SETS label values, later ones are counted as 'other'.
+METRICS_PUSH_SECONDS = 15
+METRICS_MAX_LABEL_SETS = 1000
+
+# A TRACE_SAMPLE_RATE fraction of the jobs record a trace of their lifecycle. It covers the queue wait, the page
+# load, the script injection, getJson, posts, loaded jobs, every subrequest and how the job ended. Traces of jobs
+# that took at least TRACE_MIN_DURATION_SECONDS are appended to TRACE_DIRECTORY/trace-<pid>.json in the Chrome trace
+# event format, which chrome://tracing and Perfetto open, or as one JSON line per job with TRACE_FORMAT 'jsonl'.
+TRACE_SAMPLE_RATE = 0
+TRACE_MIN_DURATION_SECONDS = 0
+TRACE_FORMAT = 'chrome'
+TRACE_DIRECTORY = os.path.join(BASE_PROJECT_DIR, 'logs/traces')
+
+# Record and replay of the network, to profile jobs and check their output offline. With NET_ARCHIVE_MODE 'record'
+# every request of a job, from its page, SjCtrl.getJson or the lane, is saved with its headers, body and timings,
+# along with the results it posted, to a gzipped JSON lines archive per job in NET_ARCHIVE_DIRECTORY. With 'replay'
+# jobs are answered from their archive and nothing is sent, requests missing from it fail. Responses take their
+# recorded time multiplied by NET_REPLAY_LATENCY_SCALE, 0 answers at once. Replayed posts are compared with the
+# recorded ones instead of being delivered. None turns it off.
+NET_ARCHIVE_MODE = None
+NET_ARCHIVE_DIRECTORY = os.path.join(BASE_PROJECT_DIR, 'data/net_archives')
+NET_REPLAY_LATENCY_SCALE = 1
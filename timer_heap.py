@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import heapq
+from itertools import count
+from time import time
+
+from PyQt5.QtCore import QObject, QTimer, Qt, pyqtSlot
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class TimerHandle(object):
+    __slots__ = ('when', 'callback', 'cancelled')
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerHeap(QObject):
+    """Runs callbacks at wall clock times using a single re-armed QTimer instead of one QTimer per callback"""
+    # Never sleep longer than this so that clock changes and suspends are noticed
+    max_sleep_seconds = 3600
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.heap = []
+        self.sequence = count()
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.CoarseTimer)
+        self.timer.timeout.connect(self.run_due)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def call_at(self, when, callback):
+        handle = TimerHandle(when, callback)
+        earliest = self.heap[0][0] if self.heap else None
+        heapq.heappush(self.heap, (when, next(self.sequence), handle))
+        if earliest is None or when < earliest:
+            self.arm()
+        return handle
+
+    def call_later(self, delay_sec, callback):
+        return self.call_at(time() + delay_sec, callback)
+
+    def arm(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            self.timer.stop()
+            return
+        delay = min(max(self.heap[0][0] - time(), 0), self.max_sleep_seconds)
+        self.timer.start(int(delay * 1000))
+
+    @pyqtSlot()
+    def run_due(self):
+        now = time()
+        while self.heap and self.heap[0][0] <= now:
+            handle = heapq.heappop(self.heap)[2]
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback()
+            except Exception:
+                logger.exception('Timer callback failed')
+        self.arm()
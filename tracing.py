@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import random
+from itertools import count
+from time import monotonic, time
+
+from settings import TRACE_SAMPLE_RATE, TRACE_MIN_DURATION_SECONDS, TRACE_FORMAT, TRACE_DIRECTORY
+
+import logging
+logger = logging.getLogger(__name__)
+
+TRACE_FORMATS = ('chrome', 'jsonl')
+# Spans are timed with monotonic() and written as wall clock microseconds, so that the traces of workers line up
+EPOCH_OFFSET = time() - monotonic()
+
+
+def timestamp(at):
+    return int((at + EPOCH_OFFSET) * 1000000)
+
+
+def start_trace(job, owner_id, queued_sec=0):
+    """A JobTrace for a sampled job, None for the others. Callers check for None before recording anything."""
+    if not TRACE_SAMPLE_RATE or random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    return JobTrace(job, owner_id, queued_sec)
+
+
+class JobTrace(object):
+    """The spans of one job, as Chrome trace events. Each job gets a row of its own in the viewer. Network requests
+    overlap freely, so they are async events which the viewer lays out next to the row."""
+    ids = count(1)
+
+    def __init__(self, job, owner_id, queued_sec=0):
+        self.job = job
+        self.owner_id = owner_id
+        self.id = next(JobTrace.ids)
+        self.started_at = monotonic()
+        self.events = []
+        # key -> (name, start, args) of spans begun and not ended yet
+        self.pending = {}
+        if queued_sec:
+            self.span('queued', self.started_at - queued_sec, self.started_at, cat='queue', priority=job.priority)
+
+    def event(self, name, phase, at, cat, args, **fields):
+        event = {'name': name, 'cat': cat, 'ph': phase, 'ts': timestamp(at), 'pid': os.getpid(), 'tid': self.id}
+        if args:
+            event['args'] = args
+        event.update(fields)
+        self.events.append(event)
+        return event
+
+    def span(self, name, start, end=None, cat='job', **args):
+        end = monotonic() if end is None else end
+        self.event(name, 'X', start, cat, args, dur=timestamp(end) - timestamp(start))
+
+    def instant(self, name, cat='job', **args):
+        self.event(name, 'i', monotonic(), cat, args, s='t')
+
+    def async_span(self, name, start, end=None, cat='network', **args):
+        end = monotonic() if end is None else end
+        span_id = '{}.{}'.format(self.id, len(self.events))
+        self.event(name, 'b', start, cat, args, id=span_id)
+        self.event(name, 'e', end, cat, None, id=span_id)
+
+    def begin(self, key, name, **args):
+        self.pending[key] = (name, monotonic(), args)
+
+    def end(self, key, **args):
+        begun = self.pending.pop(key, None)
+        if begun:
+            name, start, begin_args = begun
+            begin_args.update(args)
+            self.async_span(name, start, **begin_args)
+
+    def finish(self, outcome, **args):
+        ended_at = monotonic()
+        for key in list(self.pending):
+            self.end(key, unfinished=True)
+        self.event('job', 'X', self.started_at, 'job', dict(args, outcome=outcome, job=self.job.dict()),
+                   dur=timestamp(ended_at) - timestamp(self.started_at))
+        self.event('thread_name', 'M', self.started_at, '__metadata',
+                   {'name': '{} {} {}'.format(self.owner_id, os.path.basename(self.job.file or ''),
+                                              self.job.state or 'main')})
+        if ended_at - self.started_at >= TRACE_MIN_DURATION_SECONDS:
+            TraceWriter.get().write(self)
+
+
+class TraceWriter(object):
+    """Appends the traces of a process to TRACE_DIRECTORY/trace-<pid>.json or .jsonl.
+
+    The Chrome file uses the JSON array format without its closing bracket, which trace viewers accept, so a trace
+    only ever needs appending.
+    """
+    instance = None
+
+    @staticmethod
+    def get():
+        if TraceWriter.instance is None:
+            TraceWriter.instance = TraceWriter(TRACE_DIRECTORY, TRACE_FORMAT)
+        return TraceWriter.instance
+
+    def __init__(self, directory, trace_format):
+        if trace_format not in TRACE_FORMATS:
+            raise ValueError('Unknown trace format {}'.format(trace_format))
+        os.makedirs(directory, exist_ok=True)
+        self.format = trace_format
+        self.path = os.path.join(directory, 'trace-{}.{}'.format(os.getpid(), 'json' if trace_format == 'chrome'
+                                                                 else 'jsonl'))
+        self.file = open(self.path, 'a', encoding='utf-8')
+        if self.format == 'chrome' and not self.file.tell():
+            self.file.write('[\n')
+        self.written = 0
+        logger.info('Writing sampled job traces to {}'.format(self.path))
+
+    def write(self, trace):
+        try:
+            if self.format == 'chrome':
+                self.file.write(''.join(json.dumps(event, default=str) + ',\n' for event in trace.events))
+            else:
+                self.file.write(json.dumps({'trace_id': trace.id, 'owner': trace.owner_id, 'events': trace.events},
+                                           default=str) + '\n')
+            self.file.flush()
+            self.written += 1
+        except OSError:
+            logger.exception('Could not write the trace of {}'.format(trace.job))
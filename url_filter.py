@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+from functools import lru_cache
+import re
+
+ALLOW = 'allow'
+REJECT = 'reject'
+
+# Patterns that match every url
+_catch_all = frozenset(['.*', '.+', '.', '^', '.*$', '^.*', '^.*$'])
+_regex_meta = frozenset('.^$*+?{}[]|()')
+_back_reference = re.compile(r'\\[1-9]|\(\?P=')
+
+
+def literal_of(pattern):
+    """Returns the plain string a pattern matches when it has no regex syntax besides escapes, otherwise None"""
+    literal = []
+    escaped = False
+    for c in pattern:
+        if escaped:
+            if c.isalnum():
+                # \d, \w, \b and friends
+                return None
+            literal.append(c)
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c in _regex_meta:
+            return None
+        else:
+            literal.append(c)
+    if escaped:
+        return None
+    return ''.join(literal)
+
+
+class Segment(namedtuple('Segment', ['rule_type', 'always', 'literals', 'regexes'])):
+    """Consecutive rules of the same type. They are interchangeable under first match, so they are tested together."""
+
+    def matches(self, url):
+        if self.always:
+            return True
+        for literal in self.literals:
+            if literal in url:
+                return True
+        for regex in self.regexes:
+            if regex.search(url):
+                return True
+        return False
+
+
+def build_segment(rule_type, patterns):
+    always = False
+    literals = []
+    others = []
+    for pattern in patterns:
+        if pattern in _catch_all:
+            always = True
+            break
+        literal = literal_of(pattern)
+        if literal is not None:
+            literals.append(literal)
+        else:
+            others.append(pattern)
+
+    regexes = []
+    if others and not always:
+        if len(others) > 1 and not any(_back_reference.search(p) for p in others):
+            try:
+                regexes = [re.compile('|'.join('(?:{})'.format(p) for p in others))]
+            except re.error:
+                # e.g. inline flags or duplicate group names that only work on their own
+                regexes = []
+        if not regexes:
+            regexes = [re.compile(p) for p in others]
+    return Segment(rule_type, always, tuple(literals), tuple(regexes))
+
+
+class UrlFilter(object):
+    """First match wins across 'allow:<regex>' and 'reject:<regex>' rules, where a rule matches when re.search
+    finds its regex anywhere in the url. Urls that match no rule are allowed.
+
+    Pages of the same site request the same scripts, styles and trackers over and over, so decisions are memoized
+    per url. The memo is dropped whenever it reaches memo_size.
+    """
+    memo_size = 4096
+    _missing = object()
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.memo = {}
+
+    def decision(self, url):
+        rule_type = self.memo.get(url, self._missing)
+        if rule_type is not self._missing:
+            return rule_type
+
+        rule_type = None
+        for segment in self.segments:
+            if segment.matches(url):
+                rule_type = segment.rule_type
+                break
+        if len(self.memo) >= self.memo_size:
+            self.memo.clear()
+        self.memo[url] = rule_type
+        return rule_type
+
+    def is_rejected(self, url):
+        return self.decision(url) == REJECT
+
+
+@lru_cache(maxsize=256)
+def compile_filter(filter_str_list):
+    """Compiles a tuple of filter strings into a UrlFilter. Returns (UrlFilter, errors).
+
+    Like the rule list this replaces, the rules after an invalid filter string are ignored. Repeated rules are
+    only kept once. Compiled filters are cached, so every job with the same filter_list shares one.
+    """
+    errors = []
+    rules = []
+    seen = set()
+    for filter_str in filter_str_list:
+        filter_conf = filter_str.split(':', 1)
+        if len(filter_conf) != 2 or filter_conf[0] not in (ALLOW, REJECT) or not filter_conf[1]:
+            errors.append('Invalid filter string {}'.format(filter_str))
+            break
+
+        rule = (filter_conf[0], filter_conf[1])
+        if rule in seen:
+            continue
+        try:
+            re.compile(rule[1])
+        except re.error as e:
+            errors.append('Invalid filter regex {}: {}'.format(filter_str, e))
+            break
+        seen.add(rule)
+        rules.append(rule)
+
+    segments = []
+    start = 0
+    for index in range(1, len(rules) + 1):
+        if index == len(rules) or rules[index][0] != rules[start][0]:
+            segment = build_segment(rules[start][0], [pattern for _, pattern in rules[start:index]])
+            segments.append(segment)
+            if segment.always:
+                # Nothing after a catch all can ever match first
+                break
+            start = index
+    return UrlFilter(tuple(segments)), tuple(errors)
@@ -1,60 +1,74 @@
 # -*- coding: utf-8 -*-
 import glob
-from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkRequest
-from PyQt5.QtWebKit import QWebSettings, QWebElement
+import json
+import os
+from time import monotonic
+
+import psutil
+from PyQt5.QtWebKit import QWebSettings
 from access_manager import AccessManager
+from dom_extract import extract_dom
+from http_client import HttpClient
+from result_spool import ResultSpool
 
 from PyQt5.QtCore import QSize, QObject, pyqtSlot, pyqtProperty, QUrl, pyqtSignal, QVariant, Qt, QTimer
 from PyQt5.QtWebKitWidgets import QWebPage
 
 import logging
 from job import Job
-from settings import BASE_PROJECT_DIR, DEFAULT_JOB_TIMEOUT_SECONDS, HTTP_HEADER_CHARSET, MAX_RETRIES
+from job_activity import JobActivity
+from metrics import JOB_DURATION, JOB_FAILURES, LOAD_TO_INJECT, job_labels
+from net_archive import open_archive
+from retry_policy import CAUSE_ABORTED, CAUSE_INVALID_URL, CAUSE_SCRIPT, CAUSE_STALLED, CAUSE_TIMEOUT
+from tracing import start_trace
+from settings import BASE_PROJECT_DIR, DEFAULT_JOB_TIMEOUT_SECONDS, JOB_STALL_SECONDS, PAGE_MAX_JOBS, \
+    PAGE_MAX_PROCESS_RSS_GROWTH_MB
 
 logger = logging.getLogger(__name__)
 
 
 class JSControllerObject(QObject):
-    http_request_finished = pyqtSignal(int, int, str)
+    http_request_finished = pyqtSignal(int, int, QVariant)
+    # callback id, whether the network went idle before the timeout
+    network_idle = pyqtSignal(int, bool)
 
     def __init__(self, parent):
         super().__init__(parent)
         self.parent = parent
-        self.network_manager = QNetworkAccessManager()
 
-    def http_response(self, callback_id, reply):
-        if not self.job():
+    def http_response(self, callback_id, jobs_done, error, data):
+        # The page may have moved on to another job whose callback ids start over
+        if not self.job() or self.parent.jobs_done != jobs_done:
             return
+        if self.parent.trace:
+            self.parent.trace.end(callback_id, error=error)
+        self.parent.activity.request_finished()
+        self.http_request_finished.emit(callback_id, error, data)
 
-        if reply.error() == 0:
-            data_str = reply.readAll().data().decode(encoding='UTF-8')
-            self.http_request_finished.emit(callback_id, reply.error(), data_str)
-        else:
-            self.http_request_finished.emit(callback_id, reply.error(), '')
-        reply.deleteLater()
-
-    def post_finished(self, network_reply):
-        error = network_reply.error()
-        url = network_reply.url()
-        url_str = url.toString()
-        if error != 0:
-            request = network_reply.request()
-
-            request_headers_string = 'Request:\n'
-            for header in request.rawHeaderList():
-                request_headers_string += '{}: {}\n'.format(header.data().decode(encoding=HTTP_HEADER_CHARSET), request.rawHeader(header).data().decode(encoding=HTTP_HEADER_CHARSET))
-
-            response_headers_string = 'Response:\n'
-            for header in network_reply.rawHeaderList():
-                response_headers_string += '{}: {}\n'.format(header.data().decode(encoding=HTTP_HEADER_CHARSET), network_reply.rawHeader(header).data().decode(encoding=HTTP_HEADER_CHARSET))
-
-            logger.error(self.prepend_id('e_id="{eid};{estr}" url="{url}"\n{req_h}\n{res_h}'.format(eid=error,
-                                                                                                    estr=network_reply.errorString(),
-                                                                                                    url=url_str,
-                                                                                                    req_h=request_headers_string,
-                                                                                                    res_h=response_headers_string)))
-        else:
-            logger.info('Post successful {}'.format(url_str))
+    @pyqtSlot(int, int, int)
+    def wait_for_network_idle(self, callback_id, idle_ms, timeout_ms):
+        if not self.parent.current_job:
+            logger.error(self.prepend_id('Invalid State. wait_for_network_idle called when no current job'))
+            return
+
+        jobs_done = self.parent.jobs_done
+        self.parent.activity.wait_for_idle(idle_ms / 1000, timeout_ms / 1000,
+                                           lambda idle: self.network_idle_response(callback_id, jobs_done, idle))
+
+    def network_idle_response(self, callback_id, jobs_done, idle):
+        if not self.job() or self.parent.jobs_done != jobs_done:
+            return
+        self.network_idle.emit(callback_id, idle)
+
+    @pyqtSlot(int, int)
+    def selector_wait_started(self, wait_id, timeout_ms):
+        if self.job():
+            self.parent.activity.selector_wait_started(wait_id, timeout_ms / 1000)
+
+    @pyqtSlot(int)
+    def selector_wait_finished(self, wait_id):
+        if self.job():
+            self.parent.activity.selector_wait_finished(wait_id)
 
     @pyqtSlot(str, str)
     def post_request(self, url, data):
@@ -62,11 +76,19 @@ class JSControllerObject(QObject):
             logger.error(self.prepend_id('Invalid State. post_request called when no current job'))
             return
 
-        logger.info(self.prepend_id("Posting {} request to {}".format(self.job(), url)))
-        req = QNetworkRequest(QUrl(url))
-        req.setHeader(QNetworkRequest.ContentTypeHeader, 'application/json')
-        network_reply = self.network_manager.post(req, data.encode('UTF-8'))
-        network_reply.finished.connect(lambda: self.post_finished(network_reply))
+        if self.parent.trace:
+            self.parent.trace.instant('post_request', url=url, bytes=len(data))
+        self.parent.activity.progress()
+        archive = self.parent.net_archive
+        if archive:
+            archive.add_post(url, data)
+            if archive.replaying:
+                # Compared with the recorded posts when the job ends instead
+                return
+
+        logger.info(self.prepend_id("Spooling {} result for {}".format(self.job(), url)))
+        # Delivered in batches by the spool, which retries until the destination takes it
+        ResultSpool.get().append(url, data)
 
     @pyqtSlot(QVariant)
     def log_message(self, message):
@@ -89,8 +111,12 @@ class JSControllerObject(QObject):
             logger.error(self.prepend_id('Invalid State. http_request called when no current job'))
             return
 
-        qnetwork_reply = self.network_manager.get(QNetworkRequest(QUrl(url)))
-        qnetwork_reply.finished.connect(lambda: self.http_response(callback_id, qnetwork_reply))
+        jobs_done = self.parent.jobs_done
+        if self.parent.trace:
+            self.parent.trace.begin(callback_id, 'getJson', url=url)
+        self.parent.activity.request_started()
+        HttpClient.get().get_json(url, lambda error, data: self.http_response(callback_id, jobs_done, error, data),
+                                  self.parent.net_archive)
 
     @pyqtProperty(str)
     def current_state(self):
@@ -107,26 +133,60 @@ class JSControllerObject(QObject):
 
         logger.info(self.prepend_id('Done Job {}'.format(self.job())))
 
+        self.record_end('done')
+        self.parent.finish_render(True)
         self.parent.reset()
         self.parent.job_finished.emit()
 
     @pyqtSlot()
-    def abort(self, retry_after_sec=60):
+    def abort(self, retry_after_sec=0, cause=CAUSE_ABORTED):
         if not self.parent.current_job:
             logger.error(self.prepend_id('Invalid State. abort called when no current job'))
             return
 
-        logger.error(self.prepend_id('Job aborting {}'.format(self.job())))
-        retry_job = self.job().get_retry_job()
-        if retry_job.retry <= MAX_RETRIES:
-            logger.info(self.prepend_id('Retrying :{} after {}sec'.format(retry_job, retry_after_sec)))
-            QTimer.singleShot(retry_after_sec * 1000, Qt.VeryCoarseTimer, lambda: self.parent.new_job_received.emit(retry_job))
+        logger.error(self.prepend_id('Job aborting ({}) {}'.format(cause, self.job())))
+        JOB_FAILURES.labels(cause).inc()
+        self.record_end('failed', cause=cause)
+        if self.job().request_id:
+            # Somebody is waiting for this render. They get the error now instead of a retry.
+            self.parent.finish_render(False, 'Job failed: {}'.format(cause))
         else:
-            logger.error(self.prepend_id('Max Retries reached:{}'.format(retry_job)))
+            # The coordinator decides if and when it runs again
+            self.parent.job_failed.emit(self.job(), cause, retry_after_sec)
 
         self.parent.reset()
         self.parent.job_finished.emit()
 
+    @pyqtSlot(str)
+    def script_error(self, message):
+        logger.error(self.prepend_id('Exception in job: {}'.format(message)))
+        self.abort(cause=CAUSE_SCRIPT)
+
+    @pyqtSlot()
+    def cancel(self):
+        if not self.parent.current_job:
+            return
+
+        logger.info(self.prepend_id('Job cancelled {}'.format(self.job())))
+        self.record_end('cancelled')
+        self.parent.reset()
+        self.parent.job_finished.emit()
+
+    @pyqtSlot(QVariant)
+    def set_result(self, result):
+        self.parent.job_result = result
+        if self.parent.current_job:
+            self.parent.activity.progress()
+
+    def record_end(self, outcome, **trace_args):
+        JOB_DURATION.labels(*job_labels(self.job()) + (outcome,)).observe(monotonic() - self.parent.job_started_at)
+        trace, self.parent.trace = self.parent.trace, None
+        if trace:
+            trace.finish(outcome, **trace_args)
+        archive, self.parent.net_archive = self.parent.net_archive, None
+        if archive:
+            archive.close()
+
     def prepend_id(self, message):
         return '[{}] {}'.format(self.parent.id, message)
 
@@ -136,17 +196,70 @@ class JSControllerObject(QObject):
             logger.error(self.prepend_id('Invalid State. load called when no current job'))
             return
 
-        self.parent.new_job_received.emit(self.parent.current_job.new_state(**job_dict))
+        job = self.parent.current_job.new_state(**job_dict)
+        if self.parent.trace:
+            self.parent.trace.instant('load', state=job.state, url=job.url)
+        self.parent.activity.progress()
+        self.parent.new_job_received.emit(job)
+
+    @pyqtSlot(QVariant)
+    def load_many(self, job_dicts):
+        """SjCtrl.loadMany. The jobs cross over to the coordinator as one batch."""
+        if not self.parent.current_job:
+            logger.error(self.prepend_id('Invalid State. load_many called when no current job'))
+            return
+
+        jobs = [self.parent.current_job.new_state(**job_dict) for job_dict in job_dicts or []]
+        if self.parent.trace:
+            self.parent.trace.instant('load_many', jobs=len(jobs))
+        self.parent.activity.progress()
+        if jobs:
+            self.parent.new_jobs_received.emit(jobs)
+
+    @pyqtSlot(QVariant)
+    def load_cursor(self, job_dict):
+        """SjCtrl.loadCursor. The job is held back by the coordinator until the queue has room for what it loads."""
+        self.load(dict(job_dict, cursor=True))
+
+    @pyqtSlot(str, result=str)
+    def extract_json(self, schema):
+        """SjCtrl.extract. See dom_extract for the schema. It and what is extracted cross the bridge as JSON, where a
+        QVariant would turn null into undefined."""
+        if not self.parent.current_job:
+            logger.error(self.prepend_id('Invalid State. extract called when no current job'))
+            return 'null'
+
+        started = monotonic()
+        frame = self.parent.mainFrame()
+        try:
+            result = extract_dom(frame.documentElement(), json.loads(schema), frame.baseUrl())
+        except ValueError as e:
+            self.script_error('Invalid extract schema: {}'.format(e))
+            return 'null'
+        if self.parent.trace:
+            self.parent.trace.span('extract', started)
+        self.parent.activity.progress()
+        return json.dumps(result)
 
 
 class WebPageCustom(QWebPage):
     job_finished = pyqtSignal()
     new_job_received = pyqtSignal(Job)
+    # Jobs loaded together with SjCtrl.loadMany
+    new_jobs_received = pyqtSignal(list)
+    # The job, why it failed and the Retry-After in seconds if the site sent one. The coordinator retries it.
+    job_failed = pyqtSignal(Job, str, int)
+    # request id, success and the JSON payload for the client waiting on the job
+    render_finished = pyqtSignal(int, bool, str)
     controller_js_file = 'controller.js'
     cache_directory_name = 'cache'
+    controller_string = None
     js_lib_string_list = None
     global_settings_set = False
     id_gen = 0
+    recyclable = True
+    process = psutil.Process(os.getpid())
+    user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/44.0.2403.157 Safari/537.36'
 
     @staticmethod
     def setup_global_settings():
@@ -171,28 +284,48 @@ class WebPageCustom(QWebPage):
             WebPageCustom.global_settings_set = True
 
     def userAgentForUrl(self, qurl):
-        return 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/44.0.2403.157 Safari/537.36'
+        return self.user_agent
+
+    @staticmethod
+    def get_controller_string():
+        if WebPageCustom.controller_string is None:
+            with open("{base}/{ctrl}".format(base=BASE_PROJECT_DIR, ctrl=WebPageCustom.controller_js_file)) as ctrl_lib:
+                WebPageCustom.controller_string = ctrl_lib.read()
+        return WebPageCustom.controller_string
 
     @staticmethod
     def get_js_lib_string():
         if WebPageCustom.js_lib_string_list is None:
-            WebPageCustom.js_lib_string_list = []
-            with open("{base}/{ctrl}".format(base=BASE_PROJECT_DIR, ctrl=WebPageCustom.controller_js_file)) as ctrl_lib:
-                WebPageCustom.js_lib_string_list.append(ctrl_lib.read())
+            WebPageCustom.js_lib_string_list = [WebPageCustom.get_controller_string()]
             for file in glob.glob("{base}/js_libs/*.js".format(base=BASE_PROJECT_DIR)):
                 with open(file, encoding='utf-8', mode='r') as js_lib:
                     WebPageCustom.js_lib_string_list.append(js_lib.read())
         return WebPageCustom.js_lib_string_list
 
-    def __init__(self, parent, size=QSize(1366, 768)):
+    def __init__(self, parent, size=QSize(1366, 768), job_registry=None):
         QWebPage.__init__(self, parent)
+        self.job_registry = job_registry
         WebPageCustom.id_gen += 1
         self.id = WebPageCustom.id_gen
         self.setup_global_settings()
         self.current_job = None
+        self.job_result = None
         self.injected = False
+        self.jobs_done = 0
+        # How much the RSS of the process grew while this page had a job. The other pages' jobs grow it too, so this
+        # is a hint of what the page holds on to, not a measure of it.
+        self.process_rss_growth = 0
+        self.rss_at_job_start = 0
+        self.job_started_at = 0
+        # JobTrace of the current job when it was sampled for tracing
+        self.trace = None
+        # NetArchive of the current job when recording or replaying
+        self.net_archive = None
+        self.draining = False
         self.setViewportSize(size)
         self.control = JSControllerObject(self)
+        self.activity = JobActivity(self, self.dom_mutations)
+        self.activity.stalled.connect(self.stalled)
 
         self.mainFrame().javaScriptWindowObjectCleared.connect(lambda: logger.debug(self.control.prepend_id('javaScriptWindowObjectCleared')))
 
@@ -207,20 +340,60 @@ class WebPageCustom(QWebPage):
         self.setNetworkAccessManager(self.access_manager)
 
     def is_busy(self):
-        return bool(self.current_job)
+        # A draining page finishes its current job and is then replaced by the coordinator
+        return bool(self.current_job) or self.draining
+
+    def should_retire(self):
+        if self.draining:
+            return True
+        if PAGE_MAX_JOBS and self.jobs_done >= PAGE_MAX_JOBS:
+            return True
+        if PAGE_MAX_PROCESS_RSS_GROWTH_MB and self.process_rss_growth >= PAGE_MAX_PROCESS_RSS_GROWTH_MB * 1024 * 1024:
+            return True
+        return False
 
     def javaScriptConsoleMessage(self, message, line_number, source_id):
         logger.info(self.control.prepend_id('console:{}:{}:{}'.format(source_id, line_number, message)))
 
+    def cancel_job(self):
+        self.control.cancel()
+
+    def finish_render(self, ok, error=None):
+        if not self.current_job or not self.current_job.request_id:
+            return
+
+        if ok:
+            payload = {'result': self.job_result, 'html': self.mainFrame().toHtml()}
+        else:
+            payload = {'error': error}
+        self.render_finished.emit(self.current_job.request_id, ok, json.dumps(payload, default=str))
+
     def timeout(self):
         logger.error(self.control.prepend_id('Job timed out in {}sec - {}'.format(self.current_job.timeout or DEFAULT_JOB_TIMEOUT_SECONDS, self.current_job)))
-        self.control.abort(retry_after_sec=10)
+        self.control.abort(cause=CAUSE_TIMEOUT)
+
+    def stalled(self, seconds):
+        if not self.current_job:
+            return
+        logger.error(self.control.prepend_id('Job stalled, no progress in {:.0f}sec - {}'.format(seconds, self.current_job)))
+        self.control.abort(cause=CAUSE_STALLED)
+
+    def dom_mutations(self):
+        # Counted by controller.js once it is injected
+        if not self.injected:
+            return None
+        return self.mainFrame().evaluateJavaScript('SjCtrl.domMutations')
 
     def reset(self):
+        if self.current_job:
+            self.jobs_done += 1
+            self.process_rss_growth += max(0, self.process.memory_info().rss - self.rss_at_job_start)
         self.current_job = None
+        self.job_result = None
         self.injected = False
         self.timeout_timer.stop()
         self.timeout_timer.setInterval(DEFAULT_JOB_TIMEOUT_SECONDS * 1000)
+        self.activity.stop()
         self.access_manager.reset()
         self.mainFrame().setUrl(QUrl('file://' + BASE_PROJECT_DIR + '/blank.html'))
         self.settings().resetAttribute(QWebSettings.AutoLoadImages)
@@ -233,6 +406,9 @@ class WebPageCustom(QWebPage):
             return
 
         self.injected = True
+        started = monotonic()
+        if self.current_job.url:
+            LOAD_TO_INJECT.labels(*job_labels(self.current_job)).observe(started - self.job_started_at)
 
         logger.debug(self.control.prepend_id('Injecting Scripts'))
         self.mainFrame().addToJavaScriptWindowObject("SjCtrl", self.control)
@@ -240,21 +416,43 @@ class WebPageCustom(QWebPage):
         for js_lib in self.get_js_lib_string():
             self.mainFrame().evaluateJavaScript(js_lib)
 
-        with open(self.current_job.file, 'r') as job_file:
-            self.mainFrame().evaluateJavaScript(job_file.read())
+        job_source = None
+        if self.job_registry:
+            job_source = self.job_registry.get_source(self.current_job.file)
+        else:
+            try:
+                with open(self.current_job.file, 'r') as job_file:
+                    job_source = job_file.read()
+            except OSError as e:
+                logger.error(self.control.prepend_id('Could not read the job file {}: {}'.format(self.current_job.file, e)))
+
+        if job_source is None:
+            logger.error(self.control.prepend_id('Could not load the job file {}'.format(self.current_job.file)))
+            self.control.abort(cause=CAUSE_SCRIPT)
+            return
+        self.mainFrame().evaluateJavaScript(job_source)
+        # Gone if the script finished the job while it was evaluated
+        if self.trace:
+            self.trace.span('inject', started)
 
     @pyqtSlot(bool)
     def on_load_finished(self, ok):
         if not self.current_job:
             return
 
+        if self.trace:
+            if self.injected:
+                self.trace.instant('loadFinished', ok=ok)
+            else:
+                self.trace.span('load', self.job_started_at, ok=ok)
+
         if not ok:
             logger.warning(self.control.prepend_id('The load was unsuccessful. Not Injecting: {}'.format(self.current_job)))
             return
 
         self.inject_job()
 
-    def load_job(self, job):
+    def load_job(self, job, queued_sec=0):
         logger.info(self.control.prepend_id('Job Request {}'.format(job)))
         if not job.file:
             logger.error(self.control.prepend_id('No Job file specified {}'.format(job)))
@@ -264,10 +462,21 @@ class WebPageCustom(QWebPage):
         self.timeout_timer.start()
 
         self.current_job = job
+        self.activity.start(JOB_STALL_SECONDS if job.stall_timeout is None else float(job.stall_timeout))
+        self.job_started_at = monotonic()
+        self.trace = start_trace(job, self.id, queued_sec)
+        self.net_archive = open_archive(job)
+        self.rss_at_job_start = self.process.memory_info().rss
 
         if self.current_job.filter_list:
             self.access_manager.set_filter(self.current_job.filter_list)
 
+        if self.current_job.cache_hosts:
+            self.access_manager.set_cache_hosts(self.current_job.cache_hosts)
+
+        if self.current_job.block_profile:
+            self.access_manager.set_block_profile(self.current_job.block_profile)
+
         if self.current_job.block_images:
             self.settings().setAttribute(QWebSettings.AutoLoadImages, False)
 
@@ -277,8 +486,7 @@ class WebPageCustom(QWebPage):
             qurl = QUrl(self.current_job.url)
             if not qurl.isValid():
                 logger.error(self.control.prepend_id('Invalid URL {}'.format(self.current_job.url)))
-                self.reset()
-                self.job_finished.emit()
+                self.control.abort(cause=CAUSE_INVALID_URL)
                 return
 
             self.mainFrame().setUrl(qurl)
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+import logging.config
+import multiprocessing
+import os
+import signal
+import sys
+from time import monotonic
+
+from PyQt5.QtCore import QObject, QSocketNotifier, QTimer, Qt, pyqtSignal, pyqtSlot
+from PyQt5.QtWidgets import QApplication
+
+import settings
+from http_cache import SharedCache
+from job import Job
+from metrics import REGISTRY
+from page_coordinator import PageCoordinator
+from rate_limiter import RateLimiter
+from retry_policy import CAUSE_CRASHED
+from result_spool import ResultSpool
+from settings import WORKER_HEALTH_CHECK_SECONDS, WORKER_RESTART_DELAY_SECONDS, HTTP_CACHE_DIRECTORY, \
+    RESULT_SPOOL_DIRECTORY, METRICS_PUSH_SECONDS, RATE_LIMIT_REPORT_MILLISECONDS
+
+logger = logging.getLogger(__name__)
+
+# Messages exchanged over the pipe between the supervisor and a worker. Every message is a tuple whose first
+# item is the message type.
+#   supervisor -> worker: (MSG_JOB, slot, job_dict, queued_sec), (MSG_CANCEL, slot, request_id)
+#   worker -> supervisor: (MSG_FINISHED, slot), (MSG_NEW_JOB, job_dict), (MSG_NEW_JOBS, [job_dict]),
+#                         (MSG_JOB_FAILED, job_dict, cause, retry_after_sec),
+#                         (MSG_RENDER_FINISHED, slot, request_id, ok, payload), (MSG_THROTTLED, key, retry_after_sec),
+#                         (MSG_METRICS, snapshot), (MSG_CHARGED, {rate limit key: requests})
+MSG_JOB = 'job'
+MSG_CANCEL = 'cancel'
+MSG_FINISHED = 'finished'
+MSG_NEW_JOB = 'new_job'
+MSG_NEW_JOBS = 'new_jobs'
+MSG_JOB_FAILED = 'job_failed'
+MSG_RENDER_FINISHED = 'render_finished'
+MSG_THROTTLED = 'throttled'
+MSG_METRICS = 'metrics'
+MSG_CHARGED = 'charged'
+
+
+class RemotePage(QObject):
+    """Stands in for a WebPageCustom that lives in a worker process"""
+    job_finished = pyqtSignal()
+    new_job_received = pyqtSignal(Job)
+    new_jobs_received = pyqtSignal(list)
+    job_failed = pyqtSignal(Job, str, int)
+    render_finished = pyqtSignal(int, bool, str)
+    id_gen = 0
+    # Recycling happens inside the worker that owns the real page
+    recyclable = False
+    draining = False
+    jobs_done = 0
+    process_rss_growth = 0
+
+    def __init__(self, worker, slot):
+        super().__init__(worker)
+        RemotePage.id_gen += 1
+        self.id = RemotePage.id_gen
+        self.worker = worker
+        self.slot = slot
+        self.current_job = None
+
+    def is_busy(self):
+        # Slots of a worker that is waiting to be restarted can't take jobs
+        return bool(self.current_job) or not self.worker.is_running()
+
+    def should_retire(self):
+        return False
+
+    def load_job(self, job, queued_sec=0):
+        self.current_job = job
+        self.worker.send((MSG_JOB, self.slot, job.dict(), queued_sec))
+
+    def cancel_job(self):
+        if self.current_job:
+            self.worker.send((MSG_CANCEL, self.slot, self.current_job.request_id))
+
+    def finish(self):
+        self.current_job = None
+        self.job_finished.emit()
+
+
+class WorkerProcess(QObject):
+    started = pyqtSignal()
+
+    def __init__(self, worker_id, instances, parent=None):
+        super().__init__(parent)
+        self.worker_id = worker_id
+        self.instances = instances
+        self.pages = [RemotePage(self, slot) for slot in range(instances)]
+        self.process = None
+        self.connection = None
+        self.notifier = None
+        self.started_at = 0
+        self.restart_timer = QTimer(self)
+        self.restart_timer.setSingleShot(True)
+        self.restart_timer.timeout.connect(self.start)
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=run_worker,
+                                       args=(child_connection, self.worker_id, self.instances),
+                                       name='worker-{}'.format(self.worker_id),
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.started_at = monotonic()
+
+        self.notifier = QSocketNotifier(self.connection.fileno(), QSocketNotifier.Read, self)
+        self.notifier.activated.connect(self.read_messages)
+        logger.info('Started worker {} pid {} with {} pages'.format(self.worker_id, self.process.pid, self.instances))
+        self.started.emit()
+
+    def is_running(self):
+        return self.process is not None and self.connection is not None
+
+    def send(self, message):
+        if not self.is_running():
+            # The worker is being restarted. The jobs are picked back up by requeue_jobs
+            return
+        try:
+            self.connection.send(message)
+        except (OSError, EOFError):
+            self.worker_died()
+
+    def read_messages(self):
+        try:
+            while self.connection is not None and self.connection.poll():
+                self.handle_message(self.connection.recv())
+        except (OSError, EOFError):
+            self.worker_died()
+
+    def handle_message(self, message):
+        message_type = message[0]
+        if message_type == MSG_FINISHED:
+            self.pages[message[1]].finish()
+        elif message_type == MSG_NEW_JOB:
+            # Fan out jobs are queued on the supervisor so that they can run on any worker
+            self.pages[0].new_job_received.emit(Job(**message[1]))
+        elif message_type == MSG_NEW_JOBS:
+            self.pages[0].new_jobs_received.emit([Job(**job_dict) for job_dict in message[1]])
+        elif message_type == MSG_JOB_FAILED:
+            # Retries are decided by the supervisor, which owns the retry budget
+            self.pages[0].job_failed.emit(Job(**message[1]), message[2], message[3])
+        elif message_type == MSG_RENDER_FINISHED:
+            self.pages[message[1]].render_finished.emit(message[2], message[3], message[4])
+        elif message_type == MSG_THROTTLED:
+            # Jobs are dispatched by the supervisor, so it has to slow down too
+            RateLimiter.get().throttle(message[1], message[2])
+        elif message_type == MSG_CHARGED:
+            # Subrequests of the worker's pages hold back the next jobs for their host
+            rate_limiter = RateLimiter.get()
+            for key, requests in message[1].items():
+                rate_limiter.take(key, requests)
+        elif message_type == MSG_METRICS:
+            # Served by the supervisor with a worker label. A restarted worker starts its counters over.
+            REGISTRY.set_remote(str(self.worker_id), message[1])
+        else:
+            logger.error('Unknown message from worker {}: {}'.format(self.worker_id, message))
+
+    def check_health(self):
+        if self.process is not None and not self.process.is_alive():
+            self.worker_died()
+
+    def worker_died(self):
+        if self.process is None:
+            return
+
+        logger.error('Worker {} pid {} died with exit code {}'.format(self.worker_id, self.process.pid, self.process.exitcode))
+        self.notifier.setEnabled(False)
+        self.notifier.deleteLater()
+        self.notifier = None
+        self.connection.close()
+        self.connection = None
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(1)
+        self.process = None
+
+        if monotonic() - self.started_at < WORKER_RESTART_DELAY_SECONDS:
+            # Crash looping. Give it a moment before the next attempt.
+            self.restart_timer.start(WORKER_RESTART_DELAY_SECONDS * 1000)
+        else:
+            self.start()
+        self.requeue_jobs()
+
+    def requeue_jobs(self):
+        for page in self.pages:
+            if page.current_job and page.current_job.request_id:
+                page.render_finished.emit(page.current_job.request_id, False, '{"error": "Worker died"}')
+                page.finish()
+            elif page.current_job:
+                job = page.current_job
+                logger.warning('Job of dead worker {} failed: {}'.format(self.worker_id, job))
+                # A job that crashes WebKit every time would crash every worker it goes to. As a failure it gets the
+                # retry policy's tries and ends up with the dead jobs. Finished first so that its retry isn't
+                # coalesced into it.
+                page.finish()
+                page.job_failed.emit(job, CAUSE_CRASHED, 0)
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+
+
+class WorkerPool(QObject):
+    worker_started = pyqtSignal()
+
+    def __init__(self, workers, pages_per_worker, parent=None):
+        super().__init__(parent)
+        self.workers = [WorkerProcess(worker_id, pages_per_worker, self) for worker_id in range(workers)]
+        for worker in self.workers:
+            worker.started.connect(self.worker_started)
+        self.unassigned_pages = [page for worker in self.workers for page in worker.pages]
+
+        self.health_timer = QTimer(self)
+        self.health_timer.setTimerType(Qt.CoarseTimer)
+        self.health_timer.timeout.connect(self.check_health)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.health_timer.start(WORKER_HEALTH_CHECK_SECONDS * 1000)
+
+    def stop(self):
+        self.health_timer.stop()
+        for worker in self.workers:
+            worker.stop()
+
+    def instances(self):
+        return len(self.unassigned_pages)
+
+    def take_page(self, coordinator, job_registry=None):
+        """Used as the page_factory of the supervisor's PageCoordinator"""
+        return self.unassigned_pages.pop(0)
+
+    @pyqtSlot()
+    def check_health(self):
+        for worker in self.workers:
+            worker.check_health()
+
+
+class WorkerCoordinator(PageCoordinator):
+    """Runs the pages of one worker process. Scheduling and cron stay with the supervisor."""
+
+    def __init__(self, connection, worker_id, instances):
+        super().__init__(instances, local_jobs=False)
+        self.connection = connection
+        self.worker_id = worker_id
+        self.notifier = QSocketNotifier(connection.fileno(), QSocketNotifier.Read, self)
+        self.notifier.activated.connect(self.read_messages)
+        self.rate_limiter.throttled.connect(lambda key, retry_after_sec: self.connection.send(
+            (MSG_THROTTLED, key, retry_after_sec)))
+
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.setTimerType(Qt.VeryCoarseTimer)
+        self.metrics_timer.timeout.connect(self.send_metrics)
+        self.metrics_timer.start(METRICS_PUSH_SECONDS * 1000)
+
+        self.rate_limiter.report_charges()
+        self.charges_timer = QTimer(self)
+        self.charges_timer.timeout.connect(self.send_charges)
+        self.charges_timer.start(RATE_LIMIT_REPORT_MILLISECONDS)
+
+    def create_page(self):
+        wp = super().create_page()
+        wp.render_finished.disconnect()
+        wp.render_finished.connect(lambda request_id, ok, payload, wp=wp: self.connection.send(
+            (MSG_RENDER_FINISHED, self.web_pages.index(wp), request_id, ok, payload)))
+        return wp
+
+    @pyqtSlot()
+    def send_metrics(self):
+        self.connection.send((MSG_METRICS, REGISTRY.snapshot()))
+
+    @pyqtSlot()
+    def send_charges(self):
+        charges = self.rate_limiter.take_charges()
+        if charges:
+            self.connection.send((MSG_CHARGED, charges))
+
+    def read_messages(self):
+        try:
+            while self.connection.poll():
+                self.handle_message(self.connection.recv())
+        except (OSError, EOFError):
+            logger.error('Lost connection to the supervisor. Exiting worker {}'.format(self.worker_id))
+            self.notifier.setEnabled(False)
+            QApplication.instance().quit()
+
+    def handle_message(self, message):
+        if message[0] == MSG_JOB:
+            web_page = self.web_pages[message[1]]
+            job = Job(**message[2])
+            self.running_jobs[web_page] = self.job_queue.entry(job)
+            web_page.load_job(job, message[3])
+        elif message[0] == MSG_CANCEL:
+            web_page = self.web_pages[message[1]]
+            # The page may have moved on to another job by the time the cancel arrives
+            if web_page.current_job and web_page.current_job.request_id == message[2]:
+                web_page.cancel_job()
+        else:
+            logger.error('Unknown message from supervisor: {}'.format(message))
+
+    @pyqtSlot(Job)
+    def queue_new_job(self, job, store_id=None):
+        self.connection.send((MSG_NEW_JOB, job.dict()))
+
+    @pyqtSlot(list)
+    def queue_new_jobs(self, jobs):
+        self.connection.send((MSG_NEW_JOBS, [job.dict() for job in jobs]))
+
+    @pyqtSlot(Job, str, int)
+    def on_job_failed(self, job, cause, retry_after_sec):
+        self.connection.send((MSG_JOB_FAILED, job.dict(), cause, retry_after_sec))
+
+    def on_job_finished(self, web_page):
+        slot = self.web_pages.index(web_page)
+        self.release_page(web_page)
+        self.check_no_work()
+        self.connection.send((MSG_FINISHED, slot))
+
+
+def run_worker(connection, worker_id, instances):
+    logging.config.dictConfig(settings.LOGGING)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.info('Worker {} starting with {} pages'.format(worker_id, instances))
+
+    # Each worker keeps its own http cache. QNetworkDiskCache can't share a directory between processes.
+    SharedCache.configure(os.path.join(HTTP_CACHE_DIRECTORY, 'worker-{}'.format(worker_id)))
+    ResultSpool.configure(os.path.join(RESULT_SPOOL_DIRECTORY, 'worker-{}'.format(worker_id)))
+
+    app = QApplication(sys.argv[:1])
+    # Starts delivering what the last run of this worker left in its spool
+    ResultSpool.get()
+    # Held by the app for as long as it runs
+    app.coordinator = WorkerCoordinator(connection, worker_id, instances)
+    sys.exit(app.exec_())